@@ -0,0 +1,149 @@
+"""
+Times the Aleph operations against a local `AlephStub` serving generated
+data, so concurrency and caching changes can be compared run to run:
+
+    python experiments/aleph_benchmark.py --entities 5000 --latency 0.02
+"""
+import argparse
+import json
+import random
+import time
+
+from followthemoney_graph.backends.networkx import NetworkxEntityGraph
+from followthemoney_graph.cache import Cache, LRUCache
+from followthemoney_graph.lib import AsyncMapper, metrics
+from followthemoney_graph.operations import aleph
+from followthemoney_graph.tests.aleph_server import AlephStub
+
+
+FIRST_NAMES = ["Anna", "Boris", "Carla", "Dmitri", "Elena", "Farid", "Goran"]
+LAST_NAMES = ["Ivanov", "Horvat", "Novak", "Popescu", "Kovacs", "Petrov"]
+
+
+def generate(n_entities, n_links, n_duplicates, seed=0):
+    """
+    Returns entities, collections and xref matches for a collection of
+    `n_entities` people and companies connected by `n_links` ownerships in
+    a second collection, which also holds `n_duplicates` name-alike people.
+    """
+    rnd = random.Random(seed)
+    collections = [
+        {"id": "1", "foreign_id": "bench", "label": "Benchmark"},
+        {"id": "2", "foreign_id": "bench_links", "label": "Benchmark links"},
+    ]
+    entities = []
+    for i in range(n_entities):
+        if i % 2:
+            name = f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)} {i}"
+            schema = "Person"
+        else:
+            name = f"Company {i} Ltd"
+            schema = "Company"
+        entities.append(
+            {
+                "id": f"e{i}",
+                "schema": schema,
+                "collection_id": "1",
+                "properties": {"name": [name]},
+            }
+        )
+    for i in range(n_links):
+        owner = rnd.randrange(1, n_entities, 2)
+        asset = rnd.randrange(0, n_entities, 2)
+        entities.append(
+            {
+                "id": f"l{i}",
+                "schema": "Ownership",
+                "collection_id": "2",
+                "properties": {"owner": [f"e{owner}"], "asset": [f"e{asset}"]},
+            }
+        )
+    xrefs = []
+    for i in range(n_duplicates):
+        original = entities[rnd.randrange(1, n_entities, 2)]
+        duplicate = {
+            "id": f"d{i}",
+            "schema": "Person",
+            "collection_id": "2",
+            "properties": {"name": list(original["properties"]["name"])},
+        }
+        entities.append(duplicate)
+        xrefs.append(
+            {
+                "score": rnd.uniform(0.5, 1),
+                "entity": original,
+                "match": duplicate,
+                "match_collection": {"collection_id": "2"},
+            }
+        )
+    xrefs.sort(key=lambda x: x["score"], reverse=True)
+    return entities, collections, {"1": xrefs}
+
+
+def run(name, func, *args, **kwargs):
+    metrics.reset()
+    start = time.perf_counter()
+    n = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>22}: {n:>7} new in {elapsed:7.2f}s")
+    return {
+        "operation": name,
+        "seconds": elapsed,
+        "new": n,
+        "requests": metrics.get("aleph.requests") or 0,
+        "cache_hits": metrics.get("aleph.cache_hits") or 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, default=2000)
+    parser.add_argument("--links", type=int, default=2000)
+    parser.add_argument("--duplicates", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--cache", action="store_true", help="Cache responses")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    entities, collections, xrefs = generate(args.entities, args.links, args.duplicates)
+    stub = AlephStub(
+        entities=entities,
+        collections=collections,
+        xrefs=xrefs,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        page_size=args.page_size,
+        seed=0,
+    )
+    mapper = AsyncMapper(concurrency=args.concurrency)
+    results = []
+    metrics.enable()
+    with stub:
+        cache = LRUCache() if args.cache else Cache()
+        aleph.aleph_configure(host=stub.url, api_key="benchmark", cache=cache)
+        G = NetworkxEntityGraph()
+        operations = [
+            ("add_aleph_collection", aleph.add_aleph_collection, (G, "bench"), {}),
+            ("enrich_xref", aleph.enrich_xref, (G, "bench"), {}),
+            ("enrich_similar", aleph.enrich_similar, (G,), {"mapper": mapper}),
+            (
+                "expand",
+                aleph.expand,
+                (G,),
+                {"mapper": mapper, "batch_size": args.batch_size},
+            ),
+        ]
+        for name, func, op_args, op_kwargs in operations:
+            results.append(run(name, func, *op_args, **op_kwargs))
+    print(f"{'graph':>22}: {G.n_nodes} nodes, {G.n_edges} edges")
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump({"args": vars(args), "results": results}, fd, indent=2)
+
+
+if __name__ == "__main__":
+    main()
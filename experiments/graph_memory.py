@@ -0,0 +1,72 @@
+"""
+Measures the memory held by an entity graph built from synthetic people,
+companies and ownerships, with tracemalloc:
+
+    python experiments/graph_memory.py --entities 20000 --links 40000
+
+Run it against two checkouts (PYTHONPATH) to compare changes to the graph
+structures.
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from followthemoney import model
+
+from followthemoney_graph.backends.networkx import NetworkxEntityGraph
+
+try:
+    from followthemoney_graph.backends.csr import CSREntityGraph
+except ImportError:
+    CSREntityGraph = None
+
+
+def generate(n_entities, n_links, seed=0):
+    rnd = random.Random(seed)
+    for i in range(n_entities):
+        proxy = model.make_entity("Person" if i % 2 else "Company")
+        proxy.id = f"entity-{i:08d}-{rnd.getrandbits(64):016x}"
+        proxy.add("name", f"Entity {i}")
+        yield proxy
+    for i in range(n_links):
+        proxy = model.make_entity("Ownership")
+        proxy.id = f"link-{i:08d}-{rnd.getrandbits(64):016x}"
+        yield proxy
+
+
+def build(cls, n_entities, n_links):
+    proxies = list(generate(n_entities, 0))
+    ids = [p.id for p in proxies]
+    rnd = random.Random(1)
+    for link in generate(0, n_links):
+        link.add("owner", ids[rnd.randrange(1, n_entities, 2)])
+        link.add("asset", ids[rnd.randrange(0, n_entities, 2)])
+        proxies.append(link)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    G = cls()
+    G.add_proxies(proxies)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return G, current, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, default=20000)
+    parser.add_argument("--links", type=int, default=40000)
+    parser.add_argument("--backend", choices=["networkx", "csr"], default="networkx")
+    args = parser.parse_args()
+    cls = CSREntityGraph if args.backend == "csr" else NetworkxEntityGraph
+    G, current, peak, elapsed = build(cls, args.entities, args.links)
+    print(f"{G.n_nodes} nodes, {G.n_edges} edges in {elapsed:.1f}s")
+    print(f"graph: {current / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Times `EntityGraph.from_file` on a generated export along with the share of
+the time spent reading and decoding lines:
+
+    python experiments/loader_benchmark.py --entities 100000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from followthemoney_graph import loader
+from followthemoney_graph.backends.networkx import NetworkxEntityGraph
+
+
+def generate(path, n_entities, seed=0):
+    rnd = random.Random(seed)
+    with open(path, "w") as fd:
+        for i in range(n_entities):
+            if i % 3 == 2:
+                data = {
+                    "id": f"link-{i}",
+                    "schema": "Ownership",
+                    "properties": {
+                        "owner": [f"entity-{i - 1}"],
+                        "asset": [f"entity-{i - 2}"],
+                        "percentage": [str(rnd.randint(1, 100))],
+                    },
+                }
+            else:
+                data = {
+                    "id": f"entity-{i}",
+                    "schema": "Person",
+                    "properties": {
+                        "name": [f"Person {i}"],
+                        "birthDate": [f"19{rnd.randint(10, 99)}"],
+                    },
+                    "flags": {"seen": True},
+                }
+            fd.write(json.dumps(data) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, default=60000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
+    try:
+        generate(path, args.entities)
+        start = time.perf_counter()
+        with open(path) as fd:
+            for _ in loader.iter_records(fd):
+                pass
+        decode = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path) as fd:
+            G = NetworkxEntityGraph.from_file(fd)
+        elapsed = time.perf_counter() - start
+        print(f"decode: {decode:.2f}s")
+        share = decode / elapsed
+        print(f"load: {elapsed:.2f}s ({share:.0%} decoding, {G.n_nodes} nodes)")
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
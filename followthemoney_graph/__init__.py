@@ -2,6 +2,12 @@ import logging
 from pkg_resources import iter_entry_points
 
 from followthemoney_graph.entity_graph import EntityGraph  # noqa
-from followthemoney_graph.cache import Cache, RedisCache
+from followthemoney_graph.cache import (
+    Cache,
+    RedisCache,
+    SQLiteCache,
+    LRUCache,
+    TieredCache,
+)
 
 log = logging.getLogger(__name__)
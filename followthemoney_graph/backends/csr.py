@@ -0,0 +1,266 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .graph_backend import GraphBackend
+from followthemoney_graph.entity_graph import EntityGraph
+
+
+class CSREntityGraph(GraphBackend, EntityGraph):
+    """
+    Graph backend that keeps edges in flat NumPy arrays with a CSR index
+    over node keys. Recent inserts go into a small delta buffer that is
+    folded into the arrays once it grows past `COMPACT_THRESHOLD` or before
+    a vectorized query. Edge data is interned, so every edge costs a handful
+    of integers instead of a dict-of-dict entry.
+    """
+
+    COMPACT_THRESHOLD = 2 ** 16
+
+    def __init__(self):
+        super().__init__()
+        self._nodes = {}
+        self._data_ids = {}
+        self._data_values = []
+        self._n_edge_count = 0
+        self._edge_source = np.zeros(0, dtype=np.int64)
+        self._edge_target = np.zeros(0, dtype=np.int64)
+        self._edge_key = np.zeros(0, dtype=np.int64)
+        self._edge_data = np.zeros(0, dtype=np.int64)
+        self._edge_alive = np.zeros(0, dtype=bool)
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._indices = np.zeros(0, dtype=np.int64)
+        self._delta = {}
+        self._delta_adj = {}
+        self._n_dead = 0
+
+    def _has_node(self, node_key):
+        return node_key in self._nodes
+
+    def _add_node(self, node_key, node):
+        self._nodes[node_key] = node
+
+    def _add_edge(self, source_key, target_key, key, **data):
+        assert source_key in self._nodes
+        assert target_key in self._nodes
+        data_id = self._intern_data(data)
+        ident = self._edge_ident(source_key, target_key, key)
+        if ident in self._delta:
+            self._delta[ident][2] = data_id
+            return
+        eid = self._find_compacted(source_key, target_key, key)
+        if eid is not None:
+            self._edge_data[eid] = data_id
+            return
+        self._delta[ident] = [source_key, target_key, data_id]
+        self._delta_adj.setdefault(source_key, set()).add(ident)
+        self._delta_adj.setdefault(target_key, set()).add(ident)
+        self._n_edge_count += 1
+        if len(self._delta) >= self.COMPACT_THRESHOLD:
+            self.compact()
+
+    def _add_edges(self, sources, targets, keys, data_ids, data_values):
+        """
+        Appends the edges straight onto the arrays when the graph has no
+        edges yet, otherwise falls back to adding them one by one.
+        """
+        if self._n_edge_count:
+            return super()._add_edges(sources, targets, keys, data_ids, data_values)
+        remap = np.array([self._intern_data(d) for d in data_values], dtype=np.int64)
+        self._edge_source = np.asarray(sources, dtype=np.int64)
+        self._edge_target = np.asarray(targets, dtype=np.int64)
+        self._edge_key = np.asarray(keys, dtype=np.int64)
+        self._edge_data = remap[np.asarray(data_ids, dtype=np.int64)]
+        self._edge_alive = np.ones(len(self._edge_source), dtype=bool)
+        self._n_edge_count = len(self._edge_source)
+        self.compact()
+
+    def _remove_node(self, node_key):
+        """Deletes node and all adjacent edges"""
+        del self._nodes[node_key]
+        eids = self._row(node_key)
+        eids = eids[self._edge_alive[eids]]
+        self._edge_alive[eids] = False
+        self._n_edge_count -= len(eids)
+        self._n_dead += len(eids)
+        for ident in self._delta_adj.pop(node_key, ()):
+            source_key, target_key, _ = self._delta.pop(ident)
+            other = target_key if source_key == node_key else source_key
+            if other != node_key:
+                self._delta_adj[other].discard(ident)
+            self._n_edge_count -= 1
+
+    def _iter_edges(self, **flags):
+        node_keys = None
+        if flags:
+            node_keys = self._flag_index.find(**flags)
+            if node_keys is None:
+                lookup = self._ids.lookup
+                node_keys = [lookup(n.id) for n in self._iter_nodes(**flags)]
+        mask = self._edge_alive.copy()
+        if node_keys is not None:
+            keys = np.fromiter(node_keys, dtype=np.int64)
+            mask &= np.isin(self._edge_source, keys)
+            mask &= np.isin(self._edge_target, keys)
+            node_keys = set(keys.tolist())
+        for eid in np.flatnonzero(mask):
+            yield self._compacted_edge(eid)
+        for (_, _, key), (source_key, target_key, data_id) in list(
+            self._delta.items()
+        ):
+            if node_keys is not None and (
+                source_key not in node_keys or target_key not in node_keys
+            ):
+                continue
+            yield source_key, target_key, key, dict(self._data_values[data_id])
+
+    def _iter_nodes(self, **flags):
+        node_keys = self._flag_index.find(**flags) if flags else None
+        if node_keys is None:
+            for node in self._nodes.values():
+                if node.has_flags(**flags):
+                    yield node
+        else:
+            for node_key in node_keys:
+                yield self._nodes[node_key]
+
+    def _get_n_nodes(self):
+        return len(self._nodes)
+
+    def _get_n_edges(self):
+        return self._n_edge_count
+
+    def _get_node(self, node_key):
+        return self._nodes[node_key]
+
+    def _get_node_edges(self, node_key):
+        edges = []
+        eids = self._row(node_key)
+        for eid in eids[self._edge_alive[eids]]:
+            source_key, target_key, key, data = self._compacted_edge(eid)
+            if source_key != node_key:
+                source_key, target_key = target_key, source_key
+            edges.append((source_key, target_key, key, data))
+        for ident in self._delta_adj.get(node_key, ()):
+            source_key, target_key, data_id = self._delta[ident]
+            if source_key != node_key:
+                source_key, target_key = target_key, source_key
+            data = dict(self._data_values[data_id])
+            edges.append((source_key, target_key, ident[2], data))
+        return edges
+
+    def compact(self):
+        """
+        Fold the delta buffer into the edge arrays, drop removed edges and
+        rebuild the CSR index. Does nothing when there is nothing to fold in.
+        """
+        if not self._delta and not self._n_dead:
+            return
+        alive = self._edge_alive
+        n_delta = len(self._delta)
+        delta = np.array(
+            [(s, t, k, d) for (_, _, k), (s, t, d) in self._delta.items()],
+            dtype=np.int64,
+        ).reshape(n_delta, 4)
+        source = np.concatenate([self._edge_source[alive], delta[:, 0]])
+        target = np.concatenate([self._edge_target[alive], delta[:, 1]])
+        self._edge_source = source
+        self._edge_target = target
+        self._edge_key = np.concatenate([self._edge_key[alive], delta[:, 2]])
+        self._edge_data = np.concatenate([self._edge_data[alive], delta[:, 3]])
+        self._edge_alive = np.ones(len(source), dtype=bool)
+        self._delta = {}
+        self._delta_adj = {}
+        self._n_dead = 0
+
+        eids = np.arange(len(source), dtype=np.int64)
+        loops = source == target
+        rows = np.concatenate([source, target[~loops]])
+        row_eids = np.concatenate([eids, eids[~loops]])
+        order = np.argsort(rows, kind="stable")
+        counts = np.bincount(rows, minlength=len(self._ids))
+        self._indices = row_eids[order]
+        self._indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._indptr[1:])
+
+    def get_degrees(self):
+        """Returns a {node_id: degree} dict with self-loops counted twice"""
+        self.compact()
+        counts = np.diff(self._indptr)
+        loops = self._edge_source[self._edge_source == self._edge_target]
+        counts += np.bincount(loops, minlength=len(counts))
+        ids = self._ids
+        return {ids[k]: int(counts[k]) if k < len(counts) else 0 for k in self._nodes}
+
+    def get_node_neighbors(self, node):
+        node_key = self._node_key(node.id)
+        eids = self._row(node_key)
+        eids = eids[self._edge_alive[eids]]
+        others = set(self._edge_source[eids].tolist())
+        others.update(self._edge_target[eids].tolist())
+        for ident in self._delta_adj.get(node_key, ()):
+            others.update(ident[:2])
+        others.discard(node_key)
+        return [self._nodes[k] for k in others]
+
+    def get_components(self):
+        """Returns the connected components as lists of nodes"""
+        self.compact()
+        n = len(self._ids)
+        weights = np.ones(len(self._edge_source), dtype=np.int8)
+        adjacency = coo_matrix(
+            (weights, (self._edge_source, self._edge_target)), shape=(n, n)
+        )
+        _, labels = connected_components(adjacency, directed=False)
+        node_keys = np.fromiter(self._nodes, dtype=np.int64, count=len(self._nodes))
+        node_labels = labels[node_keys]
+        order = np.argsort(node_labels, kind="stable")
+        splits = np.flatnonzero(np.diff(node_labels[order])) + 1
+        return [
+            [self._nodes[k] for k in group.tolist()]
+            for group in np.split(node_keys[order], splits)
+            if len(group)
+        ]
+
+    def _row(self, node_key):
+        if node_key + 1 >= len(self._indptr):
+            return self._indices[:0]
+        return self._indices[self._indptr[node_key] : self._indptr[node_key + 1]]
+
+    def _find_compacted(self, source_key, target_key, key):
+        eids = self._row(source_key)
+        if not len(eids):
+            return None
+        mask = self._edge_alive[eids] & (self._edge_key[eids] == key)
+        sources, targets = self._edge_source[eids], self._edge_target[eids]
+        mask &= ((sources == source_key) & (targets == target_key)) | (
+            (sources == target_key) & (targets == source_key)
+        )
+        found = np.flatnonzero(mask)
+        if not len(found):
+            return None
+        return eids[found[0]]
+
+    def _compacted_edge(self, eid):
+        data = dict(self._data_values[self._edge_data[eid]])
+        return (
+            int(self._edge_source[eid]),
+            int(self._edge_target[eid]),
+            int(self._edge_key[eid]),
+            data,
+        )
+
+    def _intern_data(self, data):
+        ident = tuple(sorted(data.items()))
+        data_id = self._data_ids.get(ident)
+        if data_id is None:
+            data_id = len(self._data_values)
+            self._data_ids[ident] = data_id
+            self._data_values.append(data)
+        return data_id
+
+    @staticmethod
+    def _edge_ident(source_key, target_key, key):
+        if source_key <= target_key:
+            return (source_key, target_key, key)
+        return (target_key, source_key, key)
@@ -2,17 +2,32 @@ class GraphBackend:
     def _has_node(self, node_id):
         raise NotImplementedError
 
-    def _add_node(self, node):
+    def _add_node(self, node_key, node):
         raise NotImplementedError
 
     def _add_edge(self, source, target, key, **data):
         raise NotImplementedError
 
+    def _node_changed(self, node_key, node):
+        """Called after the proxies of a stored node were changed in place"""
+        pass
+
+    def _add_edges(self, sources, targets, keys, data_ids, data_values):
+        """
+        Adds edges given as parallel key arrays, with `data_ids` indexing
+        into `data_values`. Backends can override this to load in bulk.
+        """
+        for source, target, key, data_id in zip(
+            sources.tolist(), targets.tolist(), keys.tolist(), data_ids.tolist()
+        ):
+            self._add_edge(source, target, key=key, **data_values[data_id])
+
     def _remove_node(self, node_id):
         """Deletes node and all adjacent edges"""
         raise NotImplementedError
 
     def _iter_edges(self, **flags):
+        """Yields (source, target, key, data) for edges between nodes matching flags"""
         raise NotImplementedError
 
     def _iter_nodes(self, **flags):
@@ -27,8 +42,15 @@ class GraphBackend:
     def _get_node(self, node_id):
         raise NotImplementedError
 
-    def _get_node_in_edges(self, node_id):
+    def _get_node_edges(self, node_id):
         raise NotImplementedError
 
-    def _get_node_out_edges(self, node_id):
-        raise NotImplementedError
+    def _get_node_in_edges(self, node_key):
+        """Edges of the node oriented (see `_orient_edge`) to end at it"""
+        edges = (self._orient_edge(*e) for e in self._get_node_edges(node_key))
+        return [e for e in edges if e[1] == node_key]
+
+    def _get_node_out_edges(self, node_key):
+        """Edges of the node oriented (see `_orient_edge`) to start at it"""
+        edges = (self._orient_edge(*e) for e in self._get_node_edges(node_key))
+        return [e for e in edges if e[0] == node_key]
@@ -2,44 +2,62 @@ import networkx as nx
 
 from .graph_backend import GraphBackend
 from followthemoney_graph.entity_graph import EntityGraph
+from followthemoney_graph.interner import IdentityInterner
 
 
 class NetworkxEntityGraph(GraphBackend, EntityGraph):
+    """
+    Keeps the graph in a networkx MultiGraph keyed by the string ids: with
+    integer keys, networkx's per-node and per-edge dicts take more memory
+    than interning saves.
+    """
+
     def __init__(self):
         super().__init__()
+        self._ids = IdentityInterner()
         self.network = nx.MultiGraph()
 
     @classmethod
     def from_file(cls, *args, **kwargs):
         return super().from_file(*args, **kwargs)
 
-    def _has_node(self, node_id):
-        return node_id in self.network
+    def _has_node(self, node_key):
+        return node_key in self.network
 
-    def _add_node(self, node):
-        self.network.add_node(node.id, data=node)
+    def _add_node(self, node_key, node):
+        self.network.add_node(node_key, data=node)
 
-    def _add_edge(self, source_id, target_id, key, **data):
-        assert source_id in self.network
-        assert target_id in self.network
-        self.network.add_edge(source_id, target_id, key=key, **data)
+    def _add_edge(self, source_key, target_key, key, **data):
+        assert source_key in self.network
+        assert target_key in self.network
+        self.network.add_edge(source_key, target_key, key=key, **data)
 
-    def _remove_node(self, node_id):
+    def _remove_node(self, node_key):
         """Deletes node and all adjacent edges"""
-        self.network.remove_node(node_id)
+        self.network.remove_node(node_key)
 
     def _iter_edges(self, **flags):
         if flags:
-            subgraph = self.network.subgraph([n.id for n in self._iter_edges(**flags)])
+            node_keys = self._flag_index.find(**flags)
+            if node_keys is None:
+                lookup = self._ids.lookup
+                node_keys = [lookup(n.id) for n in self._iter_nodes(**flags)]
+            subgraph = self.network.subgraph(node_keys)
         else:
             subgraph = self.network
         yield from subgraph.edges(data=True, keys=True)
 
     def _iter_nodes(self, **flags):
-        for node_id, data in self.network.nodes(data=True):
-            node = data["data"]
-            if node.has_flags(**flags):
-                yield node
+        node_keys = self._flag_index.find(**flags) if flags else None
+        if node_keys is None:
+            for node_key, data in self.network.nodes(data=True):
+                node = data["data"]
+                if node.has_flags(**flags):
+                    yield node
+        else:
+            nodes = self.network.nodes
+            for node_key in node_keys:
+                yield nodes[node_key]["data"]
 
     def _get_n_nodes(self):
         return self.network.number_of_nodes()
@@ -47,8 +65,8 @@ class NetworkxEntityGraph(GraphBackend, EntityGraph):
     def _get_n_edges(self):
         return self.network.number_of_edges()
 
-    def _get_node(self, node_id):
-        return self.network.nodes[node_id]["data"]
+    def _get_node(self, node_key):
+        return self.network.nodes[node_key]["data"]
 
-    def _get_node_edges(self, node_id):
-        return self.network.edges(node_id, data=True, keys=True)
+    def _get_node_edges(self, node_key):
+        return self.network.edges(node_key, data=True, keys=True)
@@ -0,0 +1,642 @@
+import os
+import json
+import sqlite3
+import tempfile
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+
+from followthemoney import model
+
+from .graph_backend import GraphBackend
+from followthemoney_graph.entity_graph import EntityGraph
+from followthemoney_graph.node import Node
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ids (
+    key INTEGER PRIMARY KEY AUTOINCREMENT,
+    value TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    key INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS proxies (
+    key INTEGER PRIMARY KEY,
+    parent INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sets (
+    root INTEGER PRIMARY KEY,
+    label INTEGER NOT NULL UNIQUE,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stubs (
+    key INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS flags (
+    node INTEGER NOT NULL,
+    flag TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (node, flag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS flags_value ON flags (flag, value, node);
+CREATE TABLE IF NOT EXISTS unindexed_flags (
+    flag TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS edges (
+    lo INTEGER NOT NULL,
+    hi INTEGER NOT NULL,
+    key INTEGER NOT NULL,
+    source INTEGER NOT NULL,
+    target INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (lo, hi, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS edges_hi ON edges (hi);
+"""
+PAGE_SIZE = 1000
+
+
+def _close(conn, path):
+    conn.close()
+    if path is not None:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.unlink(path + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def _normalise(value):
+    if isinstance(value, bool) or (isinstance(value, float) and value.is_integer()):
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalise(v) for v in value]
+    return value
+
+
+def _flag_value(value):
+    """Dumps values equal in Python (`True == 1 == 1.0`) to the same string"""
+    return _dumps(_normalise(value))
+
+
+class LRU(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+            return self._data[key]
+        except KeyError:
+            return default
+
+    def put(self, key, value):
+        """Store value and return the (key, value) pairs that were evicted"""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        evicted = []
+        while len(self._data) > self.maxsize:
+            evicted.append(self._data.popitem(last=False))
+        return evicted
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def items(self):
+        return list(self._data.items())
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class SQLiteInterner(object):
+    def __init__(self, conn, cache_size):
+        self.conn = conn
+        self._keys = LRU(cache_size)
+        self._values = LRU(cache_size)
+
+    def intern(self, value):
+        key = self.lookup(value)
+        if key is None:
+            key = self.conn.execute(
+                "INSERT INTO ids (value) VALUES (?)", (value,)
+            ).lastrowid
+            self._keys.put(value, key)
+        return key
+
+    def lookup(self, value, default=None):
+        key = self._keys.get(value)
+        if key is None:
+            row = self.conn.execute(
+                "SELECT key FROM ids WHERE value = ?", (value,)
+            ).fetchone()
+            if row is None:
+                return default
+            key = row[0]
+            self._keys.put(value, key)
+        return key
+
+    def release(self, value):
+        key = self.lookup(value)
+        if key is not None:
+            self._keys.pop(value)
+            self._values.pop(key)
+            self.conn.execute("DELETE FROM ids WHERE key = ?", (key,))
+
+    def values(self):
+        for (value,) in _paginate(self.conn, "ids", "key", "value"):
+            yield value
+
+    def __getitem__(self, key):
+        value = self._values.get(key)
+        if value is None:
+            row = self.conn.execute(
+                "SELECT value FROM ids WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                raise IndexError(key)
+            value = row[0]
+            self._values.put(key, value)
+        return value
+
+    def __contains__(self, value):
+        return self.lookup(value) is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM ids").fetchone()[0]
+
+
+class SQLiteDisjointSet(object):
+    """Same interface and union-find semantics as `DisjointSet`, kept on disk"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _parent(self, item):
+        row = self.conn.execute(
+            "SELECT parent FROM proxies WHERE key = ?", (item,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(item)
+        return row[0]
+
+    def _set(self, label):
+        return self.conn.execute(
+            "SELECT root, size FROM sets WHERE label = ?", (label,)
+        ).fetchone()
+
+    def find(self, item):
+        path = []
+        root = self._parent(item)
+        while root != item:
+            path.append(item)
+            item, root = root, self._parent(root)
+        if len(path) > 1:
+            self.conn.executemany(
+                "UPDATE proxies SET parent = ? WHERE key = ?",
+                [(root, p) for p in path[:-1]],
+            )
+        return root
+
+    def add(self, item, label):
+        if item in self:
+            if self[item] != label:
+                raise ValueError(f"Item already belongs to another set: {item}")
+            return
+        row = self._set(label)
+        if row is None:
+            self.conn.execute(
+                "INSERT INTO proxies (key, parent) VALUES (?, ?)", (item, item)
+            )
+            self.conn.execute(
+                "INSERT INTO sets (root, label, size) VALUES (?, ?, 1)", (item, label)
+            )
+        else:
+            self.conn.execute(
+                "INSERT INTO proxies (key, parent) VALUES (?, ?)", (item, row[0])
+            )
+            self.conn.execute(
+                "UPDATE sets SET size = size + 1 WHERE root = ?", (row[0],)
+            )
+
+    def update(self, items):
+        for item, label in items.items():
+            self.add(item, label)
+
+    def union(self, label, *others):
+        target = self._set(label)
+        for other in others:
+            if other == label:
+                continue
+            source = self._set(other)
+            if source is None:
+                continue
+            if target is None:
+                self.conn.execute(
+                    "UPDATE sets SET label = ? WHERE root = ?", (label, source[0])
+                )
+                target = source
+                continue
+            (root, size), (other_root, other_size) = target, source
+            if size < other_size:
+                root, other_root = other_root, root
+            self.conn.execute("DELETE FROM sets WHERE root = ?", (other_root,))
+            self.conn.execute(
+                "UPDATE sets SET label = ?, size = ? WHERE root = ?",
+                (label, size + other_size, root),
+            )
+            self.conn.execute(
+                "UPDATE proxies SET parent = ? WHERE key = ?", (root, other_root)
+            )
+            target = (root, size + other_size)
+        return label
+
+    def remove(self, label, items):
+        row = self._set(label)
+        if row is None:
+            return
+        self.conn.execute("DELETE FROM sets WHERE root = ?", (row[0],))
+        self.conn.executemany(
+            "DELETE FROM proxies WHERE key = ?", [(item,) for item in items]
+        )
+
+    def has_label(self, label):
+        return self._set(label) is not None
+
+    def get(self, item, default=None):
+        if item not in self:
+            return default
+        return self[item]
+
+    def __getitem__(self, item):
+        root = self.find(item)
+        return self.conn.execute(
+            "SELECT label FROM sets WHERE root = ?", (root,)
+        ).fetchone()[0]
+
+    def __setitem__(self, item, label):
+        self.add(item, label)
+
+    def __contains__(self, item):
+        return (
+            self.conn.execute("SELECT 1 FROM proxies WHERE key = ?", (item,)).fetchone()
+            is not None
+        )
+
+    def __iter__(self):
+        for (key,) in _paginate(self.conn, "proxies", "key"):
+            yield key
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM proxies").fetchone()[0]
+
+
+class SQLiteKeySet(object):
+    def __init__(self, conn, table):
+        self.conn = conn
+        self.table = table
+
+    def add(self, key):
+        self.conn.execute(f"INSERT OR IGNORE INTO {self.table} (key) VALUES (?)", (key,))
+
+    def discard(self, key):
+        self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def difference_update(self, keys):
+        self.conn.executemany(
+            f"DELETE FROM {self.table} WHERE key = ?", [(k,) for k in keys]
+        )
+
+    def __contains__(self, key):
+        sql = f"SELECT 1 FROM {self.table} WHERE key = ?"
+        return self.conn.execute(sql, (key,)).fetchone() is not None
+
+    def __iter__(self):
+        for (key,) in _paginate(self.conn, self.table, "key"):
+            yield key
+
+    def __len__(self):
+        return self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class SQLiteFlagIndex(object):
+    """
+    Same interface as `FlagIndex`, answered from the `flags` table. Unset and
+    None-valued flags have no row, which is what queries for `None` look for.
+    As with `FlagIndex`, flags that ever carry an unhashable value are
+    answered by scanning instead.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _check_hashable(self, flag, value):
+        try:
+            hash(value)
+        except TypeError:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO unindexed_flags (flag) VALUES (?)", (flag,)
+            )
+
+    def add(self, node_key, node):
+        for flag, value in node.flags.items():
+            self._check_hashable(flag, value)
+        rows = [
+            (node_key, flag, _flag_value(value))
+            for flag, value in node.flags.items()
+            if value is not None
+        ]
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO flags (node, flag, value) VALUES (?, ?, ?)", rows
+        )
+
+    def remove(self, node_key, node):
+        self.conn.execute("DELETE FROM flags WHERE node = ?", (node_key,))
+
+    def update(self, node_key, flag, old, new):
+        self._check_hashable(flag, new)
+        if new is None:
+            self.conn.execute(
+                "DELETE FROM flags WHERE node = ? AND flag = ?", (node_key, flag)
+            )
+        else:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO flags (node, flag, value) VALUES (?, ?, ?)",
+                (node_key, flag, _flag_value(new)),
+            )
+
+    def find(self, **flags):
+        if not flags:
+            return None
+        unindexed = self.conn.execute(
+            "SELECT 1 FROM unindexed_flags WHERE flag IN (%s)"
+            % ", ".join("?" * len(flags)),
+            list(flags),
+        ).fetchone()
+        if unindexed is not None:
+            return None
+        clauses, params = [], []
+        for flag, value in flags.items():
+            if value is None:
+                clauses.append("key NOT IN (SELECT node FROM flags WHERE flag = ?)")
+                params.append(flag)
+                continue
+            try:
+                value = _flag_value(value)
+            except TypeError:
+                return None
+            clauses.append(
+                "key IN (SELECT node FROM flags WHERE flag = ? AND value = ?)"
+            )
+            params.extend((flag, value))
+        sql = "SELECT key FROM nodes WHERE " + " AND ".join(clauses)
+        return [key for (key,) in self.conn.execute(sql, params)]
+
+
+def _paginate(conn, table, key, *columns):
+    """Yields rows of `columns` (or of `key` alone) in key order, page by page"""
+    select = ", ".join((key,) + columns)
+    sql = f"SELECT {select} FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?"
+    last = -1
+    while True:
+        rows = conn.execute(sql, (last, PAGE_SIZE)).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row[1:] if columns else row
+        last = rows[-1][0]
+
+
+class SQLiteEntityGraph(GraphBackend, EntityGraph):
+    """
+    Graph backend kept in a local SQLite file so graphs can grow past the
+    available memory. Proxy ids, canonical node mapping, stubs, flags, nodes
+    and edges all live in indexed tables; only the most recently used `Node`
+    objects are kept in memory and they are written back when evicted or on
+    `flush()`. Nodes changed in place are put back into the cache, and a
+    node still referenced elsewhere is handed out again rather than re-read,
+    so changes to evicted nodes aren't lost. Writes are batched into transactions of `COMMIT_INTERVAL`
+    statements. Opening an existing file picks the graph back up.
+    """
+
+    CACHE_SIZE = 100_000
+    COMMIT_INTERVAL = 10_000
+
+    def __init__(self, path=None, cache_size=None):
+        super().__init__()
+        cleanup_path = None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="ftm-graph-", suffix=".sqlite")
+            os.close(fd)
+            cleanup_path = path
+        self.path = path
+        # The graph isn't shared between threads, but it may be garbage
+        # collected, and its connection closed, in another one
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._finalizer = weakref.finalize(self, _close, self.conn, cleanup_path)
+        cache_size = cache_size or self.CACHE_SIZE
+        self._cache = LRU(cache_size)
+        self._live = weakref.WeakValueDictionary()
+        self._n_writes = 0
+        self._temp_tables = count()
+        self._ids = SQLiteInterner(self.conn, cache_size)
+        self._id_to_canonical = SQLiteDisjointSet(self.conn)
+        self._stub_proxies = SQLiteKeySet(self.conn, "stubs")
+        self._flag_index = SQLiteFlagIndex(self.conn)
+
+    @contextmanager
+    def bulk(self):
+        with super().bulk():
+            yield self
+        if self._bulk_pending is None:
+            self.flush()
+
+    def flush(self):
+        for node_key, node in self._cache.items():
+            self._write_node(node_key, node)
+        self.conn.commit()
+        self._n_writes = 0
+
+    def close(self):
+        self.flush()
+        self._finalizer()
+
+    def _has_node(self, node_key):
+        if node_key in self._cache:
+            return True
+        row = self.conn.execute("SELECT 1 FROM nodes WHERE key = ?", (node_key,))
+        return row.fetchone() is not None
+
+    def _add_node(self, node_key, node):
+        self._write_node(node_key, node)
+        self._cache_node(node_key, node)
+
+    def _add_edge(self, source_key, target_key, key, **data):
+        assert self._has_node(source_key)
+        assert self._has_node(target_key)
+        lo, hi = sorted((source_key, target_key))
+        self.conn.execute(
+            "INSERT INTO edges (lo, hi, key, source, target, data) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (lo, hi, key) DO UPDATE SET data = excluded.data",
+            (lo, hi, key, source_key, target_key, _dumps(data)),
+        )
+        self._wrote()
+
+    def _add_edges(self, sources, targets, keys, data_ids, data_values):
+        data_values = [_dumps(d) for d in data_values]
+        rows = (
+            (min(s, t), max(s, t), k, s, t, data_values[d])
+            for s, t, k, d in zip(
+                sources.tolist(), targets.tolist(), keys.tolist(), data_ids.tolist()
+            )
+        )
+        self.conn.executemany(
+            "INSERT INTO edges (lo, hi, key, source, target, data) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (lo, hi, key) DO UPDATE SET data = excluded.data",
+            rows,
+        )
+        self._wrote()
+
+    def _remove_node(self, node_key):
+        """Deletes node and all adjacent edges"""
+        self._cache.pop(node_key)
+        self._live.pop(node_key, None)
+        self.conn.execute("DELETE FROM nodes WHERE key = ?", (node_key,))
+        self.conn.execute("DELETE FROM flags WHERE node = ?", (node_key,))
+        self.conn.execute(
+            "DELETE FROM edges WHERE lo = ? OR hi = ?", (node_key, node_key)
+        )
+        self._wrote()
+
+    def _iter_edges(self, **flags):
+        if not flags:
+            yield from self._iter_edge_rows("edges")
+            return
+        node_keys = self._flag_index.find(**flags)
+        if node_keys is None:
+            lookup = self._ids.lookup
+            node_keys = [lookup(n.id) for n in self._iter_nodes(**flags)]
+        table = f"selected_{next(self._temp_tables)}"
+        self.conn.execute(f"CREATE TEMP TABLE {table} (key INTEGER PRIMARY KEY)")
+        try:
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO {table} (key) VALUES (?)",
+                [(k,) for k in node_keys],
+            )
+            yield from self._iter_edge_rows(
+                f"edges JOIN {table} a ON edges.lo = a.key "
+                f"JOIN {table} b ON edges.hi = b.key"
+            )
+        finally:
+            self.conn.execute(f"DROP TABLE temp.{table}")
+
+    def _iter_edge_rows(self, source):
+        sql = (
+            f"SELECT lo, hi, edges.key, source, target, data FROM {source} "
+            "WHERE (lo, hi, edges.key) > (?, ?, ?) "
+            "ORDER BY lo, hi, edges.key LIMIT ?"
+        )
+        last = (-1, -1, -1)
+        while True:
+            rows = self.conn.execute(sql, (*last, PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+            for lo, hi, key, source_key, target_key, data in rows:
+                yield source_key, target_key, key, json.loads(data)
+            last = rows[-1][:3]
+
+    def _iter_nodes(self, **flags):
+        node_keys = self._flag_index.find(**flags) if flags else None
+        if node_keys is None:
+            for (node_key,) in _paginate(self.conn, "nodes", "key"):
+                node = self._get_node(node_key)
+                if node.has_flags(**flags):
+                    yield node
+        else:
+            for node_key in node_keys:
+                yield self._get_node(node_key)
+
+    def _get_n_nodes(self):
+        return self.conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def _get_n_edges(self):
+        return self.conn.execute("SELECT COUNT(*) FROM edges").fetchone()[0]
+
+    def _get_node(self, node_key):
+        node = self._cache.get(node_key)
+        if node is not None:
+            return node
+        node = self._live.get(node_key)
+        if node is None:
+            row = self.conn.execute(
+                "SELECT data FROM nodes WHERE key = ?", (node_key,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(node_key)
+            node = self._read_node(row[0])
+        self._cache_node(node_key, node)
+        return node
+
+    def _get_node_edges(self, node_key):
+        rows = self.conn.execute(
+            "SELECT source, target, key, data FROM edges WHERE lo = ? "
+            "UNION ALL "
+            "SELECT source, target, key, data FROM edges WHERE hi = ? AND lo != ?",
+            (node_key, node_key, node_key),
+        ).fetchall()
+        edges = []
+        for source_key, target_key, key, data in rows:
+            if source_key != node_key:
+                source_key, target_key = target_key, source_key
+            edges.append((source_key, target_key, key, json.loads(data)))
+        return edges
+
+    def _node_flag_changed(self, node, flag, old, new):
+        super()._node_flag_changed(node, flag, old, new)
+        self._cache_node(self._ids.lookup(node.id), node)
+
+    def _node_changed(self, node_key, node):
+        self._cache_node(node_key, node)
+
+    def _cache_node(self, node_key, node):
+        self._live[node_key] = node
+        for evicted_key, evicted in self._cache.put(node_key, node):
+            self._write_node(evicted_key, evicted)
+
+    def _write_node(self, node_key, node):
+        data = {
+            "id": node.id,
+            "flags": node.flags,
+            "proxies": [p.to_dict() for p in node.proxies],
+        }
+        self.conn.execute(
+            "INSERT OR REPLACE INTO nodes (key, data) VALUES (?, ?)",
+            (node_key, json.dumps(data)),
+        )
+        self._wrote()
+
+    def _read_node(self, data):
+        data = json.loads(data)
+        proxies = [model.get_proxy(p) for p in data["proxies"]]
+        node = Node(id=data["id"], proxies=proxies, flags=data["flags"])
+        node._flag_listener = self
+        return node
+
+    def _wrote(self):
+        self._n_writes += 1
+        if self._n_writes >= self.COMMIT_INTERVAL:
+            self.conn.commit()
+            self._n_writes = 0
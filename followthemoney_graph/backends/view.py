@@ -0,0 +1,176 @@
+from followthemoney import model
+
+from .graph_backend import GraphBackend
+from followthemoney_graph.entity_graph import EntityGraph
+from followthemoney_graph.node import Node
+
+
+class EntityGraphView(GraphBackend, EntityGraph):
+    """
+    Read-only subgraph of `parent` made of the nodes whose keys are in
+    `node_keys` and the edges between them. The view keeps nothing but the
+    set of keys: nodes, ids, the canonical mapping and the flag index are
+    the parent's, so flags set through a view land on the parent's nodes.
+    Views of views are views of the same parent. Adding, merging or
+    removing nodes isn't supported; `materialize` makes a separate graph.
+
+    Nodes merged or removed in the parent afterwards are followed through
+    one proxy key per node: the view then holds the nodes these proxies
+    belong to now. The edge count is cached until the parent changes.
+    """
+
+    def __init__(self, parent, node_keys):
+        node_keys = set(node_keys)
+        if isinstance(parent, EntityGraphView):
+            node_keys.intersection_update(parent._keys)
+            parent = parent.parent
+        self.parent = parent
+        canonical = parent._id_to_canonical
+        lookup = parent._ids.lookup
+        self._parts = [
+            k if k in canonical else lookup(parent._get_node(k).parts[0])
+            for k in node_keys
+        ]
+        self._node_keys = node_keys
+        self._seen_generation = parent._generation
+        self._n_edges = None
+
+    def _refresh(self):
+        if self._seen_generation != self.parent._generation:
+            canonical = self._id_to_canonical
+            self._node_keys = {canonical[p] for p in self._parts if p in canonical}
+            self._seen_generation = self.parent._generation
+            self._n_edges = None
+
+    @property
+    def _keys(self):
+        self._refresh()
+        return self._node_keys
+
+    @property
+    def _generation(self):
+        return self.parent._generation
+
+    @property
+    def _ids(self):
+        return self.parent._ids
+
+    @property
+    def _id_to_canonical(self):
+        return self.parent._id_to_canonical
+
+    @property
+    def _flag_index(self):
+        return self.parent._flag_index
+
+    @property
+    def _merged_nodes(self):
+        return self.parent._merged_nodes
+
+    @property
+    def _bulk_pending(self):
+        return self.parent._bulk_pending
+
+    @property
+    def _journal(self):
+        return self.parent._journal
+
+    @property
+    def _stub_proxies(self):
+        stubs = self.parent._stub_proxies
+        keys = self._keys
+        if len(stubs) < len(keys):
+            canonical = self._id_to_canonical
+            return {k for k in stubs if canonical[k] in keys}
+        lookup = self._ids.lookup
+        get_node = self.parent._get_node
+        part_keys = (lookup(pid) for k in keys for pid in get_node(k).parts)
+        return {k for k in part_keys if k in stubs}
+
+    def materialize(self, cls=None, **kwargs):
+        """
+        Copies the view into a new graph of the parent's backend, or of `cls`,
+        with its own nodes and proxies. Keyword arguments go to the backend's
+        constructor.
+        """
+        G = (cls or type(self.parent))(**kwargs)
+        stubs = self.parent._stub_proxies
+        lookup = self._ids.lookup
+        intern = G._ids.intern
+        with G.bulk():
+            for node in self.nodes():
+                proxies = [model.get_proxy(p.to_dict()) for p in node.proxies]
+                copy = Node(id=node.id, proxies=proxies, flags=dict(node.flags))
+                G._attach_parts(G._attach_node(copy), copy)
+                for pid in copy.parts:
+                    if lookup(pid) in stubs:
+                        G._stub_proxies.add(intern(pid))
+            for source, target, key, data in self.edges():
+                G._add_edge(intern(source), intern(target), key=intern(key), **data)
+        return G
+
+    def _read_only(self, *args, **kwargs):
+        raise NotImplementedError("Graph views are read-only, see materialize()")
+
+    add_proxy = add_stub = remove_node = merge_nodes = bulk = _read_only
+    checkpoint = _read_only
+
+    def _has_node(self, node_key):
+        return node_key in self._keys
+
+    def _iter_edges(self, **flags):
+        keys = self._keys
+        node_keys = keys
+        if flags:
+            node_keys = [self._ids.lookup(n.id) for n in self._iter_nodes(**flags)]
+            keys = set(node_keys)
+        for node_key in node_keys:
+            for edge in self.parent._get_node_edges(node_key):
+                if edge[1] in keys and edge[0] <= edge[1]:
+                    yield edge
+
+    def _iter_nodes(self, **flags):
+        get_node = self.parent._get_node
+        node_keys = self._flag_index.find(**flags) if flags else None
+        if node_keys is None:
+            for node_key in self._keys:
+                node = get_node(node_key)
+                if node.has_flags(**flags):
+                    yield node
+        else:
+            for node_key in node_keys:
+                if node_key in self._keys:
+                    yield get_node(node_key)
+
+    def _get_n_nodes(self):
+        return len(self._keys)
+
+    def _get_n_edges(self):
+        self._refresh()
+        if self._n_edges is None:
+            self._n_edges = sum(1 for _ in self._iter_edges())
+        return self._n_edges
+
+    def _get_node(self, node_key):
+        if node_key not in self._keys:
+            raise KeyError(node_key)
+        return self.parent._get_node(node_key)
+
+    def _get_node_edges(self, node_key):
+        return [
+            edge
+            for edge in self.parent._get_node_edges(node_key)
+            if edge[1] in self._keys
+        ]
+
+    def __contains__(self, proxy_id):
+        proxy_key = self._ids.lookup(proxy_id)
+        canonical = self._id_to_canonical
+        return (
+            proxy_key is not None
+            and proxy_key in canonical
+            and canonical[proxy_key] in self._keys
+        )
+
+    def __len__(self):
+        return sum(len(node.parts) for node in self.nodes())
@@ -1,5 +1,9 @@
 import os
 import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
 from redis import Redis
 from normality import stringify
 
@@ -11,23 +15,36 @@ class Cache(object):
     def has(self, key):
         return self.get(key) is not None
 
-    def store(self, key, value):
+    def store(self, key, value, ttl=None):
         pass
 
+    def get_many(self, keys):
+        """Returns a `{key: value}` dict of the keys that are cached"""
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def store_many(self, items, ttl=None):
+        for key, value in items.items():
+            self.store(key, value, ttl=ttl)
+
 
 class RedisCache(Cache):
     EXPIRE = 84600 * 90
     URL = os.environ.get("ENRICH_REDIS_URL")
 
-    def __init__(self):
-        self.redis = Redis.from_url(self.URL)
+    def __init__(self, redis=None):
+        self.redis = redis or Redis.from_url(self.URL)
 
     def _prefix_key(self, key):
         return "ftm:enrich:%s" % stringify(key)
 
-    def store(self, key, value):
+    def store(self, key, value, ttl=None):
         key = self._prefix_key(key)
-        self.redis.set(key, json.dumps(value), ex=self.EXPIRE)
+        self.redis.set(key, json.dumps(value), ex=ttl or self.EXPIRE)
 
     def get(self, key):
         value = self.redis.get(self._prefix_key(key))
@@ -37,3 +54,244 @@ class RedisCache(Cache):
     def has(self, key):
         key = self._prefix_key(key)
         return self.redis.exists(key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.redis.mget([self._prefix_key(k) for k in keys])
+        return {k: json.loads(v) for k, v in zip(keys, values) if v is not None}
+
+    def store_many(self, items, ttl=None):
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.setex(self._prefix_key(key), ttl or self.EXPIRE, json.dumps(value))
+        pipe.execute()
+
+
+class LRUCache(Cache):
+    """
+    In-process cache holding at most `max_size` bytes of JSON-encoded values
+    and dropping the least recently used ones past that. Values are stored
+    encoded so cached results can't be mutated by the caller. Entries don't
+    expire; the tier behind it decides how long a value lives.
+    """
+
+    MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.MAX_SIZE
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                return None
+            self._data.move_to_end(key)
+        return json.loads(value)
+
+    def has(self, key):
+        return key in self._data
+
+    def store(self, key, value, ttl=None):
+        value = json.dumps(value)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._data[key] = value
+            self.size += len(value)
+            while self.size > self.max_size and self._data:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache(Cache):
+    """
+    Looks keys up tier by tier, fastest first, and copies values found in a
+    slower tier into the faster ones. Stores go to every tier.
+    """
+
+    def __init__(self, *tiers):
+        self.tiers = tiers
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for upper in self.tiers[:i]:
+                    upper.store(key, value)
+                return value
+        return None
+
+    def has(self, key):
+        return any(tier.has(key) for tier in self.tiers)
+
+    def store(self, key, value, ttl=None):
+        for tier in self.tiers:
+            tier.store(key, value, ttl=ttl)
+
+    def get_many(self, keys):
+        missing = list(keys)
+        values = {}
+        for i, tier in enumerate(self.tiers):
+            if not missing:
+                break
+            found = tier.get_many(missing)
+            if found:
+                for upper in self.tiers[:i]:
+                    upper.store_many(found)
+                values.update(found)
+                missing = [k for k in missing if k not in found]
+        return values
+
+    def store_many(self, items, ttl=None):
+        for tier in self.tiers:
+            tier.store_many(items, ttl=ttl)
+
+
+class SQLiteCache(Cache):
+    """
+    Persistent cache in a local SQLite file. Entries expire after their TTL
+    and once the stored values grow past `max_size` bytes the least recently
+    used ones are evicted. Every thread gets its own connection and the file
+    is in WAL mode, so one cache file can be shared by threads and processes.
+    """
+
+    TTL = 86400 * 7
+    MAX_SIZE = 1024 ** 3
+    EVICT_INTERVAL = 1000
+    BATCH_SIZE = 500
+    TOUCH_INTERVAL = 60
+    PATH = os.environ.get(
+        "FTM_GRAPH_CACHE_PATH",
+        os.path.join(os.path.expanduser("~"), ".cache", "followthemoney-graph.sqlite"),
+    )
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cache (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        expires REAL NOT NULL,
+        accessed REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+    """
+
+    def __init__(self, path=None, ttl=None, max_size=None):
+        self.path = path or self.PATH
+        self.ttl = ttl or self.TTL
+        self.max_size = max_size or self.MAX_SIZE
+        self._local = threading.local()
+        self._n_stores = 0
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.executescript(self.SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT value, accessed FROM cache WHERE key = ? AND expires > ?",
+            (key, now),
+        ).fetchone()
+        if row is None:
+            return None
+        value, accessed = row
+        if now - accessed > self.TOUCH_INTERVAL:
+            self.conn.execute(
+                "UPDATE cache SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(value)
+
+    def has(self, key):
+        row = self.conn.execute(
+            "SELECT 1 FROM cache WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def store(self, key, value, ttl=None):
+        now = time.time()
+        value = json.dumps(value)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, size, expires, accessed) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now + (ttl or self.ttl), now),
+        )
+        self._n_stores += 1
+        if self._n_stores >= self.EVICT_INTERVAL:
+            self._n_stores = 0
+            self.evict()
+
+    def get_many(self, keys):
+        keys = list(keys)
+        values = {}
+        now = time.time()
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[i : i + self.BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            rows = self.conn.execute(
+                f"SELECT key, value FROM cache WHERE key IN ({placeholders}) "
+                "AND expires > ?",
+                (*batch, now),
+            )
+            values.update((key, json.loads(value)) for key, value in rows)
+        return values
+
+    def store_many(self, items, ttl=None):
+        now = time.time()
+        expires = now + (ttl or self.ttl)
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value), expires, now))
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, size, expires, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        self._n_stores += len(rows)
+        if self._n_stores >= self.EVICT_INTERVAL:
+            self._n_stores = 0
+            self.evict()
+
+    def evict(self):
+        """Drops expired entries, then the least recently used over `max_size`"""
+        conn = self.conn
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "  SELECT key FROM ("
+            "    SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total"
+            "    FROM cache"
+            "  ) WHERE total > ?"
+            ")",
+            (self.max_size,),
+        )
+
+
+def make_cache():
+    """
+    Cache for the enrichment commands: an in-process LRU tier in front of
+    Redis when `ENRICH_REDIS_URL` is set, or the local SQLite cache otherwise.
+    """
+    remote = RedisCache() if RedisCache.URL else SQLiteCache()
+    return TieredCache(LRUCache(), remote)
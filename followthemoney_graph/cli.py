@@ -1,48 +1,274 @@
 import click
+import json
 import logging
+import resource
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
 
 from followthemoney.cli.cli import cli
 from followthemoney.cli.util import read_entities, write_object
-from followthemoney_enrich import get_enricher, enricher_cache
+
+from followthemoney_graph.backends.csr import CSREntityGraph
+from followthemoney_graph.backends.networkx import NetworkxEntityGraph
+from followthemoney_graph.backends.sqlite import SQLiteEntityGraph
+from followthemoney_graph.cache import make_cache
+from followthemoney_graph.lib import bounded_map
+from followthemoney_graph.operations import export, snapshot
+from followthemoney_graph.operations.graph import connected_components
 
 log = logging.getLogger(__name__)
-ENRICHERS = {}
+# Enrichers keep clients and caches that aren't thread-safe: one per thread
+ENRICHERS = threading.local()
+BACKENDS = {
+    "networkx": NetworkxEntityGraph,
+    "csr": CSREntityGraph,
+    "sqlite": SQLiteEntityGraph,
+}
 
 
 def load_enricher(name):
-    if name not in ENRICHERS:
+    from followthemoney_enrich import get_enricher
+
+    enrichers = vars(ENRICHERS)
+    if name not in enrichers:
         clazz = get_enricher(name)
         if clazz is None:
             raise click.BadParameter("Unknown enricher: %s" % name)
         enricher = clazz()
-        enricher.cache = enricher_cache()
-        ENRICHERS[name] = enricher
-    return ENRICHERS[name]
+        enricher.cache = make_cache()
+        enrichers[name] = enricher
+    return enrichers[name]
+
+
+def _enricher_task(name, method):
+    """Calls `method` of the enricher `name` instance of the calling thread"""
+
+    def task(entity):
+        return getattr(load_enricher(name), method)(entity)
+
+    return task
+
+
+def _batches(entities, batch_size):
+    entities = iter(entities)
+    while True:
+        batch = list(islice(entities, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _run_batch(process, batch):
+    return [result for entity in batch for result in process(entity)]
+
+
+def process_entities(infile, outfile, process, workers=1, batch_size=1, ordered=True):
+    """
+    Writes the results of `process` for every entity in `infile`. With more
+    than one worker, batches of `batch_size` entities are processed
+    concurrently with a bounded number of batches in flight, and results
+    are written as soon as their batch is done, in input order if `ordered`.
+    """
+    batches = _batches(read_entities(infile), batch_size)
+    task = partial(_run_batch, process)
+    if workers > 1:
+        results = bounded_map(task, batches, workers=workers, ordered=ordered)
+    else:
+        results = map(task, batches)
+    try:
+        for batch in results:
+            for result in batch:
+                write_object(outfile, result)
+    except BrokenPipeError:
+        raise click.Abort()
+
+
+def concurrency_options(func):
+    func = click.option(
+        "--ordered/--unordered",
+        default=True,
+        help="Keep the output in input order",
+    )(func)
+    func = click.option(
+        "--batch-size",
+        type=int,
+        default=1,
+        show_default=True,
+        help="Entities per worker task",
+    )(func)
+    func = click.option(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        show_default=True,
+        help="Number of entity batches to process concurrently",
+    )(func)
+    return func
 
 
 @cli.command("enrich", help="Find matching entities remotely")
 @click.option("-i", "--infile", type=click.File("r"), default="-")  # noqa
 @click.option("-o", "--outfile", type=click.File("w"), default="-")  # noqa
+@concurrency_options
 @click.argument("enricher")
-def enrich(infile, outfile, enricher):
-    enricher = load_enricher(enricher)
-    try:
-        for entity in read_entities(infile):
-            for match in enricher.enrich_entity_raw(entity):
-                write_object(outfile, match)
-    except BrokenPipeError:
-        raise click.Abort()
+def enrich(infile, outfile, workers, batch_size, ordered, enricher):
+    load_enricher(enricher)
+    task = _enricher_task(enricher, "enrich_entity_raw")
+    process_entities(infile, outfile, task, workers, batch_size, ordered)
 
 
 @cli.command("expand", help="Expand enriched entities")
 @click.option("-i", "--infile", type=click.File("r"), default="-")  # noqa
 @click.option("-o", "--outfile", type=click.File("w"), default="-")  # noqa
+@concurrency_options
 @click.argument("enricher")
-def expand(infile, outfile, enricher):
-    enricher = load_enricher(enricher)
+def expand(infile, outfile, workers, batch_size, ordered, enricher):
+    load_enricher(enricher)
+    task = _enricher_task(enricher, "expand_entity")
+    process_entities(infile, outfile, task, workers, batch_size, ordered)
+
+
+@cli.group("graph", help="Build and analyse entity graphs")
+def graph():
+    pass
+
+
+@contextmanager
+def report(stage):
+    """Logs the time taken by `stage` and the peak memory use so far"""
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    log.info(f"{stage}: {elapsed:.1f}s, max RSS {max_rss:.0f} MiB")
+
+
+def _is_snapshot(path):
+    if path == "-":
+        return False
+    with open(path, "rb") as fd:
+        return fd.read(len(snapshot.MAGIC)) == snapshot.MAGIC
+
+
+def load_graph(paths, backend="networkx", db=None):
+    """
+    Streams the FtM entities in `paths` ("-" for stdin) into a new graph of
+    the given backend. A single input may also be a graph snapshot.
+    """
+    kwargs = {"path": db} if backend == "sqlite" else {}
+    cls = BACKENDS[backend]
+    paths = paths or ("-",)
+    if len(paths) == 1 and _is_snapshot(paths[0]):
+        with report(f"Loaded snapshot {paths[0]}"), open(paths[0], "rb") as fd:
+            return cls.from_snapshot(fd, **kwargs)
+    G = cls(**kwargs)
+    with report("Built graph"), G.bulk():
+        for path in paths:
+            with click.open_file(path, "r") as fd:
+                for proxy in read_entities(fd):
+                    G.add_proxy(proxy)
+    log.info(repr(G))
+    return G
+
+
+def graph_options(func):
+    func = click.option(
+        "--db", help="SQLite file to keep the graph in (sqlite backend)"
+    )(func)
+    func = click.option(
+        "-b",
+        "--backend",
+        type=click.Choice(sorted(BACKENDS)),
+        default="networkx",
+        show_default=True,
+    )(func)
+    func = click.option(
+        "-i",
+        "--infile",
+        "infiles",
+        multiple=True,
+        type=click.Path(allow_dash=True),
+        help="FtM entities or a graph snapshot (default: stdin)",
+    )(func)
+    return func
+
+
+@graph.command("build", help="Build a graph and write it as a snapshot")
+@graph_options
+@click.option("-o", "--outfile", type=click.File("wb"), required=True)
+def graph_build(infiles, backend, db, outfile):
+    G = load_graph(infiles, backend=backend, db=db)
+    with report(f"Wrote snapshot {outfile.name}"):
+        G.to_snapshot(outfile)
+
+
+@graph.command("stats", help="Print graph statistics as JSON")
+@graph_options
+@click.option("-o", "--outfile", type=click.File("w"), default="-")  # noqa
+def graph_stats(infiles, backend, db, outfile):
+    G = load_graph(infiles, backend=backend, db=db)
+    with report("Computed statistics"):
+        schemata = Counter(node.schema.name for node in G.nodes())
+        sizes = [len(c) for c in connected_components(G)]
+    stats = {
+        "proxies": len(G),
+        "nodes": G.n_nodes,
+        "edges": G.n_edges,
+        "stubs": G.n_stubs,
+        "components": len(sizes),
+        "largest_component": max(sizes, default=0),
+        "schemata": dict(schemata.most_common()),
+    }
+    outfile.write(json.dumps(stats, indent=2))
+    outfile.write("\n")
+
+
+@graph.command("components", help="Write the node ids of each component")
+@graph_options
+@click.option("-o", "--outfile", type=click.File("w"), default="-")  # noqa
+@click.option("--min-size", type=int, default=1, show_default=True)
+@click.option("--max-size", type=int)
+def graph_components(infiles, backend, db, outfile, min_size, max_size):
+    G = load_graph(infiles, backend=backend, db=db)
+    with report("Computed components"):
+        components = connected_components(G)
+    components.sort(key=len, reverse=True)
     try:
-        for entity in read_entities(infile):
-            for expanded in enricher.expand_entity(entity):
-                write_object(outfile, expanded)
+        for component in components:
+            size = len(component)
+            if size < min_size or (max_size is not None and size > max_size):
+                continue
+            write_object(outfile, {"size": size, "nodes": component})
     except BrokenPipeError:
         raise click.Abort()
+
+
+@graph.command("export", help="Export a graph as GraphML, entities or a snapshot")
+@graph_options
+@click.option("-o", "--outfile", type=click.Path(allow_dash=True), required=True)
+@click.option(
+    "-f",
+    "--format",
+    "fmt",
+    type=click.Choice(["graphml", "entities", "snapshot"]),
+    default="graphml",
+    show_default=True,
+)
+@click.option("--slim", is_flag=True, help="Only basic node attributes in GraphML")
+def graph_export(infiles, backend, db, outfile, fmt, slim):
+    G = load_graph(infiles, backend=backend, db=db)
+    with report(f"Exported {fmt} to {outfile}"):
+        if fmt == "graphml":
+            with click.open_file(outfile, "wb") as fd:
+                export.export_graphml(G, fd, slim=slim)
+        elif fmt == "snapshot":
+            with click.open_file(outfile, "wb") as fd:
+                G.to_snapshot(fd)
+        else:
+            with click.open_file(outfile, "w") as fd:
+                G.to_file(fd)
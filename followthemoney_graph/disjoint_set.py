@@ -0,0 +1,102 @@
+class DisjointSet(object):
+    """
+    Union-find structure over proxy ids with path compression and union by
+    size. Every set carries a label (the id of the node the proxies belong
+    to) so that lookups behave like the `{proxy_id: node_id}` mapping it
+    replaces, while merging two sets no longer touches every member.
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._size = {}
+        self._label = {}
+        self._root = {}
+
+    def find(self, item):
+        parent = self._parent
+        root = item
+        while parent[root] != root:
+            root = parent[root]
+        while parent[item] != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    def add(self, item, label):
+        if item in self._parent:
+            if self[item] != label:
+                raise ValueError(f"Item already belongs to another set: {item}")
+            return
+        root = self._root.get(label)
+        if root is None:
+            self._parent[item] = item
+            self._size[item] = 1
+            self._label[item] = label
+            self._root[label] = item
+        else:
+            self._parent[item] = root
+            self._size[root] += 1
+
+    def update(self, items):
+        for item, label in items.items():
+            self.add(item, label)
+
+    def union(self, label, *others):
+        """
+        Merge the sets labeled `others` into the set labeled `label`. The
+        resulting set keeps `label` regardless of which root survives.
+        """
+        root = self._root.pop(label, None)
+        for other in others:
+            if other == label:
+                continue
+            other_root = self._root.pop(other, None)
+            if other_root is None:
+                continue
+            if root is None:
+                root = other_root
+                continue
+            if self._size[root] < self._size[other_root]:
+                root, other_root = other_root, root
+            self._parent[other_root] = root
+            self._size[root] += self._size.pop(other_root)
+            self._label.pop(other_root)
+        if root is not None:
+            self._label[root] = label
+            self._root[label] = root
+        return label
+
+    def remove(self, label, items):
+        """
+        Drop the set labeled `label`. `items` must contain every member of the
+        set since members are not tracked individually.
+        """
+        root = self._root.pop(label, None)
+        if root is None:
+            return
+        self._label.pop(root)
+        self._size.pop(root)
+        for item in items:
+            self._parent.pop(item, None)
+
+    def has_label(self, label):
+        return label in self._root
+
+    def get(self, item, default=None):
+        if item not in self._parent:
+            return default
+        return self[item]
+
+    def __getitem__(self, item):
+        return self._label[self.find(item)]
+
+    def __setitem__(self, item, label):
+        self.add(item, label)
+
+    def __contains__(self, item):
+        return item in self._parent
+
+    def __iter__(self):
+        return iter(self._parent)
+
+    def __len__(self):
+        return len(self._parent)
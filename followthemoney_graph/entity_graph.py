@@ -1,6 +1,6 @@
 import logging
-import json
 import os
+from contextlib import contextmanager
 from itertools import groupby
 
 from followthemoney import model
@@ -8,15 +8,35 @@ from followthemoney.exc import InvalidData
 from tqdm.autonotebook import tqdm
 
 from .node import Node
-from .operations import export
+from .disjoint_set import DisjointSet
+from .flag_index import FlagIndex
+from .interner import Interner
+from . import journal
+from . import loader
+from .operations import export, snapshot
 
 log = logging.getLogger(__name__)
 
 
 class EntityGraph(object):
+    """
+    Proxy and node ids are interned to keys when they enter the graph.
+    Everything behind the public methods (the canonical id mapping, stubs,
+    flag index and the backend's nodes and edges) works on these keys and
+    string ids are only translated back at the API boundary. Keys are dense
+    integers by default; backends may swap in their own interner.
+    """
+
     def __init__(self):
-        self._id_to_canonical = {}
+        self._ids = Interner()
+        self._id_to_canonical = DisjointSet()
         self._stub_proxies = set()
+        self._flag_index = FlagIndex()
+        self._merged_nodes = {}
+        self._bulk_pending = None
+        self._journal = None
+        # Bumped on every change to the nodes or edges, see EntityGraphView
+        self._generation = 0
 
     @classmethod
     def from_file(cls, fd):
@@ -25,12 +45,13 @@ class EntityGraph(object):
             total = os.fstat(fd.fileno()).st_size
         except AttributeError:
             total = None
-        with tqdm(total=total, unit="B", unit_scale=True, unit_divisor=1024) as pbar:
-            data = ((json.loads(line), len(line)) for line in fd)
-            data_group = groupby(data, lambda d: d[0].get("profile_id"))
+        with tqdm(
+            total=total, unit="B", unit_scale=True, unit_divisor=1024
+        ) as pbar, G.bulk():
+            data = loader.iter_records(fd)
+            data_group = groupby(data, lambda d: d[0])
             for node_id, group in data_group:
-                for proxy_dict, line_length in group:
-                    node_flags = proxy_dict.pop("flags", {})
+                for _, node_flags, proxy_dict, line_length in group:
                     proxy = model.get_proxy(proxy_dict)
                     try:
                         node, is_new = G.add_proxy(proxy, node_id=node_id)
@@ -51,40 +72,144 @@ class EntityGraph(object):
     def to_file(self, fd):
         return export.export_followthemoney_json(self, fd)
 
-    def edges(self, **flags):
-        yield from self._iter_edges(**flags)
+    @classmethod
+    def from_snapshot(cls, fd, **kwargs):
+        """
+        Loads a graph written by `to_snapshot` from the binary file `fd`.
+        Keyword arguments go to the backend's constructor.
+        """
+        return snapshot.read_snapshot(cls(**kwargs), fd)
+
+    def to_snapshot(self, fd):
+        return snapshot.write_snapshot(self, fd)
+
+    def edges(self, props=None, schematas=None, **flags):
+        """
+        Yields the edges between nodes matching `flags`. Edges can further be
+        limited to the given edge properties (`props`) or to edges whose
+        property is defined by one of `schematas`.
+        """
+        ids = self._ids
+        edges = self._iter_edges(**flags)
+        if props is None and schematas is None:
+            for source_key, target_key, key, data in edges:
+                yield ids[source_key], ids[target_key], ids[key], data
+            return
+        if isinstance(props, str):
+            props = [props]
+        if isinstance(schematas, str):
+            schematas = [schematas]
+        props = set(props) if props is not None else None
+        if schematas is not None:
+            schematas = [model.get(s) for s in schematas]
+        for source_key, target_key, key, data in edges:
+            if props is not None and data.get("prop") not in props:
+                continue
+            if schematas is not None:
+                schema = self._get_edge_schema(source_key, target_key, data)
+                if schema is None or not any(schema.is_a(s) for s in schematas):
+                    continue
+            yield ids[source_key], ids[target_key], ids[key], data
+
+    def get_edge_schema(self, source_id, target_id, data):
+        """Schema of the endpoint that defines the edge's property"""
+        return self._get_edge_schema(
+            self._node_key(source_id), self._node_key(target_id), data
+        )
+
+    def _get_edge_schema(self, source_key, target_key, data):
+        prop = data.get("prop")
+        for node_key in (source_key, target_key):
+            schema = self._get_node(node_key).schema
+            if prop in schema.properties:
+                return schema
+        return None
 
     def nodes(self, **flags):
-        yield from self._iter_nodes(**flags)
+        if self._merged_nodes:
+            merged, lookup = self._merged_nodes, self._ids.lookup
+            for node in self._iter_nodes(**flags):
+                if lookup(node.id) not in merged:
+                    yield node
+        else:
+            yield from self._iter_nodes(**flags)
 
-    def add_proxies(self, proxies):
+    def add_proxies(self, proxies, bulk=False):
+        if bulk:
+            with self.bulk():
+                return [self.add_proxy(p) for p in proxies]
         return [self.add_proxy(p) for p in proxies]
 
+    @contextmanager
+    def bulk(self):
+        """
+        Defer edge wiring for every proxy added inside the block until the
+        block exits. Edges are then connected once per touched node, so stubs
+        are only created for targets that are still missing at the end of the
+        batch. Edges of merged nodes are likewise relocated in a single
+        compaction step. Nested blocks join the outermost one.
+        """
+        if self._bulk_pending is not None:
+            yield self
+            return
+        self._bulk_pending = set()
+        try:
+            yield self
+        finally:
+            pending, self._bulk_pending = self._bulk_pending, None
+            self._compact_merged()
+            self._connect_pending(pending)
+
+    def _connect_pending(self, proxy_keys):
+        node_keys = set()
+        for proxy_key in proxy_keys:
+            if proxy_key in self._id_to_canonical:
+                node_keys.add(self._id_to_canonical[proxy_key])
+        for node_key in node_keys:
+            self.connect_edges(self._get_node(node_key))
+
+    def _schedule_connect(self, node, proxy_key):
+        if self._bulk_pending is not None:
+            self._bulk_pending.add(proxy_key)
+        else:
+            self.connect_edges(node)
+
     def add_proxy(self, proxy, node_id=None):
-        if proxy.id in self:
-            cur_node = self.get_node_by_proxy(proxy)
-            if proxy.id in self._stub_proxies:
+        self._generation += 1
+        proxy_key = self._ids.intern(proxy.id)
+        if proxy_key in self._id_to_canonical:
+            cur_key = self._id_to_canonical[proxy_key]
+            cur_node = self._get_node(cur_key)
+            if proxy_key in self._stub_proxies:
                 cur_node.fill_stub(proxy)
-                self._stub_proxies.discard(proxy.id)
-                self.connect_edges(cur_node)
-            if node_id is not None and cur_node.id != node_id:
-                if self._has_node(node_id):
-                    node = self.get_node(node_id)
-                else:
-                    node = Node(id=node_id, proxies=[proxy])
-                    self._add_node(node)
-                node = self.merge_nodes(node, cur_node)
-                return node, True
+                self._node_changed(cur_key, cur_node)
+                self._stub_proxies.discard(proxy_key)
+                if self._journal is not None:
+                    self._journal.append(journal.STUB_FILL, proxy_key)
+                self._schedule_connect(cur_node, proxy_key)
+            if node_id is not None:
+                node_key = self._resolve_node_key(self._ids.intern(node_id))
+                if node_key != cur_key:
+                    if self._has_node(node_key):
+                        node = self._get_node(node_key)
+                    else:
+                        node = Node(id=node_id, proxies=[proxy])
+                        self._attach_node(node)
+                    node = self.merge_nodes(node, cur_node)
+                    return node, True
             return cur_node, False
-        node_id = node_id or proxy.id
-        if self._has_node(node_id):
-            node = self._get_node(node_id)
+        node_key = self._resolve_node_key(self._ids.intern(node_id or proxy.id))
+        if self._has_node(node_key):
+            node = self._get_node(node_key)
             node.add_proxy(proxy)
+            self._node_changed(node_key, node)
         else:
-            node = Node(id=node_id, proxies=[proxy])
-            self._add_node(node)
-        self._id_to_canonical[proxy.id] = node.id
-        self.connect_edges(node)
+            node = Node(id=self._ids[node_key], proxies=[proxy])
+            self._attach_node(node)
+        self._id_to_canonical[proxy_key] = node_key
+        if self._journal is not None:
+            self._journal.append(journal.PROXY_ADD, proxy_key, node_key)
+        self._schedule_connect(node, proxy_key)
         return node, True
 
     def add_stub(self, proxy_id, schema="Thing"):
@@ -93,7 +218,10 @@ class EntityGraph(object):
         if proxy_id in self:
             return self.get_node_by_proxy(stub)
         node, _ = self.add_proxy(stub)
-        self._stub_proxies.add(stub.id)
+        stub_key = self._ids.lookup(stub.id)
+        self._stub_proxies.add(stub_key)
+        if self._journal is not None:
+            self._journal.append(journal.STUB_ADD, stub_key)
         return node
 
     def remove_nodes(self, nodes):
@@ -101,43 +229,204 @@ class EntityGraph(object):
             self.remove_node(node)
 
     def remove_node(self, node):
+        self._generation += 1
+        node_key = self._node_key(node.id)
+        part_keys = [self._ids.lookup(pid) for pid in node.parts]
+        self._id_to_canonical.remove(node_key, part_keys)
+        self._stub_proxies.difference_update(part_keys)
+        self._detach_node(node)
+        self._remove_merged_into(node_key)
+        self._remove_node(node_key)
+        if self._journal is not None:
+            self._journal.append(journal.NODE_REMOVE, node_key)
+        else:
+            # The journal refers to keys, so ids are only freed without one
+            for pid in {node.id, *node.parts}:
+                self._ids.release(pid)
+
+    def _remove_merged_into(self, node_key):
+        """
+        Drops the nodes merged into `node_key` that are still waiting for
+        compaction, along with their edges, so none get moved onto it.
+        """
+        if not self._merged_nodes:
+            return
+        resolve = self._resolve_node_key
+        merged = [k for k in self._merged_nodes if resolve(k) == node_key]
+        for merged_key in merged:
+            del self._merged_nodes[merged_key]
+            self._remove_node(merged_key)
+
+    def _node_key(self, node_id):
+        node_key = self._ids.lookup(node_id)
+        if node_key is None:
+            raise KeyError(node_id)
+        return node_key
+
+    def _attach_node(self, node):
+        node_key = self._ids.intern(node.id)
+        self._add_node(node_key, node)
+        self._flag_index.add(node_key, node)
+        node._flag_listener = self
+        if self._journal is not None:
+            self._journal.append(journal.NODE_ADD, node_key)
+        return node_key
+
+    def _attach_parts(self, node_key, node):
         for pid in node.parts:
-            self._id_to_canonical.pop(pid, None)
-        self._remove_node(node.id)
+            self._id_to_canonical.add(self._ids.intern(pid), node_key)
+
+    def _detach_node(self, node):
+        node._flag_listener = None
+        self._flag_index.remove(self._ids.lookup(node.id), node)
+
+    def _node_flag_changed(self, node, flag, old, new):
+        node_key = self._ids.lookup(node.id)
+        self._flag_index.update(node_key, flag, old, new)
+        if self._journal is not None:
+            self._journal.append(journal.FLAG, node_key, flag, new)
 
     def connect_edges(self, node):
         if node.has_edge:
+            self._generation += 1
+            node_key = self._ids.lookup(node.id)
             for edge_prop in node.edges:
                 for target in node.get(edge_prop):
                     if target not in self:
-                        target_node = self.add_stub(target)
-                    else:
-                        target_node = self.get_node_by_proxy_id(target)
-                    self._add_edge(node.id, target_node.id, key=node.id, prop=edge_prop)
+                        self.add_stub(target)
+                    target_key = self._id_to_canonical[self._ids.lookup(target)]
+                    self._add_edge(node_key, target_key, key=node_key, prop=edge_prop)
 
     def merge_proxies(self, *proxies):
         nodes = [self.get_node_by_proxy(p) for p in proxies]
         return self.merge_nodes(*nodes)
 
     def merge_nodes(self, left_node, *right_nodes):
+        self._generation += 1
         for right_node in right_nodes:
             if left_node == right_node:
                 continue
             left_node.schema.model.common_schema(left_node.schema, right_node.schema)
             left_node.merge(right_node)
-            for pid in right_node.parts:
-                self._id_to_canonical[pid] = left_node.id
-            for source_id, target_id, key, data in list(
-                self._get_node_edges(right_node.id)
-            ):
-                if source_id == right_node.id:
-                    source_id = left_node.id
-                else:
-                    target_id = left_node.id
-                self._add_edge(source_id, target_id, key=key, **data)
-            self._remove_node(right_node.id)
+            self._detach_node(right_node)
+            left_key = self._ids.lookup(left_node.id)
+            right_key = self._ids.lookup(right_node.id)
+            self._node_changed(left_key, left_node)
+            self._id_to_canonical.union(left_key, right_key)
+            self._merged_nodes[right_key] = left_key
+            if self._journal is not None:
+                self._journal.append(journal.MERGE, left_key, right_key)
+        if self._bulk_pending is None:
+            self._compact_merged()
         return left_node
 
+    def _resolve_node_key(self, node_key):
+        merged = self._merged_nodes
+        root = node_key
+        while root in merged:
+            root = merged[root]
+        while node_key in merged and merged[node_key] != root:
+            merged[node_key], node_key = root, merged[node_key]
+        return root
+
+    def _compact_merged(self):
+        """
+        Move the edges of every node that was merged away onto the node it
+        now belongs to and drop the merged nodes. Each edge is relocated once
+        no matter how long the chain of merges leading to its final node.
+        """
+        if not self._merged_nodes:
+            return
+        self._generation += 1
+        resolve = self._resolve_node_key
+        for node_key in self._merged_nodes:
+            for source, target, key, data in list(self._get_node_edges(node_key)):
+                self._add_edge(resolve(source), resolve(target), key=key, **data)
+            self._remove_node(node_key)
+        self._merged_nodes = {}
+
+    def checkpoint(self):
+        """
+        Returns the current position in the change journal, starting the
+        journal if it isn't running yet.
+        """
+        if self._journal is None:
+            self._journal = journal.Journal()
+        return self._journal.checkpoint()
+
+    def stop_journal(self):
+        self._journal = None
+
+    @contextmanager
+    def track_changes(self):
+        """
+        Journal the changes made inside the block and yield the checkpoint it
+        started at. A journal started by the block is dropped on exit.
+        """
+        started = self._journal is None
+        try:
+            yield self.checkpoint()
+        finally:
+            if started:
+                self.stop_journal()
+
+    def iter_changes(self, checkpoint=0):
+        """Yields the journal records since `checkpoint` with string ids"""
+        if self._journal is None:
+            raise ValueError("Change journal is not running")
+        ids = self._ids
+        for op, *args in self._journal.since(checkpoint):
+            if op == journal.FLAG:
+                node_key, flag, value = args
+                yield op, ids[node_key], flag, value
+            else:
+                yield (op, *(ids[key] for key in args))
+
+    def get_changes(self, checkpoint=0):
+        """
+        Summarizes the changes since `checkpoint`: the nodes and proxies
+        added, the stubs filled, the nodes merged into each surviving node,
+        the latest value of every changed flag and the nodes removed. Node
+        ids are resolved to the node they were eventually merged into.
+        """
+        merged_into = {}
+
+        def resolve(node_id):
+            while node_id in merged_into:
+                node_id = merged_into[node_id]
+            return node_id
+
+        records = list(self.iter_changes(checkpoint))
+        for op, *args in records:
+            if op == journal.MERGE:
+                left_id, right_id = args
+                merged_into[right_id] = left_id
+        nodes_new, proxies_new, stubs_filled = [], [], []
+        merge, flags, removed = {}, {}, set()
+        for op, *args in records:
+            if op == journal.NODE_ADD:
+                if args[0] not in merged_into:
+                    nodes_new.append(args[0])
+            elif op == journal.PROXY_ADD:
+                proxies_new.append(args[0])
+            elif op == journal.STUB_FILL:
+                stubs_filled.append(args[0])
+            elif op == journal.MERGE:
+                merge.setdefault(resolve(args[0]), []).append(args[1])
+            elif op == journal.FLAG:
+                node_id, flag, value = args
+                flags.setdefault(resolve(node_id), {})[flag] = value
+            elif op == journal.NODE_REMOVE:
+                removed.add(args[0])
+        return {
+            "nodes_new": [n for n in nodes_new if n not in removed],
+            "proxies_new": proxies_new,
+            "stubs_filled": stubs_filled,
+            "merge": merge,
+            "flags": flags,
+            "removed": list(removed),
+        }
+
     @classmethod
     def intersect(cls, *graphs):
         keep_proxy_ids = set(pid for node in graphs[0].nodes() for pid in node.parts)
@@ -156,8 +445,8 @@ class EntityGraph(object):
                 cur_node = graph.get_node_by_proxy_id(keep_proxy_id)
                 seen_ids.update(cur_node.parts)
                 node.merge(cur_node)
-            G._add_node(node)
-            G._id_to_canonical.update({pid: node.id for pid in node.parts})
+            node_key = G._attach_node(node)
+            G._attach_parts(node_key, node)
             G.connect_edges(node)
         return G
 
@@ -172,29 +461,73 @@ class EntityGraph(object):
                     seen_ids.add(source_id)
                     yield self.get_node(source_id)
 
+    def subgraph(self, node_ids):
+        """Read-only view of the nodes `node_ids` and the edges between them"""
+        from .backends.view import EntityGraphView
+
+        return EntityGraphView(self, map(self._node_key, node_ids))
+
     def get_node(self, node_id):
-        return self._get_node(node_id)
+        node_key = self._node_key(node_id)
+        if self._merged_nodes:
+            node_key = self._resolve_node_key(node_key)
+        return self._get_node(node_key)
 
     def get_node_by_proxy_id(self, pid):
-        node_id = self._id_to_canonical[pid]
-        return self.get_node(node_id)
+        proxy_key = self._ids.lookup(pid)
+        if proxy_key is None:
+            raise KeyError(pid)
+        return self._get_node(self._id_to_canonical[proxy_key])
 
     def get_node_by_proxy(self, proxy):
         return self.get_node_by_proxy_id(proxy.id)
 
     def get_node_edges(self, node):
-        return self._get_node_edges(node.id)
+        ids = self._ids
+        for source_key, target_key, key, data in self._get_node_edges(
+            self._node_key(node.id)
+        ):
+            yield ids[source_key], ids[target_key], ids[key], data
+
+    def get_node_in_edges(self, node):
+        return self._edge_ids(self._get_node_in_edges(self._node_key(node.id)))
+
+    def get_node_out_edges(self, node):
+        return self._edge_ids(self._get_node_out_edges(self._node_key(node.id)))
+
+    def _edge_ids(self, edges):
+        ids = self._ids
+        return [(ids[s], ids[t], ids[k], data) for s, t, k, data in edges]
+
+    def _orient_edge(self, source_key, target_key, key, data):
+        """
+        Orients an edge the way its property reads: from the node defining
+        the property to the node it refers to, except for the source
+        property of edge schemata (an ownership's owner) which points into
+        the edge entity.
+        """
+        canonical = self._id_to_canonical
+        owner = canonical[key] if key in canonical else source_key
+        if owner not in (source_key, target_key):
+            owner = source_key
+        other = target_key if owner == source_key else source_key
+        schema = self._get_node(owner).schema
+        if schema.edge and data.get("prop") == schema.source_prop.name:
+            return other, owner, key, data
+        return owner, other, key, data
 
     def proxies(self, **flags):
         for node in self.nodes(**flags):
             yield from node.proxies
 
     def ensure_flag(self, **flag_values):
-        for node in self.nodes():
-            node.ensure_flag(**flag_values)
+        for flag, value in flag_values.items():
+            for node in self.nodes(**{flag: None}):
+                node.ensure_flag(**{flag: value})
 
     def __contains__(self, proxy_id):
-        return proxy_id in self._id_to_canonical
+        proxy_key = self._ids.lookup(proxy_id)
+        return proxy_key is not None and proxy_key in self._id_to_canonical
 
     def __len__(self):
         return len(self._id_to_canonical)
@@ -207,6 +540,11 @@ class EntityGraph(object):
     def n_edges(self):
         return self._get_n_edges()
 
+    @property
+    def n_stubs(self):
+        """Number of proxies only known as the target of an edge"""
+        return len(self._stub_proxies)
+
     def __repr__(self):
         n_nodes = self._get_n_nodes()
         n_edges = self._get_n_edges()
@@ -0,0 +1,88 @@
+class FlagIndex(object):
+    """
+    Inverted index from (flag, value) to node ids. Nodes that don't have a
+    flag are indexed under `None` so that queries for unset flags, which is
+    how operations find their remaining work, don't need a full scan. Flags
+    that ever carry an unhashable value are dropped from the index and
+    answered by scanning instead.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._unindexed = set()
+        self._all = set()
+
+    def add(self, node_id, node):
+        for flag in node.flags:
+            if flag not in self._index and flag not in self._unindexed:
+                self._seed(flag)
+        for flag in list(self._index):
+            self._insert(flag, node.flags.get(flag), node_id)
+        self._all.add(node_id)
+
+    def remove(self, node_id, node):
+        if node_id not in self._all:
+            return
+        self._all.discard(node_id)
+        for flag, buckets in self._index.items():
+            self._discard(buckets, node.flags.get(flag), node_id)
+
+    def update(self, node_id, flag, old, new):
+        if node_id not in self._all or flag in self._unindexed:
+            return
+        if flag not in self._index:
+            self._seed(flag)
+        self._discard(self._index[flag], old, node_id)
+        self._insert(flag, new, node_id)
+
+    def find(self, **flags):
+        """
+        Returns the ids of the nodes matching all the given flag values, or
+        None when the query can't be answered from the index and the caller
+        has to scan.
+        """
+        candidates = []
+        for flag, value in flags.items():
+            if flag in self._unindexed:
+                return None
+            buckets = self._index.get(flag)
+            if buckets is None:
+                if value is None:
+                    continue
+                return []
+            try:
+                bucket = buckets.get(value)
+            except TypeError:
+                return None
+            if not bucket:
+                return []
+            candidates.append(bucket)
+        if not candidates:
+            return None
+        candidates.sort(key=len)
+        first, rest = candidates[0], candidates[1:]
+        return [node_id for node_id in first if all(node_id in c for c in rest)]
+
+    def _seed(self, flag):
+        self._index[flag] = {None: set(self._all)}
+
+    def _insert(self, flag, value, node_id):
+        try:
+            self._index[flag].setdefault(value, set()).add(node_id)
+        except TypeError:
+            self._index.pop(flag)
+            self._unindexed.add(flag)
+
+    def _discard(self, buckets, value, node_id):
+        try:
+            bucket = buckets.get(value)
+        except TypeError:
+            return
+        if bucket is None:
+            return
+        bucket.discard(node_id)
+        if not bucket and value is not None:
+            buckets.pop(value)
+
+    def __len__(self):
+        return len(self._all)
@@ -0,0 +1,59 @@
+class Interner(object):
+    """
+    Maps string ids to dense integer keys. Each id is stored once, in the
+    order it was first seen, and keys are never reused. Released ids are
+    dropped but keep their slot, so `len` is the size of the key space.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._values = []
+
+    def intern(self, value):
+        key = self._keys.get(value)
+        if key is None:
+            key = len(self._values)
+            self._keys[value] = key
+            self._values.append(value)
+        return key
+
+    def release(self, value):
+        key = self._keys.pop(value, None)
+        if key is not None:
+            self._values[key] = None
+
+    def lookup(self, value, default=None):
+        return self._keys.get(value, default)
+
+    def values(self):
+        return (v for v in self._values if v is not None)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, value):
+        return value in self._keys
+
+    def __len__(self):
+        return len(self._values)
+
+
+class IdentityInterner(object):
+    """
+    Interner for backends keyed by the string ids themselves. CPython dicts
+    keyed by str are smaller than int-keyed ones and the ids are already
+    held by the proxies, so dense keys only pay off in array or disk
+    backends.
+    """
+
+    def intern(self, value):
+        return value
+
+    def release(self, value):
+        pass
+
+    def lookup(self, value, default=None):
+        return value
+
+    def __getitem__(self, key):
+        return key
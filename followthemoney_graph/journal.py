@@ -0,0 +1,34 @@
+NODE_ADD = "node"
+NODE_REMOVE = "remove"
+PROXY_ADD = "proxy"
+STUB_ADD = "stub"
+STUB_FILL = "fill"
+MERGE = "merge"
+FLAG = "flag"
+
+
+class Journal(object):
+    """
+    Append-only log of graph changes. Records are tuples of an operation
+    name and interned keys, e.g. `(MERGE, left_key, right_key)` or
+    `(FLAG, node_key, flag, value)`. Positions in the log serve as
+    checkpoints to read the changes since.
+    """
+
+    def __init__(self):
+        self._records = []
+
+    def append(self, *record):
+        self._records.append(record)
+
+    def checkpoint(self):
+        return len(self._records)
+
+    def since(self, checkpoint=0):
+        return self._records[checkpoint:]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
@@ -1,2 +1,10 @@
-from .entity_graph_tracker import EntityGraphTracker
+from .concurrency import (
+    AsyncMapper,
+    SingleFlight,
+    AdaptiveLimiter,
+    prefetch,
+    bounded_map,
+    requeue_failed,
+)
 from .graph_helper import track_node_tag
+from .metrics import Metrics, metrics
@@ -0,0 +1,384 @@
+import asyncio
+import contextvars
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
+
+
+log = logging.getLogger(__name__)
+_DONE = object()
+
+
+class AsyncMapper(object):
+    """
+    Drop-in `mapper=` for the aleph operations. Tasks are blocking calls run
+    in a thread pool, scheduled from an asyncio loop in a background thread
+    with at most `concurrency` of them holding a slot, each given `timeout`
+    seconds from when it starts running. Results are yielded in the order
+    they complete rather than the order they were submitted, and handed back
+    to the thread iterating over the mapper, so the graph is only ever
+    written to from there. Tasks that raise are logged and skipped, the same
+    way operations skip a task that returned None.
+
+    A task that times out frees its slot and its item is put back in the
+    queue, up to `retries` times. Threads can't be interrupted, so the timed
+    out call keeps running on a thread of its own: if it returns before
+    another attempt for the item did, its result is used, so no result is
+    lost and none is yielded twice.
+    """
+
+    def __init__(self, concurrency=16, timeout=60, retries=1):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+
+    def __call__(self, task, iterable):
+        # Tasks run in copies of the caller's context, e.g. its metrics labels
+        context = contextvars.copy_context()
+        task = partial(_run_in_context, context, task)
+        results = queue.Queue(maxsize=self.concurrency)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=asyncio.run,
+            args=(self._run(task, iterable, results, stop),),
+            daemon=True,
+        )
+        thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    async def _run(self, task, iterable, results, stop):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        # Room for the threads of timed out calls next to the ones in a slot
+        executor = ThreadPoolExecutor(2 * self.concurrency)
+        tasks = set()
+
+        def spawn(coro):
+            future = asyncio.ensure_future(coro)
+            tasks.add(future)
+            future.add_done_callback(tasks.discard)
+
+        async def put(result):
+            while not stop.is_set():
+                try:
+                    results.put_nowait(result)
+                    return
+                except queue.Full:
+                    await asyncio.sleep(0.01)
+
+        async def requeue(item, delivered, retries):
+            await slots.acquire()
+            if stop.is_set() or delivered.is_set():
+                slots.release()
+                return
+            await run(item, delivered, retries)
+
+        async def run(item, delivered, retries):
+            """Runs one attempt at `item` in the slot acquired by the caller"""
+            started = asyncio.Event()
+
+            def call():
+                loop.call_soon_threadsafe(started.set)
+                return task(item)
+
+            future = loop.run_in_executor(executor, call)
+            holds_slot = True
+            try:
+                await started.wait()
+                done, _ = await asyncio.wait([future], timeout=self.timeout)
+                if not done:
+                    slots.release()
+                    holds_slot = False
+                    if retries > 0:
+                        log.warning(f"Task timed out, requeued: {item}")
+                        spawn(requeue(item, delivered, retries - 1))
+                    else:
+                        log.warning(f"Task timed out after {self.timeout}s: {item}")
+                    waiter = asyncio.ensure_future(delivered.wait())
+                    await asyncio.wait(
+                        [future, waiter], return_when=asyncio.FIRST_COMPLETED
+                    )
+                    waiter.cancel()
+                if delivered.is_set():
+                    return
+                result = future.result()
+            except Exception:
+                log.exception(f"Task failed: {item}")
+            else:
+                delivered.set()
+                await put(result)
+            finally:
+                if holds_slot:
+                    slots.release()
+
+        try:
+            for item in iterable:
+                await slots.acquire()
+                if stop.is_set():
+                    break
+                spawn(run(item, asyncio.Event(), self.retries))
+            while tasks:
+                await asyncio.wait(set(tasks))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            await put(_DONE)
+
+
+def _run_in_context(context, task, item):
+    return context.copy().run(task, item)
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function and everyone arriving while it is in flight waits for its
+    result instead of making the same call again. `copy` is applied to the
+    result handed to waiters so they don't share a mutable object.
+    `calls` counts the calls made and `coalesced` the ones that were saved.
+    """
+
+    def __init__(self, copy=None):
+        self.copy = copy
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._flights.get(key)
+            if future is None:
+                future = self._flights[key] = Future()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            result = future.result()
+            return self.copy(result) if self.copy is not None else result
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    @property
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced}
+
+
+class AdaptiveLimiter(object):
+    """
+    Concurrency limit that adapts with additive increase and multiplicative
+    decrease. Every `limit` successful calls that finished within
+    `target_latency` seconds raise the limit by one; an overload signal
+    (throttling, server errors, timeouts) multiplies it by `decrease`.
+    Overload signals within `cooldown` seconds of the last decrease are
+    counted as the same event, so a burst of failing in-flight calls only
+    backs off once. Use it as a context manager around each call.
+    """
+
+    def __init__(
+        self,
+        limit=8,
+        min_limit=1,
+        max_limit=64,
+        target_latency=5.0,
+        decrease=0.5,
+        cooldown=1.0,
+    ):
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._successes = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def success(self, latency):
+        with self._cond:
+            if latency > self.target_latency:
+                self._successes = 0
+                return
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_limit:
+                self._successes = 0
+                self.limit += 1
+                self._cond.notify()
+
+    def overload(self):
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._successes = 0
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def backoff_delays(retries, base=0.5, cap=30.0):
+    """Yields `retries` exponential backoff delays with full jitter"""
+    for attempt in range(retries):
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _catch(task, errors, item):
+    try:
+        return item, None, task(item)
+    except errors as e:
+        return item, e, None
+
+
+def requeue_failed(mapper, task, items, delays, errors=(Exception,)):
+    """
+    Maps `task` over `items` with `mapper` and yields `(item, result)` for
+    every item that succeeded. Items whose task raised one of `errors` are
+    put back in the queue and mapped again once the others are done, after
+    waiting for the next of `delays` (e.g. `backoff_delays`). Items still
+    failing once `delays` run out are logged and dropped.
+    """
+    task = partial(_catch, task, errors)
+    delays = iter(delays)
+    items = list(items)
+    while items:
+        failed = []
+        for item, error, result in mapper(task, items):
+            if error is None:
+                yield item, result
+            else:
+                failed.append((item, error))
+        if not failed:
+            return
+        delay = next(delays, None)
+        if delay is None:
+            for item, error in failed:
+                log.error(f"Giving up on {item}: {error}")
+            return
+        log.info(f"Requeueing {len(failed)} failed items in {delay:.1f}s")
+        time.sleep(delay)
+        items = [item for item, _ in failed]
+
+
+def prefetch(iterable, size=1000):
+    """
+    Iterates over `iterable` in a background thread, keeping up to `size`
+    items buffered ahead of the consumer, so that paged API results are
+    fetched while the previous ones are being processed. Exceptions raised
+    by the iterable are re-raised to the consumer.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def bounded_map(task, iterable, workers=8, window=None, ordered=True):
+    """
+    Maps `task` over `iterable` in `workers` threads with at most `window`
+    items (twice the workers by default) in flight, so an unbounded input
+    is only read as fast as results are consumed. Results are yielded as
+    they complete, or in input order with `ordered`. Exceptions raised by
+    the task are re-raised to the consumer. Tasks run in copies of the
+    caller's context.
+    """
+    window = window or 2 * workers
+    items = iter(iterable)
+    executor = ThreadPoolExecutor(workers)
+    pending = deque() if ordered else set()
+    submit = pending.append if ordered else pending.add
+
+    def fill():
+        for item in islice(items, window - len(pending)):
+            context = contextvars.copy_context()
+            submit(executor.submit(context.run, task, item))
+
+    try:
+        fill()
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                pending.difference_update(done)
+            for future in done:
+                result = future.result()
+                fill()
+                yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,179 @@
+import contextvars
+import json
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.name, elapsed, **self.labels)
+
+
+class Metrics(object):
+    """
+    Registry of counters and histograms keyed by a name and labels. Every
+    sample is also labeled with the operation running in the current
+    context, if any (see `instrument`), so operations in concurrent threads
+    don't label each other's samples; the mappers in `lib.concurrency` run
+    their tasks in the caller's context. While disabled, recording returns
+    right after checking `enabled`, and `timer` hands out a shared no-op
+    context manager.
+    """
+
+    def __init__(self, enabled=False, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._operation = contextvars.ContextVar("operation", default=None)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @property
+    def operation(self):
+        return self._operation.get()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def _key(self, name, labels):
+        operation = self._operation.get()
+        if operation is not None and "operation" not in labels:
+            labels["operation"] = operation
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "count": 0,
+                    "sum": 0.0,
+                    "buckets": [0] * (len(self.buckets) + 1),
+                }
+            histogram["count"] += 1
+            histogram["sum"] += value
+            histogram["buckets"][bisect_left(self.buckets, value)] += 1
+
+    def timer(self, name, **labels):
+        """Context manager observing the seconds spent in its block"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def instrument(self, name):
+        """
+        Decorator for operations: counts and times their calls as
+        `operation` and labels everything recorded meanwhile with `name`.
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                token = self._operation.set(name)
+                try:
+                    with self.timer("operation"):
+                        return func(*args, **kwargs)
+                finally:
+                    self._operation.reset(token)
+
+            return wrapper
+
+        return decorator
+
+    def get(self, name, **labels):
+        """
+        Returns the counter value or histogram for `name`, summed over all
+        samples whose labels include `labels`.
+        """
+        labels = set(labels.items())
+        total = None
+        with self._lock:
+            for (key, key_labels), value in self._counters.items():
+                if key == name and labels.issubset(key_labels):
+                    total = (total or 0) + value
+            for (key, key_labels), histogram in self._histograms.items():
+                if key == name and labels.issubset(key_labels):
+                    if total is None:
+                        total = {
+                            "count": 0,
+                            "sum": 0.0,
+                            "buckets": [0] * (len(self.buckets) + 1),
+                        }
+                    total["count"] += histogram["count"]
+                    total["sum"] += histogram["sum"]
+                    for i, n in enumerate(histogram["buckets"]):
+                        total["buckets"][i] += n
+        return total
+
+    def to_dict(self):
+        data = {"buckets": list(self.buckets), "counters": [], "histograms": []}
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                data["counters"].append(
+                    {"name": name, "labels": dict(labels), "value": value}
+                )
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                data["histograms"].append(
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram["count"],
+                        "sum": histogram["sum"],
+                        "buckets": list(histogram["buckets"]),
+                    }
+                )
+        return data
+
+    def to_json(self, fd=None):
+        if fd is None:
+            return json.dumps(self.to_dict())
+        json.dump(self.to_dict(), fd)
+
+
+metrics = Metrics()
@@ -0,0 +1,42 @@
+import json
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def iter_chunks(fd, chunk_size=CHUNK_SIZE):
+    """Reads whole lines from fd in batches of roughly `chunk_size` bytes"""
+    while True:
+        lines = fd.readlines(chunk_size)
+        if not lines:
+            return
+        yield lines
+
+
+def decode_chunk(lines):
+    """
+    Decodes a batch of exported proxy lines into
+    (profile_id, flags, proxy_dict, line_length) records. `flags` is popped
+    from the proxy dict like `EntityGraph.from_file` always did.
+    """
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        data = json_loads(line)
+        flags = data.pop("flags", {})
+        records.append((data.get("profile_id"), flags, data, len(line)))
+    return records
+
+
+def iter_records(fd, chunk_size=CHUNK_SIZE):
+    """Yields decoded records from fd in file order, reading it in chunks"""
+    for chunk in iter_chunks(fd, chunk_size=chunk_size):
+        yield from decode_chunk(chunk)
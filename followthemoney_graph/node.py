@@ -35,8 +35,29 @@ def _match(target, value):
 
 class Node(MultiPartProxy):
     def __init__(self, *args, flags=None, **kwargs):
+        self._flags = {}
+        self._flag_listener = None
         super().__init__(*args, **kwargs)
-        self.flags = flags or {}
+        self._flags = flags or {}
+
+    @property
+    def flags(self):
+        return self._flags
+
+    @flags.setter
+    def flags(self, flags):
+        old_flags, self._flags = self._flags, dict(flags)
+        if self._flag_listener is not None:
+            for flag in set(old_flags).union(self._flags):
+                old, new = old_flags.get(flag), self._flags.get(flag)
+                if old != new:
+                    self._flag_listener._node_flag_changed(self, flag, old, new)
+
+    def _set_flag(self, flag, value):
+        old = self._flags.get(flag)
+        self._flags[flag] = value
+        if self._flag_listener is not None and old != value:
+            self._flag_listener._node_flag_changed(self, flag, old, value)
 
     @property
     def has_edge(self):
@@ -61,11 +82,13 @@ class Node(MultiPartProxy):
         raise IndexError
 
     def set_flags(self, **flag_values):
-        self.flags.update(flag_values)
+        for flag, value in flag_values.items():
+            self._set_flag(flag, value)
 
     def ensure_flag(self, **flag_values):
         for flag, value in flag_values.items():
-            self.flags.setdefault(flag, value)
+            if flag not in self._flags:
+                self._set_flag(flag, value)
 
     def has_flags(self, **flag_values):
         return all(self.flags.get(f) == v for f, v in flag_values.items())
@@ -73,7 +96,7 @@ class Node(MultiPartProxy):
     def merge(self, other):
         super().merge(other)
         for flag, value in other.flags.items():
-            self.flags[flag] = self.flags.get(flag, False) and value
+            self._set_flag(flag, self.flags.get(flag, False) and value)
         return self
 
     def match(self, other, ignore_edges=True, exact=True):
@@ -1,27 +1,321 @@
+import contextvars
+import json
 import logging
-from functools import lru_cache
+import threading
+import time
+from hashlib import sha1
+from itertools import chain
 from copy import deepcopy
-from functools import partial, wraps
+from functools import partial, reduce, wraps
 from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus, urlsplit, parse_qsl, urlencode
 
-from alephclient.api import AlephAPI, EntityResultSet, AlephException
+from alephclient.api import AlephAPI, AlephException
 from tqdm.autonotebook import tqdm
 import requests
+from requests.exceptions import HTTPError, RequestException
 
 from followthemoney import model
+from followthemoney.types import registry
 from followthemoney.exc import InvalidData
 
+from ..cache import SQLiteCache
+from ..disjoint_set import DisjointSet
+from ..lib.concurrency import (
+    SingleFlight,
+    AdaptiveLimiter,
+    backoff_delays,
+    prefetch,
+    requeue_failed,
+)
+from ..lib.metrics import metrics
+
 
 log = logging.getLogger(__name__)
 
-alephclient = AlephAPI(timeout=60)
-alephclient._request = lru_cache(2048)(alephclient._request)
+# Cache TTLs in seconds by API route, with ids replaced by <id>. GET requests
+# to other routes aren't cached. `match` is a POST: its results are cached
+# per fingerprint by `enrich_similar`.
+ALEPH_CACHE_TTLS = {
+    "collections": 86400,
+    "collections/<id>/xref": 3600,
+    "entities": 86400 * 7,
+    "entities/<id>": 86400 * 7,
+    "entitysets": 86400,
+    "entitysets/<id>/items": 86400,
+    "match": 86400 * 7,
+}
+aleph_cache = SQLiteCache()
+aleph_flight = SingleFlight(copy=deepcopy)
+aleph_limiter = AdaptiveLimiter()
+ALEPH_RETRIES = 5
+# Rounds a failed work item is requeued for once its requests ran out of retries
+ALEPH_REQUEUES = 3
+ALEPH_TIMEOUT = 60
+# Properties left out of match fingerprints, as they differ between copies
+MATCH_IGNORE_PROPS = ("alephUrl",)
+
+
+def _request_key(method, url, params=None, json=None, **kwargs):
+    """
+    Cache key for a GET request: the URL with its query string and `params`
+    merged and sorted, so equivalent requests share an entry. Requests with
+    any other method aren't cached.
+    """
+    if method.upper() != "GET" or json is not None:
+        return None
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    for key, values in (params or {}).items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        query.extend((key, str(v)) for v in values if v is not None)
+    query = urlencode(sorted(query))
+    return f"{parts.scheme}://{parts.netloc}{parts.path}?{query}"
+
+
+def _endpoint(url):
+    path = urlsplit(url).path.split("/api/2/", 1)[-1]
+    return path.split("/", 1)[0]
+
+
+def _route(url):
+    """The API path of `url` with the ids in it replaced by `<id>`"""
+    segments = urlsplit(url).path.split("/api/2/", 1)[-1].strip("/").split("/")
+    return "/".join("<id>" if i % 2 else s for i, s in enumerate(segments))
+
+
+def _request_ttl(url):
+    return ALEPH_CACHE_TTLS.get(_route(url))
+
+
+def _cache_scope(api):
+    """
+    Cache key prefix for the host and API key `api` talks to, so responses
+    are never served to a client with other permissions. The key itself is
+    hashed rather than stored in the cache.
+    """
+    auth = api.session.headers.get("Authorization", "")
+    return sha1(f"{api.base_url}\n{auth}".encode("utf8")).hexdigest()[:16]
+
+
+def _record_response(response, *args, **kwargs):
+    if not metrics.enabled:
+        return
+    endpoint = _endpoint(response.url)
+    metrics.incr("aleph.requests", endpoint=endpoint, status=response.status_code)
+    # Reading the content here would load streamed responses at once
+    length = response.headers.get("Content-Length")
+    if length is not None:
+        metrics.incr("aleph.bytes", int(length), endpoint=endpoint)
+    metrics.observe(
+        "aleph.request_seconds", response.elapsed.total_seconds(), endpoint=endpoint
+    )
+
+
+def _cached_request(request, cache, flight, scope=""):
+    """
+    Serves GET requests to routes with a cache TTL from `cache`, under keys
+    prefixed with `scope`, and has concurrent misses for the same key share
+    a single request through `flight`.
+    """
+
+    def fetch(key, method, url, **kwargs):
+        value = cache.get(key)
+        if value is None:
+            metrics.incr("aleph.cache_misses", endpoint=_endpoint(url))
+            value = request(method, url, **kwargs)
+            cache.store(key, value, ttl=_request_ttl(url))
+        else:
+            metrics.incr("aleph.cache_hits", endpoint=_endpoint(url))
+        return value
+
+    @wraps(request)
+    def cached(method, url, **kwargs):
+        key = _request_key(method, url, **kwargs)
+        if key is None or _request_ttl(url) is None:
+            return request(method, url, **kwargs)
+        key = f"{scope}:{key}"
+        return flight.do(key, fetch, key, method, url, **kwargs)
+
+    return cached
+
+
+class _BudgetExhausted(Exception):
+    pass
+
+
+class _RequestBudget(object):
+    """
+    Counts the requests sent to Aleph, `next` pages and retries included,
+    by the code running in a context with the budget set (see
+    `_request_budget`). Cached responses don't count. Once `limit` requests
+    were sent, further ones raise `_BudgetExhausted`.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def spend(self):
+        with self._lock:
+            if self.exhausted:
+                raise _BudgetExhausted(f"Used up the budget of {self.limit} requests")
+            self.used += 1
+
+    @property
+    def exhausted(self):
+        return self.limit is not None and self.used >= self.limit
+
+
+_request_budget = contextvars.ContextVar("aleph_request_budget", default=None)
+
+
+def _is_overload(exc):
+    return exc.status == 429 or exc.transient
+
+
+def _throttled_request(request, limiter, retries=ALEPH_RETRIES):
+    """
+    Runs requests within `limiter`, each with a `ALEPH_TIMEOUT` timeout.
+    Throttling, server errors and timeouts make the limiter back off and the
+    request is retried after a jittered exponential delay; other errors are
+    raised right away. Every request sent is charged to the request budget
+    of the context, if any.
+    """
+
+    @wraps(request)
+    def throttled(method, url, **kwargs):
+        kwargs.setdefault("timeout", ALEPH_TIMEOUT)
+        delays = backoff_delays(retries)
+        budget = _request_budget.get()
+        while True:
+            if budget is not None:
+                budget.spend()
+            with limiter:
+                start = time.monotonic()
+                try:
+                    value = request(method, url, **kwargs)
+                except AlephException as e:
+                    if not _is_overload(e):
+                        raise
+                    limiter.overload()
+                    error = e
+                else:
+                    limiter.success(time.monotonic() - start)
+                    return value
+            delay = next(delays, None)
+            if delay is None:
+                raise error
+            metrics.incr("aleph.retries", endpoint=_endpoint(url))
+            log.info(f"Retrying in {delay:.1f}s: {url}: {error}")
+            time.sleep(delay)
+
+    return throttled
+
+
+def _stream_request(session):
+    """Opens a streamed response, raising errors as `AlephException`"""
+
+    def request(method, url, **kwargs):
+        try:
+            response = session.request(method, url, stream=True, **kwargs)
+            response.raise_for_status()
+        except (RequestException, HTTPError) as exc:
+            raise AlephException(exc) from exc
+        return response
+
+    return request
+
+
+def _match(api, entity, collection_ids=None, url=None, publisher=False):
+    """`AlephAPI.match` sent through the client's throttled `_request`"""
+    params = {"collection_ids": collection_ids or []}
+    url = url or api._make_url("match")
+    response = api._request("POST", url, json=entity, params=params)
+    for result in response.get("results", []):
+        yield api._patch_entity(result, publisher=publisher)
+
+
+def _stream_entities(api, collection=None, include=None, schema=None, publisher=False):
+    """
+    `AlephAPI.stream_entities` with the request opened through the client's
+    limiter and retries. A stream failing halfway isn't retried.
+    """
+    url = api._make_url("entities/_stream")
+    if collection is not None:
+        url = api._make_url(f"collections/{collection.get('id')}/_stream")
+    params = {"include": include, "schema": schema}
+    response = api._stream("GET", url, params=params)
+    try:
+        for line in response.iter_lines(chunk_size=None):
+            yield api._patch_entity(
+                json.loads(line), publisher=publisher, collection=collection
+            )
+    except RequestException as exc:
+        raise AlephException(exc) from exc
+    finally:
+        response.close()
+
+
+def _make_alephclient(cache=None, flight=None, limiter=None):
+    api = AlephAPI(**_client_settings)
+    api.session.hooks["response"].append(_record_response)
+    limiter = limiter or aleph_limiter
+    request = _throttled_request(api._request, limiter)
+    api._stream = _throttled_request(_stream_request(api.session), limiter)
+    api.match = partial(_match, api)
+    api.stream_entities = partial(_stream_entities, api)
+    api.cache_scope = _cache_scope(api)
+    api._request = _cached_request(
+        request, cache or aleph_cache, flight or aleph_flight, api.cache_scope
+    )
+    return api
+
+
+class _LazyClient(object):
+    """
+    Stands in for the module client until it's first used, so importing this
+    module doesn't need Aleph settings and `aleph_configure` can still point
+    it somewhere else.
+    """
+
+    def __getattr__(self, name):
+        global alephclient
+        if isinstance(alephclient, _LazyClient):
+            alephclient = _make_alephclient()
+        return getattr(alephclient, name)
+
+
+_client_settings = {}
+alephclient = _LazyClient()
+
+
+def aleph_configure(host=None, api_key=None, cache=None):
+    """
+    Points the module client at `host` with `api_key` instead of the
+    alephclient environment settings, optionally with another response
+    cache (e.g. `Cache()` to disable caching).
+    """
+    global alephclient, aleph_cache
+    _client_settings.clear()
+    if host is not None:
+        _client_settings["host"] = host
+    if api_key is not None:
+        _client_settings["api_key"] = api_key
+    if cache is not None:
+        aleph_cache = cache
+    alephclient = _make_alephclient()
+    return alephclient
 
 
 def aleph_initializer(initializer=None):
     global alephclient
-    alephclient = AlephAPI(timeout=60)
-    adapter = requests.adapters.HTTPAdapter(pool_connections=52)
+    alephclient = _make_alephclient()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=52, pool_maxsize=aleph_limiter.max_limit
+    )
     alephclient.session.mount("http://", adapter)
     alephclient.session.mount("https://", adapter)
     if initializer is not None:
@@ -47,46 +341,78 @@ def aleph_get_qparts(
     We take a list of query parts to get OR'd together. The queries are chunked
     so that the length is up to 3600 characters long in order to make sure we
     don't get rejected from aleph for having too long of a URL. The limit is
-    technically 4096, but we'd like to leave a buffer just in ase
+    technically 4096, but we'd like to leave a buffer just in ase. With
+    `merge="and"` the results of the chunks are intersected by entity id.
+    """
+    batches = _pack_qparts(
+        api,
+        base_url,
+        q_parts,
+        *args,
+        max_query_length=max_query_length,
+        merge=merge,
+        **kwargs,
+    )
+    if merge.lower() == "or":
+        for batch in batches:
+            url = _make_url_qparts(api, base_url, batch, *args, merge=merge, **kwargs)
+            yield from _alephget(api, url)
+        return
+    results = None
+    for batch in batches:
+        url = _make_url_qparts(api, base_url, batch, *args, merge=merge, **kwargs)
+        result = {r["id"]: r for r in _alephget(api, url)}
+        if results is not None:
+            result = {key: results[key] for key in result if key in results}
+        results = result
+        if not results:
+            return
+    if results:
+        yield from results.values()
+
+
+def _pack_qparts(
+    api, base_url, q_parts, *args, max_query_length=3600, merge="or", **kwargs
+):
+    """
+    Greedily packs `q_parts` into batches whose query URL stays under
+    `max_query_length`. URL encoding works character by character, so the
+    URL length is the length for a single part plus the encoded length of
+    every further separator and part.
     """
-    # <HACK dec14,2020, the big OR'd queries aren't working right now>
-    for q_part in q_parts:
-        url = _make_url_qparts(api, base_url, [q_part], *args, merge=merge, **kwargs)
-        yield from _alephget(api, url)
-    return
-    # </HACK>
     if not q_parts:
         return
-    url = _make_url_qparts(api, base_url, q_parts, *args, merge=merge, **kwargs)
-    if len(url) <= max_query_length:
-        print(url)
-        yield from _alephget(api, url)
-    else:
-        results = []
-        while q_parts:
-            url = None
-            for i in range(len(q_parts)):
-                url_test = _make_url_qparts(
-                    api, base_url, q_parts[:i], *args, merge=merge, **kwargs
-                )
-                url_len = len(url_test)
-                if url_len > max_query_length:
-                    break
-                url = url_test
-            else:
-                i += 1
-            q_parts = q_parts[i:]
-            if merge.lower() == "or":
-                yield from _alephget(api, url)
-            else:
-                result = {r["id"]: r for r in _alephget(api, url)}
-        if results and merge.lower() == "and":
-            keys = set.intersection(*[set(r) for r in result])
-            for key in keys:
-                yield results[0][key]
+    url = _make_url_qparts(api, base_url, q_parts[:1], *args, merge=merge, **kwargs)
+    overhead = len(url) - len(quote_plus(q_parts[0]))
+    separator = len(quote_plus(f" {merge.upper()} "))
+    batch, length = [], overhead
+    for q_part in q_parts:
+        part_length = len(quote_plus(q_part))
+        if batch and length + separator + part_length > max_query_length:
+            yield batch
+            batch, length = [], overhead
+        if batch:
+            length += separator
+        elif overhead + part_length > max_query_length:
+            log.warning(f"Query part too long for a single query: {q_part}")
+        batch.append(q_part)
+        length += part_length
+    yield batch
+
+
+def _map_requeued(mapper, task, items):
+    """
+    Maps `task` over the work items of an operation with `mapper`, yielding
+    `(item, result)` pairs in the order the mapper yields them. Items that
+    failed with an `AlephException` after their requests ran out of retries
+    are requeued with a jittered backoff, `ALEPH_REQUEUES` times, and then
+    dropped: operations leave them unflagged for the next pass.
+    """
+    delays = backoff_delays(ALEPH_REQUEUES, base=5.0)
+    return requeue_failed(mapper, task, items, delays, errors=(AlephException,))
 
 
-def _make_url_qparts(api, url, q_parts, merge="or", *args, **kwargs):
+def _make_url_qparts(api, url, q_parts, *args, merge="or", **kwargs):
     q = f" {merge.upper()} ".join(q_parts)
     return api._make_url(url, q, *args, **kwargs)
 
@@ -101,75 +427,132 @@ def gen_q_part(field, values):
     return f'(_exists_:"{field}" AND {field}:({value}))'
 
 
-def _alephget(api, url):
-    try:
+def _alephget(api, url, patch=True):
+    """
+    Yields the entities of every result page, following the `next` links
+    until the last page rather than relying on the page `limit`. Requests
+    are already retried with backoff, so errors are raised: callers leave
+    the work item unflagged and it is picked up again on the next pass
+    instead of being silently recorded as having no results. Without
+    `patch`, results that aren't entities are yielded as they are.
+    """
+    while url is not None:
         log.debug(f"Fetching from server: {url}")
-        return EntityResultSet(api, url, publisher=True)
-    except AlephException as e:
-        log.warning(f"Error calling Aleph API: {url}: {e}")
-        return []
+        result = api._request("GET", url)
+        for entity in result.get("results", []):
+            yield api._patch_entity(entity, True) if patch else entity
+        url = result.get("next")
+
+
+def _alephget_xrefs(api, collection_id):
+    """Yields the xref results of a collection with both their entities patched"""
+    url = api._make_url(f"collections/{collection_id}/xref")
+    for xref in _alephget(api, url, patch=False):
+        for key in ("entity", "match"):
+            api._patch_entity(xref[key], True)
+        yield xref
+
+
+def _flatten_entity(entity, nested=None):
+    """
+    Returns a shallow copy of `entity` whose properties have nested entity
+    dicts replaced by their ids, appending the nested dicts to `nested`.
+    The input is left untouched, so no deep copy is needed.
+    """
+    properties = {}
+    for key, values in entity.get("properties", {}).items():
+        flat = []
+        for value in values:
+            if isinstance(value, dict):
+                if nested is not None:
+                    nested.append(value)
+                value = value.get("id")
+            flat.append(value)
+        properties[key] = flat
+    entity = dict(entity)
+    entity["properties"] = properties
+    return entity
 
 
 def parse_nested(edge):
-    schema = model.get(edge["schema"])
-    for items in edge["properties"].values():
-        for item in items:
-            if isinstance(item, dict):
-                log.debug(f"Found nested item: {item['id']}")
-                yield parse_entity(item)
-    yield parse_entity(edge)
+    """Yields the proxies of the entities nested in `edge`, then of `edge`"""
+    nested = []
+    proxy = parse_entity(edge, nested=nested)
+    for item in nested:
+        log.debug(f"Found nested item: {item['id']}")
+        yield parse_entity(item)
+    yield proxy
 
 
-def parse_entity(entity):
-    try:
-        entity = deepcopy(entity)
-        for key, values in entity.get("properties", {}).items():
-            for i, value in enumerate(values):
-                if isinstance(value, dict):
-                    values[i] = value.get("id")
-        return model.get_proxy(entity)
-    except AttributeError:
-        return None
+def parse_entity(entity, nested=None):
+    with metrics.timer("parse_entity"):
+        try:
+            return model.get_proxy(_flatten_entity(entity, nested=nested))
+        except AttributeError:
+            return None
+
+
+def _add_proxy(G, proxy, **kwargs):
+    with metrics.timer("add_proxy"):
+        return G.add_proxy(proxy, **kwargs)
+
+
+def parse_entities(entities, nested=False):
+    """
+    Batch variant of `parse_entity` (or `parse_nested` with `nested=True`)
+    for streams of entities. Entities that are None or fail to parse are
+    skipped.
+    """
+    for entity in entities:
+        if entity is None:
+            continue
+        try:
+            if nested:
+                yield from (p for p in parse_nested(entity) if p is not None)
+            else:
+                proxy = parse_entity(entity)
+                if proxy is not None:
+                    yield proxy
+        except InvalidData as e:
+            log.debug(f"Invalid entity: {entity.get('id')}: {e}")
 
 
 def _add_entity(entity_id, publisher):
     try:
         return alephclient.get_entity(entity_id, publisher=publisher)
     except AlephException as e:
-        logging.warning(f"Could not get data for: {entity_id}: {e}")
-        return None
-    except Exception:
-        logging.exception("General error getting entity")
+        if e.status != 404:
+            raise
+        log.warning(f"Could not get data for: {entity_id}: {e}")
         return None
 
 
+@metrics.instrument("add_aleph_entities")
 def add_aleph_entities(G, *entity_ids, publisher=True, mapper=map):
     N = 0
     task = partial(_add_entity, publisher=publisher)
-    results = mapper(task, entity_ids)
+    results = _map_requeued(mapper, task, entity_ids)
     if len(entity_ids) > 10:
         results = tqdm(results, total=len(entity_ids))
-    for entity in results:
+    for _, entity in results:
         if entity is None:
             continue
         try:
             proxy = parse_entity(entity)
-            node, is_new = G.add_proxy(proxy)
+            node, is_new = _add_proxy(G, proxy)
             N += int(is_new)
         except InvalidData:
             pass
     return N
 
 
+@metrics.instrument("add_aleph_search")
 def add_aleph_search(G, query, publisher=True, flags=None):
     N = 0
     results = alephclient.search(query, publisher=True)
-    for entity in results:
-        if entity is None:
-            continue
+    for proxy in parse_entities(results):
         try:
-            proxy = parse_entity(entity)
-            node, is_new = G.add_proxy(proxy)
+            node, is_new = _add_proxy(G, proxy)
             if flags:
                 node.set_flags(**flags)
             N += int(is_new)
@@ -178,20 +561,21 @@ def add_aleph_search(G, query, publisher=True, flags=None):
     return N
 
 
+@metrics.instrument("add_aleph_collection")
 def add_aleph_collection(G, foreign_key, include=None, schema=None, publisher=True):
     N = 0
     collection = alephclient.get_collection_by_foreign_id(foreign_key)
     entities = alephclient.stream_entities(
         collection, include=include, schema=schema, publisher=publisher
     )
-    for entity in entities:
-        if entity["id"] not in G:
-            proxy = parse_entity(entity)
-            node, is_new = G.add_proxy(proxy)
-            N += int(is_new)
+    entities = (e for e in entities if e["id"] not in G)
+    for proxy in parse_entities(entities):
+        node, is_new = _add_proxy(G, proxy)
+        N += int(is_new)
     return N
 
 
+@metrics.instrument("add_list")
 def add_list(G, list_id, flag):
     N = 0
     for item in alephclient.entitysetitems(list_id, publisher=True):
@@ -200,12 +584,13 @@ def add_list(G, list_id, flag):
         entity = item["entity"]
         entity["added_by_id"] = item["added_by_id"]
         proxy = parse_entity(entity)
-        node, is_new = G.add_proxy(proxy)
+        node, is_new = _add_proxy(G, proxy)
         G.get_node_by_proxy(proxy).set_flags(**{flag: True})
         N += int(is_new)
     return N
 
 
+@metrics.instrument("add_lists")
 def add_lists(G, foreign_id):
     collection = alephclient.get_collection_by_foreign_id(foreign_id)
     lists = alephclient.entitysets(collection["id"], set_types=["list"])
@@ -223,6 +608,7 @@ def add_lists(G, foreign_id):
     return N
 
 
+@metrics.instrument("enrich_xref")
 def enrich_xref(
     G,
     foreign_id,
@@ -231,16 +617,26 @@ def enrich_xref(
     match_schemata=None,
     min_score=0.5,
     skip_unknown_entities=True,
+    resolve_schema=False,
 ):
+    """
+    Merges the graph's entities with their xref matches. Matches are
+    collected into connected components first, while the next xref pages
+    are fetched in the background, and then applied in one bulk merge pass.
+    With `resolve_schema`, components whose schemata have no common schema
+    are skipped as a whole instead of being merged as far as they go.
+    """
     if entity_schemata:
         entity_schema = model.get(entity_schemata)
     if match_schemata:
         match_schema = model.get(match_schemata)
     collection = alephclient.get_collection_by_foreign_id(foreign_id)
     collection_id = collection["id"]
-    xrefs = alephclient.get_collection_xref(collection_id, publisher=True)
+    xrefs = _alephget_xrefs(alephclient, collection_id)
     N = 0
-    for xref in tqdm(xrefs):
+    proxies = {}
+    components = DisjointSet()
+    for xref in tqdm(prefetch(xrefs)):
         if xref["score"] < min_score:
             log.debug(
                 f"Stoping xref enrichment due to low xref score: {xref['score']} < {min_score}"
@@ -267,83 +663,225 @@ def enrich_xref(
                 f"Match is not the right schema: {match_schema}: {match_proxy.schema}"
             )
             continue
-        try:
-            G.add_proxy(entity_proxy)
-            G.add_proxy(match_proxy)
-            G.merge_proxies(entity_proxy, match_proxy)
-        except InvalidData:
-            pass
+        for proxy in (entity_proxy, match_proxy):
+            proxies.setdefault(proxy.id, proxy)
+            if proxy.id not in components:
+                components.add(proxy.id, proxy.id)
+        components.union(components[entity_proxy.id], components[match_proxy.id])
         N += 1
+    _merge_components(G, proxies, components, resolve_schema=resolve_schema)
     return N
 
 
-def _enrich_similar(item, min_score):
-    try:
-        name, properties = item
-        data = {
-            "schema": name,
-            "properties": properties,
-        }
-        matches = alephclient.match(data, publisher=True)
-        data = []
-        for match in matches:
-            if match["score"] <= min_score:
-                break
-            data.append(match)
-        return data
-    except AlephException as e:
-        log.warning(f"Aleph Exception: {e}")
-        return None
-    except Exception:
-        log.exception("General enrich Exception")
-        return None
+def _merge_components(G, proxies, components, resolve_schema=False):
+    groups = {}
+    for proxy_id in components:
+        groups.setdefault(components[proxy_id], []).append(proxies[proxy_id])
+    with G.bulk():
+        for group in tqdm(groups.values()):
+            if resolve_schema:
+                try:
+                    reduce(model.common_schema, (p.schema for p in group))
+                except InvalidData as e:
+                    log.debug(f"No common schema for xref component: {e}")
+                    continue
+            nodes = {}
+            for proxy in group:
+                try:
+                    node, _ = _add_proxy(G, proxy)
+                except InvalidData:
+                    continue
+                nodes[node.id] = node
+            nodes = list(nodes.values())
+            if not nodes:
+                continue
+            left = nodes[0]
+            for right in nodes[1:]:
+                try:
+                    left = G.merge_nodes(left, right)
+                except InvalidData:
+                    pass
+
 
+def _match_key(fingerprint):
+    return f"{alephclient.cache_scope}:match:{fingerprint}"
 
-def enrich_similar(G, min_score=120, mapper=map):
+
+def _match_fingerprint(node):
+    """
+    Returns a fingerprint of the node's schema and normalized matchable
+    property values, and the matchable properties to send to `match`.
+    Entity references and `MATCH_IGNORE_PROPS` are left out.
+    """
+    properties, normalized = {}, []
+    for name, values in sorted(node.properties.items()):
+        prop = node.schema.get(name)
+        if prop is None or not prop.matchable or prop.type == registry.entity:
+            continue
+        if name in MATCH_IGNORE_PROPS or not values:
+            continue
+        properties[name] = sorted(set(values))
+        normalized.append(
+            (name, sorted({" ".join(str(v).split()).casefold() for v in values}))
+        )
+    payload = json.dumps([node.schema.name, normalized], ensure_ascii=False)
+    return sha1(payload.encode("utf8")).hexdigest(), properties
+
+
+def _enrich_similar(item):
+    fingerprint, (name, properties) = item
+    data = {
+        "schema": name,
+        "properties": properties,
+    }
+    return list(alephclient.match(data, publisher=True))
+
+
+def _add_matches(G, node, matches, min_score):
     N = 0
-    nodes = list(
-        node for node in G.nodes(aleph_enrich_similar=None) if node.schema.matchable
-    )
-    task = partial(_enrich_similar, min_score=min_score)
-    task_args = ((n.schema.name, n.properties) for n in nodes)
-    results = zip(nodes, mapper(task, task_args))
-    for node, matches in tqdm(results, total=len(nodes)):
-        if matches is None:
+    for match in matches:
+        if match["score"] <= min_score:
+            break
+        match_proxy = parse_entity(match)
+        try:
+            node, is_new = _add_proxy(G, match_proxy, node_id=node.id)
+        except InvalidData:
             continue
-        for match in matches:
-            match_proxy = parse_entity(match)
-            try:
-                node, is_new = G.add_proxy(match_proxy, node_id=node.id)
-            except InvalidData:
-                pass
-                # G.add_proxy(match_proxy)
-                # link = model.make_entity("UnknownLink")
-                # for p in node.parts:
-                #    link.add("subject", p)
-                # link.add("object", match_proxy.id)
-                # link.make_id(*node.parts, match_proxy.id)
-                # _, is_new = G.add_proxy(link)
-            N += int(is_new)
-        node.set_flags(aleph_enrich_similar=True)
+            # G.add_proxy(match_proxy)
+            # link = model.make_entity("UnknownLink")
+            # for p in node.parts:
+            #    link.add("subject", p)
+            # link.add("object", match_proxy.id)
+            # link.make_id(*node.parts, match_proxy.id)
+            # _, is_new = G.add_proxy(link)
+        N += int(is_new)
+    return node, N
+
+
+@metrics.instrument("enrich_similar")
+def enrich_similar(G, min_score=120, mapper=map, cache=None):
+    """
+    Adds the `match` results scoring above `min_score` to the matchable
+    nodes whose payload changed since they were last matched. Nodes are
+    fingerprinted by their normalized matchable properties (see
+    `_match_fingerprint`) and skipped while their fingerprint is the one
+    recorded in `aleph_enrich_similar_fingerprint`, the fingerprint of the
+    payload last sent for them. Nodes gaining parts or properties, e.g. by
+    merges, are thus matched again. Nodes sharing a fingerprint are matched
+    with a single request and results are kept per fingerprint in `cache`
+    (the Aleph response cache by default).
+    """
+    if cache is None:
+        cache = aleph_cache
+    groups, payloads = {}, {}
+    for node in list(G.nodes()):
+        if not node.schema.matchable:
+            continue
+        fingerprint, properties = _match_fingerprint(node)
+        if node.flags.get("aleph_enrich_similar_fingerprint") == fingerprint:
+            node.set_flags(aleph_enrich_similar=True)
+            continue
+        # Nodes are looked up again by a proxy id when their matches are
+        # added, as earlier matches may have merged them into another node
+        groups.setdefault(fingerprint, []).append(node.parts[0])
+        payloads.setdefault(fingerprint, (node.schema.name, properties))
+    cached = cache.get_many([_match_key(f) for f in groups])
+    metrics.incr("aleph.match_cache_hits", len(cached))
+    results = [(f, cached[_match_key(f)]) for f in groups if _match_key(f) in cached]
+    task_args = [(f, payloads[f]) for f in groups if _match_key(f) not in cached]
+    fetched = _map_requeued(mapper, _enrich_similar, task_args)
+    fetched = ((f, matches) for (f, _), matches in fetched)
+    N = 0
+    for fingerprint, matches in tqdm(chain(results, fetched), total=len(groups)):
+        if _match_key(fingerprint) not in cached:
+            cache.store(_match_key(fingerprint), matches, ttl=ALEPH_CACHE_TTLS["match"])
+        done = set()
+        for proxy_id in groups[fingerprint]:
+            if proxy_id not in G:
+                continue
+            node = G.get_node_by_proxy_id(proxy_id)
+            if node.id in done:
+                continue
+            node, n = _add_matches(G, node, matches, min_score)
+            N += n
+            done.add(node.id)
+            node.set_flags(
+                aleph_enrich_similar=True,
+                aleph_enrich_similar_fingerprint=fingerprint,
+            )
     return N
 
 
-def _expand(pids, filters):
-    try:
-        q_parts = [f"entities:{pid}" for pid in pids]
-        edges = aleph_get_qparts(
+def _expand_items(nodes, batch_size, filters):
+    """
+    Yields a work item `(batch, pids)` per query to make for `nodes`: the
+    proxy ids of several nodes are grouped about `batch_size` at a time and
+    packed into as few queries as the URL length allows. `batch` holds the
+    indices of the nodes whose proxy ids the query asks for, `pids`.
+    """
+    for batch, parts in _batch_parts(nodes, batch_size):
+        q_parts = [f"entities:{pid}" for pid in parts]
+        for pack in _pack_qparts(
             alephclient, "entities", q_parts, filters=filters, merge="or"
-        )
-        return list(edges)
-    except AlephException as e:
-        log.critical(f"Aleph Exception: {len(q_parts)} query parts: {e}")
-        return None
-    except Exception:
-        log.exception("General expand exception")
-        return None
+        ):
+            yield batch, tuple(q[len("entities:") :] for q in pack)
 
 
-def expand(G, schematas=("Interval", "Thing"), filters=None, mapper=map):
+def _expand(item, filters):
+    """Fetches the edges of the proxy ids of a work item, see `_expand_items`"""
+    _, pids = item
+    q_parts = [f"entities:{pid}" for pid in pids]
+    url = _make_url_qparts(
+        alephclient, "entities", q_parts, filters=filters, merge="or"
+    )
+    return list(_alephget(alephclient, url))
+
+
+def _add_expanded(G, nodes, item, edges, done, flag):
+    """
+    Adds the edges fetched for a work item and records its proxy ids in
+    `done`. The nodes of the item whose proxy ids were all fetched by now are
+    flagged. Returns the number of new proxies and the newly flagged nodes.
+    """
+    batch, pids = item
+    N = _add_edges(G, edges)
+    done.update(pids)
+    flagged = []
+    for i in batch:
+        node = nodes[i]
+        if not node.flags.get(flag) and done.issuperset(node.parts):
+            node.set_flags(**{flag: True})
+            flagged.append(node)
+    return N, flagged
+
+
+def _batch_parts(nodes, batch_size):
+    """
+    Groups node indices so that each group has about `batch_size` proxy ids
+    to query for. A node is never split across groups.
+    """
+    batch, parts = [], []
+    for i, node in enumerate(nodes):
+        batch.append(i)
+        parts.extend(node.parts)
+        if len(parts) >= batch_size:
+            yield tuple(batch), parts
+            batch, parts = [], []
+    if batch:
+        yield tuple(batch), parts
+
+
+@metrics.instrument("expand")
+def expand(
+    G, schematas=("Interval", "Thing"), filters=None, mapper=map, batch_size=50
+):
+    """
+    Fetches the edges of every node not expanded yet. The proxy ids of
+    several nodes are queried together, about `batch_size` at a time, and
+    packed into as few queries as the URL length allows. A node is only
+    flagged once every query holding its proxy ids succeeded; failed queries
+    are requeued (see `_map_requeued`).
+    """
     if isinstance(schematas, str):
         schematas = [schematas]
     filters = filters or []
@@ -351,16 +889,178 @@ def expand(G, schematas=("Interval", "Thing"), filters=None, mapper=map):
     flag = f'aleph_expand_{"_".join(schematas)}'
     nodes = list(node for node in G.nodes(**{flag: None}) if not node.schema.edge)
     task = partial(_expand, filters=filters)
-    task_args = (n.parts for n in nodes)
+    items = list(_expand_items(nodes, batch_size, filters))
+    N, done = 0, set()
+    results = _map_requeued(mapper, task, items)
+    for item, edges in tqdm(results, total=len(items)):
+        N += _add_expanded(G, nodes, item, edges, done, flag)[0]
+    return N
+
+
+def _add_edges(G, edges):
     N = 0
-    results = zip(nodes, mapper(task, task_args))
-    for node, edges in tqdm(results, total=len(nodes)):
-        if edges is None:
-            continue
-        for edge in edges:
-            if edge["id"] not in G:
-                log.debug(f"Adding edge: {edge}")
-                result = G.add_proxies(parse_nested(edge))
-                N += sum(int(is_new) for _, is_new in result)
-        node.set_flags(**{flag: True})
+    for edge in edges:
+        if edge["id"] not in G:
+            log.debug(f"Adding edge: {edge}")
+            result = [_add_proxy(G, proxy) for proxy in parse_nested(edge)]
+            N += sum(int(is_new) for _, is_new in result)
+    return N
+
+
+def degree_score(G, node):
+    """Frontier score preferring nodes with few known edges, so hubs go last"""
+    return -sum(1 for _ in G.get_node_edges(node))
+
+
+def _entity_neighbors(G, node):
+    """
+    Nodes one entity hop away. Edge entities such as ownerships are nodes of
+    their own, so they are stepped over to the entities they connect.
+    """
+    for neighbor in G.get_node_neighborhood(node):
+        if neighbor.schema.edge:
+            for other in G.get_node_neighborhood(neighbor):
+                if other.id != node.id:
+                    yield other
+        else:
+            yield neighbor
+
+
+def _budgeted_expand(context, stopping, filters, item):
+    """
+    Runs `_expand` in a copy of `context`, which holds the request budget,
+    unless the expansion is `stopping`. Returns None for the items skipped
+    or cut short by the budget.
+    """
+    if stopping.is_set():
+        return None
+    try:
+        return context.copy().run(_expand, item, filters)
+    except _BudgetExhausted:
+        return None
+
+
+@metrics.instrument("expand_frontier")
+def expand_frontier(
+    G,
+    nodes,
+    max_depth=2,
+    max_requests=None,
+    max_nodes=None,
+    max_time=None,
+    score=degree_score,
+    schematas=("Interval", "Thing"),
+    filters=None,
+    mapper=map,
+    batch_size=50,
+):
+    """
+    Expands the neighbourhood of `nodes` hop by hop up to `max_depth`. Each
+    level's frontier is ordered by `score(G, node)`, highest first, and its
+    queries are batched like in `expand`. Expansion stops once `max_requests`
+    requests were sent to Aleph (`next` pages and retries included, cached
+    responses not), `max_nodes` nodes were added or `max_time` seconds have
+    passed. Queries running by then still have their results added, queries
+    cut short by the request budget and the ones not started are dropped,
+    and frontier nodes that weren't reached stay unflagged. Nodes already
+    expanded aren't fetched again but their known neighbours still join the
+    next frontier.
+    """
+    if isinstance(schematas, str):
+        schematas = [schematas]
+    filters = list(filters or [])
+    filters.extend(("schemata", schemata) for schemata in schematas)
+    flag = f'aleph_expand_{"_".join(schematas)}'
+    budget = _RequestBudget(max_requests)
+    context = contextvars.copy_context()
+    context.run(_request_budget.set, budget)
+    stopping = threading.Event()
+    task = partial(_budgeted_expand, context, stopping, filters)
+    start_time = time.monotonic()
+    start_nodes = G.n_nodes
+
+    def exhausted():
+        if budget.exhausted:
+            return "requests"
+        if max_nodes is not None and G.n_nodes - start_nodes >= max_nodes:
+            return "nodes"
+        if max_time is not None and time.monotonic() - start_time >= max_time:
+            return "time"
+        return None
+
+    N = 0
+    seen = {node.id for node in nodes}
+    frontier = [node for node in nodes if not node.schema.edge]
+    depth, reason = 0, None
+    while frontier and depth < max_depth:
+        reason = exhausted()
+        if reason:
+            break
+        frontier.sort(key=lambda node: score(G, node), reverse=True)
+        todo = [node for node in frontier if not node.flags.get(flag)]
+        expanded = [node for node in frontier if node.flags.get(flag)]
+        items = list(_expand_items(todo, batch_size, filters))
+        done = set()
+        results = _map_requeued(mapper, task, items)
+        for item, edges in tqdm(results, total=len(items)):
+            if edges is None:
+                continue
+            n, flagged = _add_expanded(G, todo, item, edges, done, flag)
+            N += n
+            expanded.extend(flagged)
+            if exhausted():
+                stopping.set()
+        reason = exhausted()
+        depth += 1
+        if reason:
+            break
+        frontier = []
+        for node in expanded:
+            for neighbor in _entity_neighbors(G, node):
+                if neighbor.id not in seen and not neighbor.schema.edge:
+                    seen.add(neighbor.id)
+                    frontier.append(neighbor)
+    log.info(
+        f"Frontier expansion reached depth {depth} with {budget.used} requests, "
+        f"{G.n_nodes - start_nodes} new nodes (stopped by: {reason or 'depth'})"
+    )
+    return None
+
+    N = 0
+    seen = {node.id for node in nodes}
+    frontier = [node for node in nodes if not node.schema.edge]
+    depth, reason = 0, None
+    while frontier and depth < max_depth:
+        reason = exhausted()
+        if reason:
+            break
+        frontier.sort(key=lambda node: score(G, node), reverse=True)
+        todo = [node for node in frontier if not node.flags.get(flag)]
+        expanded = [node for node in frontier if node.flags.get(flag)]
+        items = list(_expand_items(todo, batch_size, filters))
+        if max_requests is not None:
+            items = items[: max_requests - n_requests]
+        n_requests += len(items)
+        done = set()
+        results = _map_requeued(mapper, task, items)
+        for item, edges in tqdm(results, total=len(items)):
+            n, flagged = _add_expanded(G, todo, item, edges, done, flag)
+            N += n
+            expanded.extend(flagged)
+            reason = exhausted()
+            if reason in ("nodes", "time"):
+                break
+        depth += 1
+        frontier = []
+        for node in expanded:
+            for neighbor in _entity_neighbors(G, node):
+                if neighbor.id not in seen and not neighbor.schema.edge:
+                    seen.add(neighbor.id)
+                    frontier.append(neighbor)
+        if reason in ("nodes", "time"):
+            break
+    log.info(
+        f"Frontier expansion reached depth {depth} with {n_requests} queries, "
+        f"{G.n_nodes - start_nodes} new nodes (stopped by: {reason or 'depth'})"
+    )
     return N
@@ -39,7 +39,7 @@ def export_graphml(G, filename, exclude_schemas=None, slim=False):
                     **{p: values[0] for p, values in node.properties.items()},
                 }
             )
-            data.pop("role")
+            data.pop("role", None)
         H.add_node(
             node.id,
             label=get_node_label(node),
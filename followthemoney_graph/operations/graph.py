@@ -1,7 +1,7 @@
 import networkx as nx
 from tqdm.autonotebook import tqdm
 
-from ..entity_graph import EntityGraph
+from ..backends.view import EntityGraphView
 from ..node import Node
 
 
@@ -15,46 +15,111 @@ def find_subgraphs_like(G, match, exact=True):
         G.network, match.network, node_match=match_fxn
     )
     for result in matcher.subgraph_isomorphisms_iter():
-        yield {mid: G.get_node(nid) for nid, mid in result.items()}
+        yield {match._ids[mid]: G._get_node(nid) for nid, mid in result.items()}
 
 
 def paths(G, source_nodes, target_nodes, max_length=None):
     graph = G.network
-    target_nodes = tuple(target_nodes)
+    target_keys = tuple(G._node_key(n.id) for n in target_nodes)
     for source_node in tqdm(source_nodes):
+        source_key = G._node_key(source_node.id)
         shortest_length = max_length
-        for target_node in target_nodes:
+        for target_key in target_keys:
             try:
-                path = nx.shortest_path(graph, source_node.id, target_node.id)
+                path = nx.shortest_path(graph, source_key, target_key)
                 if shortest_length is None or len(path) < shortest_length:
-                    yield [G.get_node(nid) for nid in path]
+                    yield [G._get_node(nid) for nid in path]
             except nx.NetworkXNoPath:
                 continue
 
 
+def connected_components(G):
+    """
+    Returns the connected components of G as lists of node ids. Backends
+    that compute components themselves (`get_components`) are used as is,
+    otherwise the edges are folded into a union-find over node ids.
+    """
+    if hasattr(G, "get_components"):
+        return [[node.id for node in group] for group in G.get_components()]
+    parent = {}
+
+    def find(item):
+        root = item
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while item != root:
+            parent[item], item = root, parent.get(item, item)
+        return root
+
+    for source, target, _, _ in G.edges():
+        source, target = find(source), find(target)
+        if source != target:
+            parent[source] = target
+    groups = {}
+    for node in G.nodes():
+        groups.setdefault(find(node.id), []).append(node.id)
+    return list(groups.values())
+
+
+def _degrees(G):
+    """
+    Returns `{node_key: degree}` counting self-loops twice, from the
+    backend's vectorized `get_degrees` where it has one.
+    """
+    lookup = G._ids.lookup
+    if hasattr(G, "get_degrees"):
+        return {lookup(node_id): d for node_id, d in G.get_degrees().items()}
+    node_keys = (lookup(node.id) for node in G.nodes())
+    return {node_key: len(_neighbours(G, node_key)) for node_key in node_keys}
+
+
+def _neighbours(G, node_key):
+    """
+    Returns the neighbour keys of `node_key` with one entry per edge,
+    counting self-loops twice.
+    """
+    neighbours = []
+    for _, other, _, _ in G._get_node_edges(node_key):
+        neighbours.append(other)
+        if other == node_key:
+            neighbours.append(other)
+    return neighbours
+
+
+def _subgraph(G, node_keys, copy):
+    view = EntityGraphView(G, node_keys)
+    return view.materialize() if copy else view
+
+
 def filter_kcore(G, k, copy=False):
-    network = G.network
-    for i in range(k):
-        degree = network.degree()
-        network = network.subgraph([e for e, d in degree if d >= i + 1])
-    if copy:
-        network = network.copy()
-    return EntityGraph.from_networkx(network)
+    """
+    Keeps the k-core of G: the largest subgraph whose nodes all have at least
+    `k` edges within it. Returns a view of G, or a separate graph with `copy`.
+    Only degrees are held for the whole graph, neighbours are looked up for
+    the nodes being peeled off.
+    """
+    degree = _degrees(G)
+    removed = {node_key for node_key, d in degree.items() if d < k}
+    queue = list(removed)
+    while queue:
+        for other in _neighbours(G, queue.pop()):
+            if other in removed:
+                continue
+            degree[other] -= 1
+            if degree[other] < k:
+                removed.add(other)
+                queue.append(other)
+    return _subgraph(G, (n for n in degree if n not in removed), copy)
 
 
 def filter_degree_range(G, degree_range, copy=False):
-    degree = G.network.degree()
-    network = G.network.subgraph(
-        [
-            e
-            for e, d in degree
-            if (degree_range[0] is None or d >= degree_range[0])
-            and (degree_range[1] is None or d < degree_range[1])
-        ]
-    )
-    if copy:
-        network = network.copy()
-    return EntityGraph.from_networkx(network)
+    low, high = degree_range
+    node_keys = [
+        node_key
+        for node_key, degree in _degrees(G).items()
+        if (low is None or degree >= low) and (high is None or degree < high)
+    ]
+    return _subgraph(G, node_keys, copy)
 
 
 def filter_degree_min(G, min_degree, copy=False):
@@ -66,15 +131,12 @@ def filter_degree_max(G, max_degree, copy=False):
 
 
 def filter_component_size(G, size_range, copy=False):
-    components = nx.algorithms.components.weakly_connected_components(G.network)
-    nodes = set()
-    for component in components:
+    lookup = G._ids.lookup
+    node_keys = []
+    for component in connected_components(G):
         N = len(component)
         if (size_range[0] is None or N >= size_range[0]) and (
             size_range[1] is None or N < size_range[1]
         ):
-            nodes.update(component)
-    subgraph = G.network.subgraph(nodes)
-    if copy:
-        subgraph = subgraph.copy()
-    return EntityGraph.from_networkx(subgraph)
+            node_keys.extend(map(lookup, component))
+    return _subgraph(G, node_keys, copy)
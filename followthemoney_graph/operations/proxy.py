@@ -5,8 +5,6 @@ from collections import defaultdict
 from followthemoney import model
 from tqdm.autonotebook import tqdm
 
-from ..lib import EntityGraphTracker
-
 
 log = logging.getLogger(__name__)
 
@@ -31,21 +29,20 @@ def add_entities_from_file(G, fd):
 
 
 def merge_properties(G, properties=None):
-    with EntityGraphTracker(G) as G:
+    with G.track_changes() as checkpoint:
         properties = set(properties or [])
         dedupe_table = defaultdict(set)
-        for canon_id, data in tqdm(G.get_nodes(), total=G.n_nodes):
-            for prop, values in data.get_type_inverted().items():
+        for node in tqdm(G.nodes(), total=G.n_nodes):
+            for prop, values in node.get_type_inverted().items():
                 if properties and prop not in properties:
                     continue
                 for value in values:
                     key = f"{prop}:{value}"
-                    dedupe_table[key].add(canon_id)
-        id_change_lookup = {}
-        for key, canon_ids in tqdm(dedupe_table.items()):
-            canon_ids = {id_change_lookup.get(cid, cid) for cid in canon_ids}
-            if len(canon_ids) > 1:
-                log.debug(f"Merging items: {key}: {len(canon_ids)}")
-                canon_id_new = G.merge_nodes_canonicals(*canon_ids)
-                id_change_lookup.update({cid: canon_id_new for cid in canon_ids})
-        return G.get_changes()
+                    dedupe_table[key].add(node.id)
+        with G.bulk():
+            for key, node_ids in tqdm(dedupe_table.items()):
+                nodes = {n.id: n for n in map(G.get_node, node_ids)}
+                if len(nodes) > 1:
+                    log.debug(f"Merging items: {key}: {len(nodes)}")
+                    G.merge_nodes(*nodes.values())
+        return G.get_changes(checkpoint)
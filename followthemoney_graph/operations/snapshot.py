@@ -0,0 +1,223 @@
+import json
+import logging
+import mmap
+import struct
+
+import numpy as np
+from followthemoney import model
+from tqdm.autonotebook import tqdm
+
+from ..loader import json_loads
+from ..node import Node
+
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"FTMGSNAP"
+VERSION = 1
+SECTIONS = (
+    "id_indptr",
+    "id_data",
+    "node_ids",
+    "node_flags",
+    "node_proxy_indptr",
+    "proxy_ids",
+    "proxy_indptr",
+    "proxy_data",
+    "stub_ids",
+    "edges",
+    "flag_indptr",
+    "flag_data",
+    "edge_data_indptr",
+    "edge_data_data",
+)
+HEADER = struct.Struct("<8sQQ")
+SECTION = struct.Struct("<QQ")
+ALIGN = 8
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class _Table(object):
+    """Dedupes values into a list and hands out their positions"""
+
+    def __init__(self, encode=None):
+        self.encode = encode
+        self.keys = {}
+        self.values = []
+
+    def add(self, value):
+        ident = value if self.encode is None else self.encode(value)
+        key = self.keys.get(ident)
+        if key is None:
+            key = len(self.values)
+            self.keys[ident] = key
+            self.values.append(ident)
+        return key
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def _blob(values):
+    """Packs a list of strings into (indptr, data) sections"""
+    data = [v.encode("utf8") for v in values]
+    indptr = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(d) for d in data], out=indptr[1:])
+    return indptr, b"".join(data)
+
+
+def _int64(values):
+    return np.asarray(values, dtype=np.int64)
+
+
+def write_snapshot(G, fd):
+    """
+    Writes G to the binary file object `fd`. Strings (proxy and node ids),
+    proxy payloads, flag sets and edge data are each stored once in their own
+    section and referenced by position; the node to parts mapping and the
+    edge list are flat int64 arrays so loading doesn't rebuild them.
+    """
+    if G._bulk_pending is not None:
+        raise SnapshotError("Can't snapshot a graph inside bulk()")
+    ids = _Table()
+    flags = _Table(encode=_dumps)
+    edge_data = _Table(encode=_dumps)
+    node_ids, node_flags, node_proxy_indptr = [], [], [0]
+    proxy_ids, proxy_data = [], []
+    for node in tqdm(G.nodes(), total=G.n_nodes):
+        node_ids.append(ids.add(node.id))
+        node_flags.append(flags.add(node.flags))
+        for proxy in node.proxies:
+            proxy_ids.append(ids.add(proxy.id))
+            proxy_data.append(_dumps(proxy.to_dict()))
+        node_proxy_indptr.append(len(proxy_ids))
+    stub_ids = [ids.add(G._ids[key]) for key in G._stub_proxies]
+    edges = [
+        (ids.add(source), ids.add(target), ids.add(key), edge_data.add(data))
+        for source, target, key, data in tqdm(G.edges(), total=G.n_edges)
+    ]
+
+    id_indptr, id_data = _blob(ids.values)
+    proxy_indptr, proxy_data = _blob(proxy_data)
+    flag_indptr, flag_data = _blob(flags.values)
+    edge_data_indptr, edge_data_data = _blob(edge_data.values)
+    sections = {
+        "id_indptr": id_indptr,
+        "id_data": id_data,
+        "node_ids": _int64(node_ids),
+        "node_flags": _int64(node_flags),
+        "node_proxy_indptr": _int64(node_proxy_indptr),
+        "proxy_ids": _int64(proxy_ids),
+        "proxy_indptr": proxy_indptr,
+        "proxy_data": proxy_data,
+        "stub_ids": _int64(stub_ids),
+        "edges": _int64(edges).reshape(len(edges), 4),
+        "flag_indptr": flag_indptr,
+        "flag_data": flag_data,
+        "edge_data_indptr": edge_data_indptr,
+        "edge_data_data": edge_data_data,
+    }
+    payloads = [
+        s if isinstance(s, bytes) else s.tobytes() for s in map(sections.get, SECTIONS)
+    ]
+    offset = HEADER.size + SECTION.size * len(SECTIONS)
+    table = []
+    for payload in payloads:
+        offset += -offset % ALIGN
+        table.append((offset, len(payload)))
+        offset += len(payload)
+
+    fd.write(HEADER.pack(MAGIC, VERSION, len(SECTIONS)))
+    for entry in table:
+        fd.write(SECTION.pack(*entry))
+    position = HEADER.size + SECTION.size * len(SECTIONS)
+    for (offset, _), payload in zip(table, payloads):
+        fd.write(b"\0" * (offset - position))
+        fd.write(payload)
+        position = offset + len(payload)
+
+
+class _Sections(object):
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, version, n_sections = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise SnapshotError("Not an EntityGraph snapshot")
+        if version != VERSION or n_sections != len(SECTIONS):
+            raise SnapshotError(f"Unsupported snapshot version: {version}")
+        self.table = {
+            name: SECTION.unpack_from(buffer, HEADER.size + SECTION.size * i)
+            for i, name in enumerate(SECTIONS)
+        }
+
+    def array(self, name):
+        offset, length = self.table[name]
+        return np.frombuffer(
+            self.buffer, dtype=np.int64, count=length // 8, offset=offset
+        )
+
+    def strings(self, name):
+        indptr = self.array(f"{name}_indptr")
+        offset, _ = self.table[f"{name}_data"]
+        buffer = self.buffer
+        for start, end in zip(indptr[:-1].tolist(), indptr[1:].tolist()):
+            yield buffer[offset + start : offset + end]
+
+
+def read_snapshot(G, fd):
+    """
+    Loads the snapshot in the binary file object `fd` into the empty graph
+    G. The file is memory-mapped and nodes, canonical mapping, stubs and
+    edges are attached directly, without going through `add_proxy` or
+    `connect_edges`. The mapping is closed once the graph is loaded.
+    """
+    with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        # The arrays viewing the buffer must be gone before it can be closed
+        return _read_sections(G, _Sections(buffer))
+
+
+def _read_sections(G, sections):
+    strings = [s.decode("utf8") for s in sections.strings("id")]
+    keys = [G._ids.intern(s) for s in strings]
+    if keys and isinstance(keys[0], str):
+        # Backends keyed by the string ids themselves, see IdentityInterner
+        remap = np.array(keys, dtype=object)
+    else:
+        remap = _int64(keys)
+    flags = [json_loads(f) for f in sections.strings("flag")]
+    edge_data = [json_loads(d) for d in sections.strings("edge_data")]
+
+    node_ids = sections.array("node_ids")
+    node_flags = sections.array("node_flags").tolist()
+    node_proxy_indptr = sections.array("node_proxy_indptr").tolist()
+    proxy_keys = remap[sections.array("proxy_ids")].tolist()
+    proxy_data = sections.strings("proxy")
+    canonical = G._id_to_canonical
+    with G.bulk():
+        for i, node_id in enumerate(tqdm(node_ids.tolist(), total=len(node_ids))):
+            start, end = node_proxy_indptr[i], node_proxy_indptr[i + 1]
+            proxies = [
+                model.get_proxy(json_loads(next(proxy_data)))
+                for _ in range(start, end)
+            ]
+            node = Node(
+                id=strings[node_id], proxies=proxies, flags=dict(flags[node_flags[i]])
+            )
+            node_key = G._attach_node(node)
+            for proxy_key in proxy_keys[start:end]:
+                canonical.add(proxy_key, node_key)
+        for stub_key in remap[sections.array("stub_ids")].tolist():
+            G._stub_proxies.add(stub_key)
+        edges = sections.array("edges").reshape(-1, 4)
+        G._add_edges(
+            remap[edges[:, 0]],
+            remap[edges[:, 1]],
+            remap[edges[:, 2]],
+            edges[:, 3],
+            edge_data,
+        )
+    return G
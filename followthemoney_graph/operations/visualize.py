@@ -38,7 +38,7 @@ def show_entity_graph(G):
     pos = nx.fruchterman_reingold_layout(G.network)
     fig = plt.figure()
 
-    node_labels = {node: get_node_label(node) for node in G.nodes()}
+    node_labels = {G._node_key(node.id): get_node_label(node) for node in G.nodes()}
 
     nx.draw(
         G.network,
@@ -0,0 +1,244 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from followthemoney import model
+
+
+class AlephStub(object):
+    """
+    Local stand-in for the Aleph API endpoints used by `operations.aleph`:
+    entity lookup and search (including `entities:<id>` queries, which also
+    find entities nesting the referenced one), `match`,
+    collection lookup, `xref`, `_stream` and entity sets. It serves the
+    entities, collections, xrefs and entity sets it was given, and any
+    recorded response in `responses` (keyed by path and query string)
+    takes precedence. Every request waits `latency` seconds and fails with
+    `error_status` with probability `error_rate`. Use it as a context
+    manager; `url` is the host to configure the client with.
+    """
+
+    def __init__(
+        self,
+        entities=(),
+        collections=(),
+        xrefs=None,
+        entitysets=(),
+        entityset_items=None,
+        responses=None,
+        latency=0,
+        error_rate=0,
+        error_status=503,
+        page_size=50,
+        seed=None,
+    ):
+        self.entities = {e["id"]: e for e in entities}
+        self.collections = list(collections)
+        self.xrefs = xrefs or {}
+        self.entitysets = list(entitysets)
+        self.entityset_items = entityset_items or {}
+        self.responses = responses or {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.page_size = page_size
+        self.requests = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._references = {}
+        for entity in self.entities.values():
+            for values in entity.get("properties", {}).values():
+                for value in values:
+                    if isinstance(value, dict):
+                        value = value.get("id")
+                    if isinstance(value, str) and value in self.entities:
+                        self._references.setdefault(value, []).append(entity)
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._handle(self, "GET")
+
+            def do_POST(self):
+                stub._handle(self, "POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, endpoint):
+        """Number of requests made to paths starting with `endpoint`"""
+        return sum(1 for _, path in self.requests if path.startswith(endpoint))
+
+    def _handle(self, handler, method):
+        parts = urlsplit(handler.path)
+        path = parts.path.split("/api/2/", 1)[-1].strip("/")
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        body = None
+        length = int(handler.headers.get("Content-Length") or 0)
+        if length:
+            body = json.loads(handler.rfile.read(length))
+        with self._lock:
+            self.requests.append((method, path))
+            fail = self.error_rate and self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return self._send(handler, self.error_status, {"message": "Injected"})
+        recorded = self.responses.get(handler.path.split("/api/2/", 1)[-1])
+        if recorded is not None:
+            return self._send(handler, 200, recorded)
+        try:
+            status, data = self._route(method, path, params, body)
+        except KeyError:
+            status, data = 404, {"message": "Not found"}
+        if status == 200 and path.endswith("_stream"):
+            return self._send_lines(handler, data)
+        return self._send(handler, status, data)
+
+    def _route(self, method, path, params, body):
+        segments = path.split("/")
+        filters = {}
+        for key, value in params:
+            if key.startswith("filter:"):
+                filters.setdefault(key[len("filter:") :], []).append(value)
+        if method == "POST" and segments == ["match"]:
+            return 200, {"results": self._match(body)}
+        if segments == ["entities"]:
+            query = dict(params).get("q", "")
+            return 200, self._page(self._search(query, filters), params, path)
+        if segments[0] == "entities" and len(segments) == 2:
+            return 200, self.entities[segments[1]]
+        if segments == ["collections"]:
+            foreign_ids = filters.get("foreign_id", [])
+            results = [c for c in self.collections if c["foreign_id"] in foreign_ids]
+            return 200, self._page(results, params, path)
+        if segments[0] == "collections" and len(segments) == 3:
+            collection_id = segments[1]
+            if segments[2] == "xref":
+                results = self.xrefs[collection_id]
+                return 200, self._page(results, params, path)
+            if segments[2] == "_stream":
+                return 200, [
+                    e
+                    for e in self.entities.values()
+                    if str(e.get("collection_id")) == collection_id
+                ]
+        if segments == ["entitysets"]:
+            collection_ids = filters.get("collection_id", [])
+            types = filters.get("type")
+            results = [
+                s
+                for s in self.entitysets
+                if str(s["collection_id"]) in collection_ids
+                and (types is None or s["type"] in types)
+            ]
+            return 200, self._page(results, params, path)
+        if segments[0] == "entitysets" and segments[2:] == ["items"]:
+            results = self.entityset_items[segments[1]]
+            return 200, self._page(results, params, path)
+        raise KeyError(path)
+
+    def _search(self, query, filters):
+        schematas = [model.get(s) for s in filters.get("schemata", [])]
+        if " AND " in query:
+            merge, parts = all, query.split(" AND ")
+        else:
+            merge, parts = any, query.split(" OR ") if query else []
+        results = []
+        for entity in self.entities.values():
+            schema = model.get(entity["schema"])
+            if schematas and not any(schema.is_a(s) for s in schematas):
+                continue
+            if parts and not merge(self._matches(entity, p) for p in parts):
+                continue
+            results.append(entity)
+        return results
+
+    def _matches(self, entity, part):
+        if part.startswith("entities:"):
+            target = part[len("entities:") :]
+            return entity in self._references.get(target, [])
+        term = part.strip('"').lower()
+        return any(
+            isinstance(v, str) and term in v.lower()
+            for values in entity.get("properties", {}).values()
+            for v in values
+        )
+
+    def _match(self, sample):
+        schema = model.get(sample["schema"])
+        names = {
+            n.lower() for n in sample.get("properties", {}).get("name", [])
+        }
+        results = []
+        for entity in self.entities.values():
+            other = model.get(entity["schema"])
+            if not other.matchable or not (schema.is_a(other) or other.is_a(schema)):
+                continue
+            overlap = names.intersection(
+                n.lower() for n in entity.get("properties", {}).get("name", [])
+            )
+            if overlap:
+                results.append({**entity, "score": 100 + 50 * len(overlap)})
+        return sorted(results, key=lambda r: r["score"], reverse=True)
+
+    def _page(self, results, params, path):
+        single = dict(params)
+        offset = int(single.get("offset", 0))
+        limit = int(single.get("limit", self.page_size))
+        page = {
+            "results": results[offset : offset + limit],
+            "offset": offset,
+            "limit": limit,
+            "total": len(results),
+            "next": None,
+        }
+        if offset + limit < len(results):
+            # filters can repeat, so the other parameters are kept as a list
+            params = [(k, v) for k, v in params if k not in ("offset", "limit")]
+            params += [("offset", offset + limit), ("limit", limit)]
+            page["next"] = f"{self.url}/api/2/{path}?{urlencode(params)}"
+        return page
+
+    def _send(self, handler, status, data):
+        payload = json.dumps(data).encode("utf8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _send_lines(self, handler, entities):
+        payload = b"".join(json.dumps(e).encode("utf8") + b"\n" for e in entities)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
@@ -0,0 +1,291 @@
+import pytest
+from followthemoney import model
+
+from followthemoney_graph.backends.networkx import NetworkxEntityGraph
+from followthemoney_graph.cache import Cache, LRUCache
+from followthemoney_graph.operations import aleph
+from followthemoney_graph.tests.aleph_server import AlephStub
+
+
+COLLECTION = {"id": "1", "foreign_id": "test", "label": "Test"}
+ENTITIES = [
+    {
+        "id": "alice",
+        "schema": "Person",
+        "collection_id": "1",
+        "properties": {"name": ["Alice Smith"]},
+    },
+    {
+        "id": "acme",
+        "schema": "Company",
+        "collection_id": "1",
+        "properties": {"name": ["ACME Inc"]},
+    },
+    {
+        "id": "owns",
+        "schema": "Ownership",
+        "collection_id": "2",
+        "properties": {"owner": ["alice"], "asset": ["acme"]},
+    },
+    {
+        "id": "alice-2",
+        "schema": "Person",
+        "collection_id": "2",
+        "properties": {"name": ["Alice Smith"]},
+    },
+]
+
+
+@pytest.fixture(autouse=True)
+def restore_client():
+    """Puts the module client back the way it was after each test"""
+    client, cache = aleph.alephclient, aleph.aleph_cache
+    settings = dict(aleph._client_settings)
+    yield
+    aleph.alephclient, aleph.aleph_cache = client, cache
+    aleph._client_settings.clear()
+    aleph._client_settings.update(settings)
+
+
+@pytest.fixture
+def stub():
+    with AlephStub(entities=ENTITIES, collections=[COLLECTION], page_size=1) as stub:
+        aleph.aleph_configure(host=stub.url, api_key="test", cache=Cache())
+        yield stub
+
+
+def test_add_aleph_collection(stub):
+    G = NetworkxEntityGraph()
+    assert aleph.add_aleph_collection(G, "test") == 2
+    assert "alice" in G and "acme" in G
+    assert aleph.add_aleph_collection(G, "test") == 0
+
+
+def test_add_aleph_entities(stub):
+    G = NetworkxEntityGraph()
+    assert aleph.add_aleph_entities(G, "alice", "missing") == 1
+    assert "alice" in G
+
+
+def test_expand(stub):
+    G = NetworkxEntityGraph()
+    aleph.add_aleph_collection(G, "test")
+    assert aleph.expand(G, batch_size=1) > 0
+    assert "owns" in G
+    assert stub.count("entities") >= 2
+    n_requests = len(stub.requests)
+    assert aleph.expand(G) == 0
+    assert len(stub.requests) == n_requests
+
+
+def test_expand_partial_failure(stub, monkeypatch):
+    G = NetworkxEntityGraph()
+    aleph.add_aleph_collection(G, "test")
+    alephget = aleph._alephget
+    attempts = []
+
+    def failing_alephget(api, url, *args, **kwargs):
+        if "acme" in url:
+            attempts.append(url)
+            raise aleph.AlephException(url)
+        return alephget(api, url, *args, **kwargs)
+
+    def single_qparts(api, base_url, q_parts, **kwargs):
+        return ([q_part] for q_part in q_parts)
+
+    monkeypatch.setattr(aleph, "_alephget", failing_alephget)
+    monkeypatch.setattr(aleph, "_pack_qparts", single_qparts)
+    monkeypatch.setattr(aleph, "backoff_delays", lambda retries, **kw: [0] * retries)
+    aleph.expand(G, batch_size=2)
+    flag = "aleph_expand_Interval_Thing"
+    assert G.get_node_by_proxy_id("alice").flags.get(flag)
+    assert not G.get_node_by_proxy_id("acme").flags.get(flag)
+    assert len(attempts) == aleph.ALEPH_REQUEUES + 1
+
+
+def test_failed_items_are_requeued(stub, monkeypatch):
+    monkeypatch.setattr(aleph, "backoff_delays", lambda retries, **kw: [0] * retries)
+    get_entity = aleph.alephclient.get_entity
+    failures = {"acme": 2}
+
+    def flaky_get_entity(entity_id, **kwargs):
+        if failures.get(entity_id):
+            failures[entity_id] -= 1
+            raise aleph.AlephException("flaky")
+        return get_entity(entity_id, **kwargs)
+
+    monkeypatch.setattr(aleph.alephclient, "get_entity", flaky_get_entity)
+    G = NetworkxEntityGraph()
+    assert aleph.add_aleph_entities(G, "acme", "alice") == 2
+    assert "acme" in G and "alice" in G
+
+
+def test_expand_nested():
+    newco = {
+        "id": "newco",
+        "schema": "Company",
+        "properties": {"name": ["NewCo"]},
+    }
+    ownership = {
+        "id": "owns-newco",
+        "schema": "Ownership",
+        "collection_id": "2",
+        "properties": {"owner": [dict(ENTITIES[0])], "asset": [newco]},
+    }
+    with AlephStub(entities=ENTITIES[:1] + [ownership]) as stub:
+        aleph.aleph_configure(host=stub.url, api_key="test", cache=Cache())
+        G = NetworkxEntityGraph()
+        aleph.add_aleph_entities(G, "alice")
+        assert aleph.expand(G) == 2
+    assert "owns-newco" in G and "newco" in G
+    link = G.get_node_by_proxy_id("owns-newco")
+    assert link.get("asset") == ["newco"]
+    assert G.get_node_by_proxy_id("newco").get("name") == ["NewCo"]
+    neighbors = {n.id for n in G.get_node_neighborhood(link)}
+    assert neighbors == {"alice", "newco"}
+    assert ownership["properties"]["asset"] == [newco]
+
+
+def test_enrich_xref(stub):
+    acme_2 = {
+        "id": "acme-2",
+        "schema": "Company",
+        "collection_id": "2",
+        "properties": {"name": ["ACME"]},
+    }
+    stub.xrefs = {
+        "1": [
+            {
+                "score": 0.9,
+                "entity": ENTITIES[0],
+                "match": ENTITIES[3],
+                "match_collection": {"collection_id": "2"},
+            },
+            {
+                "score": 0.7,
+                "entity": ENTITIES[1],
+                "match": acme_2,
+                "match_collection": {"collection_id": "3"},
+            },
+            {
+                "score": 0.2,
+                "entity": ENTITIES[1],
+                "match": acme_2,
+                "match_collection": {"collection_id": "2"},
+            },
+        ]
+    }
+    G = NetworkxEntityGraph()
+    aleph.add_aleph_collection(G, "test")
+    assert aleph.enrich_xref(G, "test", match_collection_ids=[2]) == 1
+    assert stub.count("collections/1/xref") == 3
+    assert set(G.get_node_by_proxy_id("alice").parts) == {"alice", "alice-2"}
+    assert "acme-2" not in G
+    assert "alephUrl" in G.get_node_by_proxy_id("alice-2").properties
+
+
+def test_enrich_similar(stub):
+    G = NetworkxEntityGraph()
+    aleph.add_aleph_entities(G, "alice")
+    aleph.enrich_similar(G, min_score=120)
+    node = G.get_node_by_proxy_id("alice")
+    assert "alice-2" in node.parts
+    assert node.flags["aleph_enrich_similar"]
+
+
+def test_errors_are_retried(stub, monkeypatch):
+    monkeypatch.setattr(aleph, "backoff_delays", lambda retries, **kw: iter([0] * retries))
+    stub.error_rate = 1
+    with pytest.raises(aleph.AlephException):
+        aleph.alephclient.get_entity("alice")
+    assert stub.count("entities/alice") == aleph.ALEPH_RETRIES + 1
+
+
+def test_match_and_stream_are_retried(stub, monkeypatch):
+    monkeypatch.setattr(aleph, "backoff_delays", lambda retries, **kw: iter([0] * retries))
+    stub.error_rate = 1
+    G = NetworkxEntityGraph()
+    G.add_proxy(model.get_proxy(ENTITIES[0]))
+    # the failed item is requeued, then left unflagged without failing the run
+    assert aleph.enrich_similar(G) == 0
+    rounds = aleph.ALEPH_REQUEUES + 1
+    assert stub.count("match") == (aleph.ALEPH_RETRIES + 1) * rounds
+    with pytest.raises(aleph.AlephException):
+        list(aleph.alephclient.stream_entities(COLLECTION))
+    assert stub.count("collections/1/_stream") == aleph.ALEPH_RETRIES + 1
+    assert not G.get_node_by_proxy_id("alice").flags.get("aleph_enrich_similar")
+
+
+def test_enrich_similar_fingerprints(stub):
+    cache = LRUCache()
+    G = NetworkxEntityGraph()
+    G.add_proxy(model.get_proxy(ENTITIES[0]))
+    duplicate = model.get_proxy(
+        {"id": "bob", "schema": "Person", "properties": {"name": [" alice  SMITH"]}}
+    )
+    G.add_proxy(duplicate)
+    aleph.enrich_similar(G, min_score=120, cache=cache)
+    assert stub.count("match") == 1
+    # the match for alice merged bob's node too, which is looked up again
+    node = G.get_node_by_proxy_id("bob")
+    assert set(node.parts) == {"alice", "alice-2", "bob"}
+    assert node.flags["aleph_enrich_similar"] is True
+    assert G._flag_index.find(aleph_enrich_similar=None) is not None
+    assert aleph.enrich_similar(G, min_score=120, cache=cache) == 0
+    node.set_flags(aleph_enrich_similar=None)
+    assert aleph.enrich_similar(G, min_score=120, cache=cache) == 0
+    assert node.flags["aleph_enrich_similar"] is True
+    assert stub.count("match") == 1
+
+    # a new part changes the payload, flagged or not
+    renamed = model.get_proxy(
+        {"id": "carol", "schema": "Person", "properties": {"name": ["Carol"]}}
+    )
+    G.add_proxy(renamed, node_id=node.id)
+    sent = node.flags["aleph_enrich_similar_fingerprint"]
+    assert aleph.enrich_similar(G, min_score=120, cache=cache) == 0
+    assert stub.count("match") == 2
+    fingerprint = G.get_node(node.id).flags["aleph_enrich_similar_fingerprint"]
+    assert fingerprint != sent
+    assert fingerprint == aleph._match_fingerprint(G.get_node(node.id))[0]
+
+    G = NetworkxEntityGraph()
+    G.add_proxy(model.get_proxy(ENTITIES[0]))
+    assert aleph.enrich_similar(G, min_score=120, cache=cache) == 1
+    assert "alice-2" in G.get_node_by_proxy_id("alice").parts
+    assert stub.count("match") == 2
+
+
+def test_cache_scope_and_ttls(stub):
+    cache = LRUCache()
+    aleph.aleph_configure(host=stub.url, api_key="a", cache=cache)
+    aleph.alephclient.get_entity("alice")
+    aleph.alephclient.get_entity("alice")
+    assert stub.count("entities/alice") == 1
+    aleph.aleph_configure(host=stub.url, api_key="b", cache=cache)
+    aleph.alephclient.get_entity("alice")
+    assert stub.count("entities/alice") == 2
+
+    url = f"{stub.url}/api/2/collections/1/xref?offset=50"
+    assert aleph._request_ttl(url) == aleph.ALEPH_CACHE_TTLS["collections/<id>/xref"]
+    assert aleph._request_ttl(f"{stub.url}/api/2/collections/1/_stream") is None
+
+
+def test_expand_frontier_request_budget():
+    flag = "aleph_expand_Interval_Thing"
+    owns_2 = dict(ENTITIES[2], id="owns-2")
+    with AlephStub(entities=ENTITIES + [owns_2], page_size=1) as stub:
+        aleph.aleph_configure(host=stub.url, api_key="test", cache=Cache())
+        G = NetworkxEntityGraph()
+        aleph.add_aleph_entities(G, "alice")
+        n_requests = len(stub.requests)
+        # alice's edges come one per page: the budget runs out within the query
+        aleph.expand_frontier(G, list(G.nodes()), max_depth=2, max_requests=1)
+        assert len(stub.requests) - n_requests == 1
+        assert not G.get_node_by_proxy_id("alice").flags.get(flag)
+
+        n_requests = len(stub.requests)
+        aleph.expand_frontier(G, list(G.nodes()), max_depth=2, max_requests=2)
+        assert len(stub.requests) - n_requests == 2
+        assert G.get_node_by_proxy_id("alice").flags.get(flag)
+        assert "owns-2" in G and not G.get_node_by_proxy_id("acme").flags.get(flag)
@@ -0,0 +1,110 @@
+import time
+
+from followthemoney_graph.cache import SQLiteCache, RedisCache, LRUCache, TieredCache
+
+
+def test_sqlite_cache(tmp_path):
+    cache = SQLiteCache(path=str(tmp_path / "cache.sqlite"))
+    assert cache.get("a") is None
+    cache.store("a", {"results": [1, 2]})
+    assert cache.has("a")
+    assert cache.get("a") == {"results": [1, 2]}
+
+    cache.store("b", "value", ttl=0.01)
+    time.sleep(0.02)
+    assert not cache.has("b")
+    assert cache.get("b") is None
+
+    reopened = SQLiteCache(path=cache.path)
+    assert reopened.get("a") == {"results": [1, 2]}
+
+
+def test_sqlite_cache_eviction(tmp_path):
+    cache = SQLiteCache(path=str(tmp_path / "cache.sqlite"), max_size=100)
+    cache.TOUCH_INTERVAL = 0
+    for i in range(10):
+        cache.store(f"key-{i}", "x" * 18)
+        time.sleep(0.001)
+    cache.get("key-0")
+    cache.evict()
+    assert cache.has("key-0")
+    assert not cache.has("key-1")
+    assert cache.has("key-9")
+    assert sum(cache.has(f"key-{i}") for i in range(10)) == 5
+
+
+class MemoryRedis(object):
+    """Just enough of the redis client for RedisCache"""
+
+    def __init__(self):
+        self.data = {}
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.calls += 1
+        return [self.data.get(k) for k in keys]
+
+    def set(self, key, value, ex=None):
+        self.calls += 1
+        self.data[key] = value.encode("utf8")
+
+    def exists(self, key):
+        self.calls += 1
+        return key in self.data
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def setex(self, key, ttl, value):
+        self.commands.append((key, value))
+
+    def execute(self):
+        self.redis.calls += 1
+        for key, value in self.commands:
+            self.redis.data[key] = value.encode("utf8")
+
+
+def test_redis_cache_batches():
+    redis = MemoryRedis()
+    cache = RedisCache(redis=redis)
+    cache.store_many({f"key-{i}": i for i in range(10)})
+    assert cache.get_many(["key-1", "key-5", "missing"]) == {"key-1": 1, "key-5": 5}
+    assert redis.calls == 2
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=10)
+    cache.store("a", "xxx")
+    cache.store("b", "xxx")
+    value = cache.get("a")
+    cache.store("c", "xxx")
+    assert value == "xxx"
+    assert cache.has("a") and cache.has("c") and not cache.has("b")
+    assert cache.size <= 10
+
+
+def test_tiered_cache(tmp_path):
+    redis = MemoryRedis()
+    local = LRUCache()
+    cache = TieredCache(local, RedisCache(redis=redis))
+    RedisCache(redis=redis).store_many({"a": 1, "b": 2})
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+    calls = redis.calls
+    assert cache.get("a") == 1
+    assert local.get_many(["a", "b"]) == {"a": 1, "b": 2}
+    assert redis.calls == calls
+
+    sqlite = SQLiteCache(path=str(tmp_path / "cache.sqlite"))
+    cache = TieredCache(LRUCache(), sqlite)
+    cache.store_many({"a": 1, "b": 2})
+    assert sqlite.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
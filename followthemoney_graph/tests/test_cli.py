@@ -0,0 +1,80 @@
+import json
+
+import pkg_resources
+import pytest
+from click.testing import CliRunner
+
+try:
+    from followthemoney_graph.cli import graph
+except (ImportError, pkg_resources.ResolutionError) as exc:
+    # followthemoney.cli loads the entry points of every installed plugin
+    pytest.skip(f"followthemoney CLI can't be loaded: {exc}", allow_module_level=True)
+
+
+ENTITIES = [
+    {"id": "alice", "schema": "Person", "properties": {"name": ["Alice"]}},
+    {"id": "acme", "schema": "Company", "properties": {"name": ["ACME"]}},
+    {
+        "id": "owns",
+        "schema": "Ownership",
+        "properties": {"owner": ["alice"], "asset": ["acme"]},
+    },
+    {"id": "bob", "schema": "Person", "properties": {"name": ["Bob"]}},
+    {
+        "id": "owns-ghost",
+        "schema": "Ownership",
+        "properties": {"owner": ["bob"], "asset": ["ghost"]},
+    },
+]
+
+
+@pytest.fixture
+def entities(tmp_path):
+    path = tmp_path / "entities.json"
+    path.write_text("".join(json.dumps(e) + "\n" for e in ENTITIES))
+    return str(path)
+
+
+def invoke(*args):
+    result = CliRunner().invoke(graph, [str(a) for a in args], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    return result.stdout
+
+
+@pytest.mark.parametrize("backend", ["networkx", "csr", "sqlite"])
+def test_graph_stats(entities, backend):
+    stats = json.loads(invoke("stats", "-i", entities, "-b", backend))
+    assert stats["proxies"] == 6
+    assert stats["nodes"] == 6
+    assert stats["edges"] == 4
+    assert stats["stubs"] == 1
+    assert stats["components"] == 2
+    assert stats["largest_component"] == 3
+    assert stats["schemata"]["Ownership"] == 2
+
+
+def test_graph_build(entities, tmp_path):
+    path = tmp_path / "graph.snapshot"
+    invoke("build", "-i", entities, "-o", path)
+    assert json.loads(invoke("stats", "-i", path)) == json.loads(
+        invoke("stats", "-i", entities)
+    )
+
+
+def test_graph_components(entities):
+    lines = invoke("components", "-i", entities, "--min-size", 3).splitlines()
+    components = [json.loads(line) for line in lines]
+    assert [c["size"] for c in components] == [3, 3]
+    assert {"alice", "acme", "owns"} in [set(c["nodes"]) for c in components]
+    assert invoke("components", "-i", entities, "--max-size", 2) == ""
+
+
+def test_graph_export(entities, tmp_path):
+    path = tmp_path / "graph.json"
+    invoke("export", "-i", entities, "-o", path, "-f", "entities")
+    stats = json.loads(invoke("stats", "-i", path))
+    assert (stats["proxies"], stats["nodes"], stats["edges"]) == (6, 6, 4)
+
+    path = tmp_path / "graph.graphml"
+    invoke("export", "-i", entities, "-o", path, "--slim")
+    assert "<graphml" in path.read_text()
@@ -0,0 +1,203 @@
+import threading
+import time
+
+from followthemoney_graph.lib import (
+    AsyncMapper,
+    SingleFlight,
+    AdaptiveLimiter,
+    prefetch,
+    bounded_map,
+    requeue_failed,
+)
+from followthemoney_graph.lib.concurrency import backoff_delays
+
+
+def test_async_mapper_completion_order():
+    def task(delay):
+        time.sleep(delay)
+        return delay
+
+    mapper = AsyncMapper(concurrency=4)
+    assert list(mapper(task, [0.2, 0.0, 0.1])) == [0.0, 0.1, 0.2]
+
+
+def test_async_mapper_bounded():
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def task(item):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return item
+
+    mapper = AsyncMapper(concurrency=3)
+    assert sorted(mapper(task, range(20))) == list(range(20))
+    assert running[1] == 3
+
+
+def test_async_mapper_skips_failures():
+    def task(item):
+        if item == 1:
+            raise ValueError(item)
+        return item
+
+    mapper = AsyncMapper(concurrency=4, timeout=0.1)
+    assert sorted(mapper(task, range(4))) == [0, 2, 3]
+
+
+def test_async_mapper_timeout_requeues():
+    lock = threading.Lock()
+    attempts = {}
+
+    def task(delay):
+        with lock:
+            attempts[delay] = attempts.get(delay, 0) + 1
+        time.sleep(delay)
+        return delay
+
+    # the slow task frees the only slot when it times out, so the tasks
+    # queued behind it run meanwhile; its item is requeued and the result
+    # of whichever attempt returns first is yielded, once
+    mapper = AsyncMapper(concurrency=1, timeout=0.1)
+    assert list(mapper(task, [0.25, 0.01, 0.01])) == [0.01, 0.01, 0.25]
+    assert attempts == {0.25: 2, 0.01: 2}
+
+    mapper = AsyncMapper(concurrency=1, timeout=0.1, retries=0)
+    assert list(mapper(task, [0.15, 0.01])) == [0.01, 0.15]
+
+
+def test_single_flight():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(key):
+        calls.append(key)
+        started.set()
+        release.wait(1)
+        return {"key": key}
+
+    flight = SingleFlight(copy=dict)
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("a", fetch, "a")))
+    leader.start()
+    started.wait(1)
+    waiters = [
+        threading.Thread(target=lambda: results.append(flight.do("a", fetch, "a")))
+        for _ in range(3)
+    ]
+    for thread in waiters:
+        thread.start()
+    while flight.coalesced < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader, *waiters]:
+        thread.join()
+
+    assert calls == ["a"]
+    assert results == [{"key": "a"}] * 4
+    assert len({id(r) for r in results}) == 4
+    assert flight.stats == {"calls": 1, "coalesced": 3}
+    assert flight.do("a", fetch, "a") == {"key": "a"}
+    assert flight.calls == 2
+
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(limit=2, max_limit=4, target_latency=1.0, cooldown=10)
+    for _ in range(2):
+        limiter.success(0.1)
+    assert limiter.limit == 3
+    limiter.success(5.0)
+    for _ in range(2):
+        limiter.success(0.1)
+    assert limiter.limit == 3
+    for _ in range(10):
+        limiter.success(0.1)
+    assert limiter.limit == 4
+
+    limiter.overload()
+    limiter.overload()
+    assert limiter.limit == 2
+
+    with limiter, limiter:
+        assert limiter.in_flight == 2
+        blocked = threading.Thread(target=limiter.acquire)
+        blocked.start()
+        blocked.join(0.05)
+        assert blocked.is_alive()
+    blocked.join(1)
+    assert limiter.in_flight == 1
+
+
+def test_backoff_delays():
+    delays = list(backoff_delays(5, base=1, cap=4))
+    assert len(delays) == 5
+    assert all(0 <= d <= min(4, 2 ** i) for i, d in enumerate(delays))
+
+
+def test_requeue_failed():
+    attempts = {}
+
+    def task(item):
+        attempts[item] = attempts.get(item, 0) + 1
+        if item == "flaky" and attempts[item] < 3 or item == "broken":
+            raise ValueError(item)
+        return item.upper()
+
+    items = ["ok", "flaky", "broken"]
+    results = list(requeue_failed(map, task, items, [0, 0], errors=(ValueError,)))
+    assert results == [("ok", "OK"), ("flaky", "FLAKY")]
+    assert attempts == {"ok": 1, "flaky": 3, "broken": 3}
+
+
+def test_prefetch():
+    assert list(prefetch(range(100), size=3)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise ValueError("page")
+
+    items = prefetch(failing())
+    assert next(items) == 1
+    try:
+        next(items)
+    except ValueError:
+        pass
+    else:
+        assert False, "error wasn't raised"
+
+
+def test_bounded_map():
+    def task(i):
+        time.sleep(0.01 * (5 - i))
+        return i
+
+    assert list(bounded_map(task, range(5), workers=5)) == [0, 1, 2, 3, 4]
+    unordered = list(bounded_map(task, range(5), workers=5, ordered=False))
+    assert unordered[0] == 4 and sorted(unordered) == [0, 1, 2, 3, 4]
+
+    read = []
+
+    def items():
+        for i in range(100):
+            read.append(i)
+            yield i
+
+    results = bounded_map(lambda i: i, items(), workers=2, window=4)
+    assert next(results) == 0
+    assert len(read) <= 5
+    results.close()
+
+    def fail(i):
+        raise ValueError(i)
+
+    try:
+        list(bounded_map(fail, range(3), workers=2))
+    except ValueError:
+        pass
+    else:
+        assert False, "error wasn't raised"
@@ -4,7 +4,12 @@ import random
 import logging
 import string
 
-from followthemoney_graph.backends.networkx import NetworkxEntityGraph as EntityGraph
+import pytest
+
+from followthemoney_graph.backends.networkx import NetworkxEntityGraph
+from followthemoney_graph.backends.csr import CSREntityGraph
+from followthemoney_graph.backends.sqlite import SQLiteEntityGraph
+from followthemoney_graph.interner import IdentityInterner
 
 fmt = "%(name)s [%(levelname)s] %(message)s"
 logging.basicConfig(level=logging.DEBUG, format=fmt)
@@ -17,6 +22,11 @@ def random_proxies(schema="LegalEntity"):
     return proxy
 
 
+@pytest.fixture(params=[NetworkxEntityGraph, CSREntityGraph, SQLiteEntityGraph])
+def EntityGraph(request):
+    return request.param
+
+
 def create_link(sources, targets):
     proxy = model.make_entity("UnknownLink")
     proxy.make_id(random.sample(string.ascii_letters, 8))
@@ -27,7 +37,7 @@ def create_link(sources, targets):
     return proxy
 
 
-def test_create_nodes():
+def test_create_nodes(EntityGraph):
     proxies = [random_proxies() for _ in range(10)]
     G = EntityGraph()
     G.add_proxies(proxies)
@@ -36,7 +46,7 @@ def test_create_nodes():
         assert p.id in G
 
 
-def test_create_edges():
+def test_create_edges(EntityGraph):
     proxies = [random_proxies() for _ in range(10)]
     edges = [create_link([proxies[i]], [proxies[-i]]) for i in range(len(proxies) // 2)]
 
@@ -48,7 +58,7 @@ def test_create_edges():
         assert p.id in G
 
 
-def test_merge():
+def test_merge(EntityGraph):
     proxies = [random_proxies() for _ in range(3)]
     edges = [
         create_link([proxies[2]], [proxies[1]]),
@@ -68,7 +78,7 @@ def test_merge():
     assert len(G.get_node_out_edges(node)) == 2
 
 
-def test_merge_self_loop():
+def test_merge_self_loop(EntityGraph):
     proxies = [random_proxies() for _ in range(3)]
     edges = [
         create_link([proxies[0]], [proxies[1]]),
@@ -89,7 +99,7 @@ def test_merge_self_loop():
     assert len(G.get_node_out_edges(node)) == 4
 
 
-def test_ensure_flag():
+def test_ensure_flag(EntityGraph):
     proxies = [random_proxies() for _ in range(3)]
     G = EntityGraph()
     G.add_proxies(proxies)
@@ -98,7 +108,7 @@ def test_ensure_flag():
         assert node.has_flags(test=True)
 
 
-def test_get_nodes():
+def test_get_nodes(EntityGraph):
     proxies = [random_proxies() for _ in range(10)]
     G = EntityGraph()
     G.add_proxies(proxies)
@@ -118,7 +128,7 @@ def test_get_nodes():
     assert len(list(G.nodes(test=None))) == 1
 
 
-def test_intersect_basic():
+def test_intersect_basic(EntityGraph):
     proxies_a = [random_proxies() for _ in range(5)]
     proxies_b = [random_proxies() for _ in range(5)]
     common = [random_proxies() for _ in range(5)]
@@ -139,7 +149,7 @@ def test_intersect_basic():
     assert all(p.id not in g for p in proxies_b)
 
 
-def test_intersect_merge():
+def test_intersect_merge(EntityGraph):
     proxies_a = [random_proxies() for _ in range(5)]
     proxies_b = [random_proxies() for _ in range(5)]
     common = [random_proxies() for _ in range(5)]
@@ -175,3 +185,450 @@ def test_intersect_merge():
     node = g.get_node_by_proxy(common[3])
     assert len(list(g.edges())) == 1
     assert len(list(G.get_node_out_edges(node))) == 1
+
+
+def test_bulk_matches_incremental(EntityGraph):
+    proxies = [random_proxies() for _ in range(10)]
+    edges = [create_link([proxies[i]], [proxies[-i]]) for i in range(len(proxies) // 2)]
+    edges.append(create_link([proxies[0]], ["missing-target"]))
+
+    G = EntityGraph()
+    G.add_proxies(edges)
+    G.add_proxies(proxies)
+
+    G_bulk = EntityGraph()
+    with G_bulk.bulk():
+        G_bulk.add_proxies(edges)
+        assert G_bulk.n_edges == 0
+        G_bulk.add_proxies(proxies)
+
+    assert len(G_bulk) == len(G)
+    assert G_bulk.n_nodes == G.n_nodes
+    assert G_bulk.n_edges == G.n_edges
+    assert {G_bulk._ids[k] for k in G_bulk._stub_proxies} == {"missing-target"}
+    assert {G._ids[k] for k in G._stub_proxies} == {"missing-target"}
+    for p in proxies:
+        node = G_bulk.get_node_by_proxy(p)
+        assert node.schema == p.schema
+
+
+def test_add_proxies_bulk(EntityGraph):
+    proxies = [random_proxies() for _ in range(5)]
+    edges = [create_link([proxies[0]], [p]) for p in proxies[1:]]
+
+    G = EntityGraph()
+    G.add_proxies(edges + proxies, bulk=True)
+
+    assert not G._stub_proxies
+    assert G.n_edges == 2 * len(edges)
+
+
+def test_merge_then_remove_bulk(EntityGraph):
+    proxies = [random_proxies() for _ in range(5)]
+    edges = [
+        create_link([proxies[0]], [proxies[2]]),
+        create_link([proxies[1]], [proxies[3]]),
+        create_link([proxies[3]], [proxies[4]]),
+    ]
+
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    G.add_proxies(edges)
+    with G.bulk():
+        G.merge_proxies(proxies[0], proxies[1])
+        G.merge_proxies(proxies[2], proxies[3])
+        G.remove_node(G.get_node_by_proxy(proxies[1]))
+
+    assert proxies[0].id not in G and proxies[1].id not in G
+    assert G.n_nodes == 2 + len(edges)
+    assert G.n_edges == 4
+    node = G.get_node_by_proxy(proxies[3])
+    assert len(node.parts) == 2
+    assert len(list(G.get_node_edges(node))) == 3
+
+
+def test_merge_chain_bulk(EntityGraph):
+    proxies = [random_proxies() for _ in range(6)]
+    edges = [create_link([proxies[i]], [proxies[i + 1]]) for i in range(5)]
+
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    G.add_proxies(edges)
+    with G.bulk():
+        for i in range(1, 5):
+            G.merge_proxies(proxies[0], proxies[i])
+        node = G.get_node_by_proxy(proxies[3])
+        assert len(node.parts) == 5
+
+    node = G.get_node_by_proxy(proxies[0])
+    assert G.n_nodes == 2 + len(edges)
+    assert all(G.get_node_by_proxy(p) is node for p in proxies[:5])
+    assert G.get_node_by_proxy(proxies[5]) is not node
+    # links between merged proxies collapse onto a single (link, node) edge
+    assert len(list(G.get_node_edges(node))) == len(edges)
+    assert G.n_edges == len(edges) + 1
+
+
+def test_flag_index(EntityGraph):
+    proxies = [random_proxies() for _ in range(6)]
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    nodes = [G.get_node_by_proxy(p) for p in proxies]
+    nodes[0].set_flags(done=True)
+    nodes[1].set_flags(done=True, tag="a")
+    nodes[2].flags = {"tag": "a"}
+
+    assert G._flag_index.find(done=None) is not None
+    assert {n.id for n in G.nodes(done=None)} == {n.id for n in nodes[2:]}
+    assert {n.id for n in G.nodes(done=True, tag="a")} == {nodes[1].id}
+    assert {n.id for n in G.nodes(tag="b")} == set()
+
+    G.merge_proxies(proxies[1], proxies[2])
+    assert {n.id for n in G.nodes(tag="a")} == {nodes[1].id}
+    assert {n.id for n in G.nodes(done=True)} == {nodes[0].id, nodes[1].id}
+
+    G.remove_node(nodes[0])
+    assert {n.id for n in G.nodes(done=True)} == {nodes[1].id}
+
+    nodes[3].set_flags(tag=["a", "b"])
+    assert G._flag_index.find(tag="a") is None
+    assert {n.id for n in G.nodes(tag="a")} == {nodes[1].id}
+
+
+@pytest.mark.parametrize(
+    "stored,queried", [(1, True), (True, 1), (0, False), (1.0, True), (2.0, 2)]
+)
+def test_flag_index_equal_values(EntityGraph, stored, queried):
+    proxies = [random_proxies() for _ in range(2)]
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    node = G.get_node_by_proxy(proxies[0])
+    node.set_flags(f=stored)
+    assert node.has_flags(f=queried)
+    assert G._flag_index.find(f=queried) is not None
+    assert [n.id for n in G.nodes(f=queried)] == [node.id]
+
+
+def test_edges_filtered(EntityGraph):
+    proxies = [random_proxies() for _ in range(4)]
+    edges = [
+        create_link([proxies[0]], [proxies[1]]),
+        create_link([proxies[2]], [proxies[3]]),
+    ]
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    G.add_proxies(edges)
+    for p in proxies[:2] + edges[:1]:
+        G.get_node_by_proxy(p).set_flags(keep=True)
+
+    assert len(list(G.edges())) == 4
+    assert len(list(G.edges(keep=True))) == 2
+    assert len(list(G.edges(keep=None))) == 2
+    assert len(list(G.edges(props="subject"))) == 2
+    assert len(list(G.edges(props=["object"], keep=True))) == 1
+    assert len(list(G.edges(schematas="UnknownLink"))) == 4
+    assert len(list(G.edges(schematas="Ownership"))) == 0
+
+
+def test_interned_ids(EntityGraph):
+    proxies = [random_proxies() for _ in range(2)]
+    link = create_link([proxies[0]], [proxies[1]])
+    G = EntityGraph()
+    G.add_proxies(proxies + [link])
+
+    node_ids = {n.id for n in G.nodes()}
+    assert node_ids == {p.id for p in proxies + [link]}
+    for source, target, key, data in G.edges():
+        assert {source, target} <= node_ids
+        assert key == link.id
+    assert "unknown" not in G
+    assert G.get_node(link.id).id == link.id
+
+    released = G._ids.lookup(link.id)
+    G.remove_node(G.get_node(link.id))
+    assert link.id not in G
+    if not isinstance(G._ids, IdentityInterner):
+        assert link.id not in G._ids
+        assert proxies[0].id in G._ids
+        # the link was interned last: its key is the highest one
+        assert G._ids.intern("new-id") != released
+    G.add_proxy(link)
+    assert G.n_edges == 2
+
+
+def test_csr_compaction():
+    class SmallCSREntityGraph(CSREntityGraph):
+        COMPACT_THRESHOLD = 3
+
+    proxies = [random_proxies() for _ in range(6)]
+    edges = [create_link([proxies[i]], [proxies[i + 1]]) for i in range(5)]
+    graphs = [NetworkxEntityGraph(), SmallCSREntityGraph()]
+    for G in graphs:
+        G.add_proxies(proxies)
+        G.add_proxies(edges)
+        G.merge_proxies(proxies[0], proxies[1])
+        G.remove_node(G.get_node_by_proxy(proxies[5]))
+    G_nx, G_csr = graphs
+
+    def edge_set(G):
+        return {(frozenset((s, t)), k, d["prop"]) for s, t, k, d in G.edges()}
+
+    assert G_csr.n_edges == G_nx.n_edges
+    assert edge_set(G_csr) == edge_set(G_nx)
+    G_csr.compact()
+    assert G_csr.n_edges == G_nx.n_edges == len(list(G_csr.edges()))
+    indptr = G_csr._indptr
+    G_csr.compact()
+    assert G_csr._indptr is indptr
+    assert G_csr.get_degrees() == dict(
+        (G_nx._ids[k], d) for k, d in G_nx.network.degree()
+    )
+    node = G_csr.get_node_by_proxy(proxies[0])
+    neighbors = {n.id for n in G_csr.get_node_neighbors(node)}
+    assert neighbors == {edges[0].id, edges[1].id}
+    components = G_csr.get_components()
+    assert [len(c) for c in components] == [G_nx.n_nodes]
+
+
+def test_sqlite_cache_eviction(tmp_path):
+    path = str(tmp_path / "graph.sqlite")
+    proxies = [random_proxies() for _ in range(6)]
+    edges = [create_link([proxies[i]], [proxies[i + 1]]) for i in range(5)]
+
+    G = SQLiteEntityGraph(path, cache_size=2)
+    G.add_proxies(proxies + edges, bulk=True)
+    G.merge_proxies(proxies[0], proxies[1])
+    for node in list(G.nodes()):
+        node.set_flags(seen=True)
+    G.get_node_by_proxy(proxies[2]).set_flags(seen=False)
+    assert len(G._cache._data) <= 2
+    G.close()
+
+    G = SQLiteEntityGraph(path)
+    assert len(G) == len(proxies) + len(edges)
+    assert G.n_nodes == len(proxies) + len(edges) - 1
+    assert G.n_edges == 2 * len(edges) - 1
+    assert len(G.get_node_by_proxy(proxies[1]).parts) == 2
+    assert {n.id for n in G.nodes(seen=False)} == {proxies[2].id}
+    G.close()
+
+
+def test_sqlite_evicted_changes(tmp_path):
+    path = str(tmp_path / "graph.sqlite")
+    proxies = [random_proxies() for _ in range(4)]
+    G = SQLiteEntityGraph(path, cache_size=1)
+    G.add_proxies(proxies)
+    nodes = [G.get_node_by_proxy(p) for p in proxies]
+    assert G.get_node_by_proxy(proxies[0]) is nodes[0]
+    G.merge_nodes(nodes[0], nodes[1])
+    G.merge_nodes(nodes[2], nodes[3])
+    for node in nodes:
+        G.get_node_by_proxy(proxies[3])
+        node.set_flags(seen=True)
+    G.close()
+
+    G = SQLiteEntityGraph(path)
+    assert G.n_nodes == 2
+    assert len(G.get_node_by_proxy(proxies[1]).parts) == 2
+    assert len(G.get_node_by_proxy(proxies[3]).parts) == 2
+    assert len(list(G.nodes(seen=True))) == 2
+    G.close()
+
+
+def test_file_roundtrip(EntityGraph, tmp_path):
+    proxies = [random_proxies() for _ in range(6)]
+    edges = [create_link([proxies[i]], [proxies[i + 1]]) for i in range(5)]
+    G = EntityGraph()
+    G.add_proxies(proxies + edges)
+    G.merge_proxies(proxies[0], proxies[1])
+    G.get_node_by_proxy(proxies[0]).set_flags(done=True)
+
+    path = tmp_path / "graph.json"
+    with open(path, "w") as fd:
+        G.to_file(fd)
+    with open(path) as fd:
+        G_loaded = EntityGraph.from_file(fd)
+
+    assert len(G_loaded) == len(G)
+    assert G_loaded.n_nodes == G.n_nodes
+    assert G_loaded.n_edges == G.n_edges
+    node = G_loaded.get_node_by_proxy(proxies[1])
+    assert len(node.parts) == 2
+    assert {n.id for n in G_loaded.nodes(done=True)} == {node.id}
+
+
+def test_snapshot_roundtrip(EntityGraph, tmp_path):
+    proxies = [random_proxies() for _ in range(6)]
+    edges = [create_link([proxies[i]], [proxies[i + 1]]) for i in range(5)]
+    G = EntityGraph()
+    G.add_proxies(proxies + edges)
+    G.merge_proxies(proxies[0], proxies[1])
+    G.get_node_by_proxy(proxies[0]).set_flags(done=True)
+    target = random_proxies()
+    G.add_proxy(create_link([proxies[5]], [target]))
+
+    path = tmp_path / "graph.snapshot"
+    with open(path, "wb") as fd:
+        G.to_snapshot(fd)
+    with open(path, "rb") as fd:
+        G_loaded = EntityGraph.from_snapshot(fd)
+
+    assert len(G_loaded) == len(G)
+    assert G_loaded.n_nodes == G.n_nodes
+    assert G_loaded.n_edges == G.n_edges
+    assert {frozenset(e[:2]) for e in G_loaded.edges()} == {
+        frozenset(e[:2]) for e in G.edges()
+    }
+    node = G_loaded.get_node_by_proxy(proxies[1])
+    assert len(node.parts) == 2
+    assert {n.id for n in G_loaded.nodes(done=True)} == {node.id}
+
+    G_loaded.add_proxy(target)
+    assert G_loaded.n_nodes == G.n_nodes
+    assert G_loaded.get_node_by_proxy(target).schema.name == target.schema.name
+
+
+def test_change_journal(EntityGraph):
+    proxies = [random_proxies() for _ in range(4)]
+    G = EntityGraph()
+    G.add_proxies(proxies[:2])
+    assert G._journal is None
+
+    with G.track_changes() as checkpoint:
+        target = random_proxies()
+        G.add_proxies([proxies[2], create_link([proxies[2]], [target])])
+        G.merge_proxies(proxies[0], proxies[1])
+        G.get_node_by_proxy(proxies[0]).set_flags(done=True)
+        G.add_proxy(target)
+        changes = G.get_changes(checkpoint)
+    assert G._journal is None
+
+    left = G.get_node_by_proxy(proxies[0])
+    assert proxies[2].id in changes["nodes_new"]
+    assert changes["stubs_filled"] == [target.id]
+    assert changes["merge"] == {left.id: [proxies[1].id]}
+    assert changes["flags"] == {left.id: {"done": True}}
+    assert proxies[0].id not in changes["proxies_new"]
+
+
+def test_merge_properties(EntityGraph):
+    from followthemoney_graph.operations.proxy import merge_properties
+
+    proxies = [random_proxies() for _ in range(3)]
+    proxies[1].add("email", "info@example.com")
+    proxies[2].add("email", "info@example.com")
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    changes = merge_properties(G, properties=["emails"])
+    assert G.n_nodes == 2
+    node = G.get_node_by_proxy(proxies[1])
+    assert len(node.parts) == 2
+    assert list(changes["merge"]) == [node.id]
+
+
+def test_connected_components(EntityGraph):
+    from followthemoney_graph.operations.graph import connected_components
+
+    proxies = [random_proxies() for _ in range(5)]
+    links = [
+        create_link([proxies[0]], [proxies[1]]),
+        create_link([proxies[1]], [proxies[2]]),
+    ]
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    G.add_proxies(links)
+    components = sorted(sorted(c) for c in connected_components(G))
+    linked = sorted([p.id for p in proxies[:3]] + [link.id for link in links])
+    assert components == sorted([linked, [proxies[3].id], [proxies[4].id]])
+
+
+def test_graph_views(EntityGraph):
+    from followthemoney_graph.operations.graph import (
+        filter_component_size,
+        filter_degree_min,
+        filter_kcore,
+    )
+
+    proxies = [random_proxies() for _ in range(5)]
+    links = [
+        create_link([proxies[0]], [proxies[1]]),
+        create_link([proxies[1]], [proxies[2]]),
+    ]
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    G.add_proxies(links)
+
+    view = filter_component_size(G, (2, None))
+    assert view.n_nodes == 5 and view.n_edges == 4
+    assert proxies[0].id in view and proxies[3].id not in view
+    assert view.get_node_by_proxy(proxies[0]) is G.get_node_by_proxy(proxies[0])
+
+    chained = filter_degree_min(view, 2)
+    assert chained.parent is G
+    expected = {proxies[1].id, *(link.id for link in links)}
+    assert {n.id for n in chained.nodes()} == expected
+    assert chained.n_edges == 2
+    assert filter_kcore(G, 1).n_nodes == 5
+    assert filter_kcore(G, 2).n_nodes == 0
+
+    view.get_node_by_proxy(proxies[0]).set_flags(seen=True)
+    assert [n.id for n in G.nodes(seen=True)] == [proxies[0].id]
+    with pytest.raises(NotImplementedError):
+        view.add_proxy(random_proxies())
+
+    copy = filter_component_size(G, (2, None), copy=True)
+    assert type(copy) is EntityGraph
+    assert copy.n_nodes == 5 and copy.n_edges == 4
+    assert copy.get_node_by_proxy(proxies[0]) is not G.get_node_by_proxy(proxies[0])
+    assert copy.get_node_by_proxy(proxies[0]).flags == {"seen": True}
+
+
+def test_graph_view_kcore_and_stubs(EntityGraph):
+    from followthemoney_graph.backends.view import EntityGraphView
+    from followthemoney_graph.operations.graph import filter_kcore
+
+    proxies = [random_proxies() for _ in range(3)]
+    links = [create_link([proxies[i - 1]], [proxies[i]]) for i in range(3)]
+    links.append(create_link([proxies[0]], ["missing-target"]))
+    links.append(create_link([random_proxies()], ["other-target"]))
+    G = EntityGraph()
+    G.add_proxies(proxies + links)
+
+    core = filter_kcore(G, 2)
+    expected = {p.id for p in proxies} | {link.id for link in links[:3]}
+    assert {n.id for n in core.nodes()} == expected
+    assert core.n_stubs == 0
+    assert filter_kcore(G, 3).n_nodes == 0
+
+    stub_key = G._node_key(G.get_node_by_proxy_id("missing-target").id)
+    # fewer view nodes than parent stubs: the view's parts are looked up
+    assert {G._ids[k] for k in EntityGraphView(G, [stub_key])._stub_proxies} == {
+        "missing-target"
+    }
+    everything = EntityGraphView(G, [G._node_key(n.id) for n in G.nodes()])
+    assert everything.n_stubs == G.n_stubs == 3
+
+
+def test_graph_view_follows_parent(EntityGraph):
+    from followthemoney_graph.operations.graph import filter_component_size
+
+    proxies = [random_proxies() for _ in range(4)]
+    links = [
+        create_link([proxies[0]], [proxies[1]]),
+        create_link([proxies[2]], [proxies[3]]),
+    ]
+    G = EntityGraph()
+    G.add_proxies(proxies)
+    G.add_proxies(links)
+    view = filter_component_size(G, (2, None))
+    assert view.n_nodes == 6 and view.n_edges == 4
+
+    G.merge_proxies(proxies[0], proxies[2])
+    node = G.get_node_by_proxy(proxies[0])
+    assert view.n_nodes == 5 and view.n_edges == 4
+    assert node.id in {n.id for n in view.nodes()}
+    assert view.get_node_by_proxy(proxies[2]) is node
+
+    G.remove_node(G.get_node_by_proxy(links[1]))
+    assert view.n_nodes == 4 and view.n_edges == 2
+    assert links[1].id not in view
@@ -0,0 +1,66 @@
+import io
+import json
+import threading
+
+from followthemoney_graph.lib import AsyncMapper, Metrics, bounded_map
+
+
+def test_metrics_disabled():
+    metrics = Metrics()
+    metrics.incr("requests")
+    with metrics.timer("parse"):
+        pass
+    assert metrics.get("requests") is None
+    assert metrics.to_dict()["counters"] == []
+
+
+def test_metrics():
+    metrics = Metrics(enabled=True, buckets=(0.1, 1))
+
+    @metrics.instrument("expand")
+    def expand():
+        metrics.incr("requests", endpoint="entities")
+        metrics.incr("requests", endpoint="match")
+        metrics.observe("latency", 0.5, endpoint="entities")
+        metrics.observe("latency", 5, endpoint="entities")
+
+    expand()
+    metrics.incr("requests", endpoint="entities")
+    assert metrics.get("requests") == 3
+    assert metrics.get("requests", operation="expand") == 2
+    assert metrics.get("requests", endpoint="entities") == 2
+    latency = metrics.get("latency", endpoint="entities")
+    assert latency == {"count": 2, "sum": 5.5, "buckets": [0, 1, 1]}
+    assert metrics.get("operation", operation="expand")["count"] == 1
+
+    fd = io.StringIO()
+    metrics.to_json(fd)
+    data = json.loads(fd.getvalue())
+    assert len(data["counters"]) == 3
+    assert {h["name"] for h in data["histograms"]} == {"latency", "operation"}
+
+
+def test_metrics_operation_per_thread():
+    metrics = Metrics(enabled=True)
+    both_running = threading.Barrier(2)
+
+    def request(item):
+        metrics.incr("requests")
+
+    def run(name):
+        @metrics.instrument(name)
+        def operation():
+            # both operations are running while their tasks record samples
+            both_running.wait()
+            list(bounded_map(request, range(10), workers=2))
+            list(AsyncMapper(concurrency=2)(request, range(10)))
+
+        operation()
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.get("requests", operation="a") == 20
+    assert metrics.get("requests", operation="b") == 20
@@ -25,11 +25,21 @@ setup(
         "requests",
         "redis",
         "networkx[all]",
+        "numpy",
+        "scipy",
     ],
     extras_require={
         "examples": [
             "click",
-        ]
+        ],
+        "fast": [
+            "orjson",
+        ],
+    },
+    entry_points={
+        "followthemoney.cli": [
+            "graph = followthemoney_graph.cli:graph",
+        ],
     },
     test_suite="nose.collector",
     tests_require=["coverage", "nose"],